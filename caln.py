@@ -1,1745 +1,6181 @@
-import os
-import sys
-import pandas as pd
-import numpy as np
-from skopt import gp_minimize
-from skopt.space import Real
-from openpyxl import Workbook
-from openpyxl.chart import BarChart, LineChart, Reference
-from openpyxl.styles import PatternFill
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-from sklearn.linear_model import LinearRegression
-import subprocess
-import shutil
-import copy
-import json
-import logging
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
-import ctypes
-import threading
-import portalocker
-from datetime import datetime
-
-# --------------------- Path Handling for PyInstaller ---------------------
-def resource_path(relative_path):
-    try:
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-    return os.path.join(base_path, relative_path)
-
-# Global variables
-stop_calibration_flag = False
-calibration_thread = None
-
-# =====================================================================
-#  SCALING ENGINE
-#  All dimensions flow through S()/SF() so the entire UI scales uniformly.
-#  base_dpi_scale: detected from OS (1.0 at 96dpi, 1.5 at 144dpi, 2.0 at 4K)
-#  user_zoom: manual Ctrl+/- zoom (0.5x to 2.5x)
-# =====================================================================
-base_dpi_scale = 1.0
-user_zoom = 1.0
-
-def _detect_dpi_scale():
-    """Detect OS DPI scaling BEFORE creating any tk window."""
-    global base_dpi_scale
-    try:
-        ctypes.windll.shcore.SetProcessDpiAwareness(2)  # Per-monitor DPI v2
-    except Exception:
-        try:
-            ctypes.windll.user32.SetProcessDPIAware()
-        except Exception:
-            pass
-    try:
-        hdc = ctypes.windll.user32.GetDC(0)
-        dpi = ctypes.windll.gdi32.GetDeviceCaps(hdc, 88)  # LOGPIXELSX
-        ctypes.windll.user32.ReleaseDC(0, hdc)
-        base_dpi_scale = dpi / 96.0
-    except Exception:
-        base_dpi_scale = 1.0
-
-_detect_dpi_scale()  # Call immediately at import time
-
-def _scale_factor():
-    return base_dpi_scale * user_zoom
-
-def S(val):
-    """Scale a pixel value by DPI * zoom. Returns int."""
-    return int(val * _scale_factor())
-
-def SF(base_size):
-    """Scale a font size. Minimum 7."""
-    return max(7, int(base_size * _scale_factor()))
-
-def F(key):
-    """Get a scaled font tuple by name."""
-    fonts = {
-        "heading_xl":  ("Segoe UI", SF(22), "bold"),
-        "heading_lg":  ("Segoe UI", SF(16), "bold"),
-        "heading_md":  ("Segoe UI", SF(13), "bold"),
-        "heading_sm":  ("Segoe UI", SF(11), "bold"),
-        "body":        ("Segoe UI", SF(10)),
-        "body_sm":     ("Segoe UI", SF(9)),
-        "mono":        ("Cascadia Code", SF(9)),
-        "mono_sm":     ("Cascadia Code", SF(8)),
-        "label":       ("Segoe UI", SF(10)),
-        "label_bold":  ("Segoe UI", SF(10), "bold"),
-        "button":      ("Segoe UI", SF(10), "bold"),
-        "button_sm":   ("Segoe UI", SF(9), "bold"),
-        "tag":         ("Segoe UI", SF(8), "bold"),
-    }
-    return fonts.get(key, fonts["body"])
-
-# Widget registry for zoom rescaling
-_scalable_widgets = []
-
-def _register(widget):
-    """Register a custom widget for rescaling on zoom."""
-    _scalable_widgets.append(widget)
-    return widget
-
-def _labeled(parent, text, font_tag, **kw):
-    """Create a Label with a font tag for zoom rescaling."""
-    lbl = tk.Label(parent, text=text, font=F(font_tag), **kw)
-    lbl._font_tag = font_tag
-    return lbl
-
-# =====================================================================
-#  ZOOM FUNCTIONS (Ctrl+/- and Ctrl+0)
-# =====================================================================
-def zoom_in(event=None):
-    global user_zoom
-    user_zoom = min(2.5, round(user_zoom + 0.1, 1))
-    _apply_zoom()
-
-def zoom_out(event=None):
-    global user_zoom
-    user_zoom = max(0.5, round(user_zoom - 0.1, 1))
-    _apply_zoom()
-
-def reset_zoom(event=None):
-    global user_zoom
-    user_zoom = 1.0
-    _apply_zoom()
-
-def _apply_zoom():
-    """Walk entire widget tree and update all fonts + rescale custom widgets."""
-    log_message(f"  Zoom: {user_zoom:.1f}x  ·  DPI: {base_dpi_scale:.2f}x  ·  Effective: {_scale_factor():.2f}x")
-    _walk_rescale(root)
-    for w in _scalable_widgets:
-        try:
-            w.rescale()
-        except Exception:
-            pass
-
-def _walk_rescale(widget):
-    """Recursively update fonts on standard tk widgets."""
-    try:
-        if isinstance(widget, tk.Label) and hasattr(widget, '_font_tag'):
-            widget.config(font=F(widget._font_tag))
-        elif isinstance(widget, tk.Entry):
-            widget.config(font=F("body"))
-        elif isinstance(widget, tk.Text):
-            widget.config(font=F("mono"))
-        elif isinstance(widget, ttk.Combobox):
-            widget.config(font=F("body"))
-    except Exception:
-        pass
-    try:
-        for child in widget.winfo_children():
-            _walk_rescale(child)
-    except Exception:
-        pass
-
-
-# =====================================================================
-#  DESIGN SYSTEM  — Vercel/Linear inspired dark theme
-# =====================================================================
-
-
-# =====================================================================
-#  DUAL THEME SYSTEM — Dark (default) + Light
-# =====================================================================
-
-DARK_THEME = {
-    "bg_primary":     "#10131a",
-    "bg_secondary":   "#181c27",
-    "bg_tertiary":    "#212636",
-    "bg_input":       "#1a1e2a",
-    "bg_log":         "#0c0e14",
-    "border":         "#2e3446",
-    "border_focus":   "#3b82f6",
-    "border_hover":   "#3d4456",
-    "border_input":   "#363c50",
-    "text_primary":   "#edf0f7",
-    "text_secondary": "#a0a8be",
-    "text_tertiary":  "#6b7280",
-    "text_on_accent": "#ffffff",
-    "accent":         "#06b6d4",
-    "accent_hover":   "#0891b2",
-    "accent_muted":   "#164e63",
-    "success":        "#10b981",
-    "success_hover":  "#059669",
-    "danger":         "#ef4444",
-    "danger_hover":   "#dc2626",
-    "toggle_on":      "#10b981",
-    "toggle_off":     "#3d4456",
-    "toggle_knob":    "#ffffff",
-    "progress_bg":    "#252a38",
-    "progress_fill":  "#06b6d4",
-}
-
-LIGHT_THEME = {
-    "bg_primary":     "#f0f2f5",
-    "bg_secondary":   "#ffffff",
-    "bg_tertiary":    "#e8ebf0",
-    "bg_input":       "#f7f8fa",
-    "bg_log":         "#fafbfc",
-    "border":         "#d1d5db",
-    "border_focus":   "#3b82f6",
-    "border_hover":   "#b0b6c2",
-    "border_input":   "#c8cdd6",
-    "text_primary":   "#1a1d27",
-    "text_secondary": "#4b5563",
-    "text_tertiary":  "#9ca3af",
-    "text_on_accent": "#ffffff",
-    "accent":         "#0891b2",
-    "accent_hover":   "#0e7490",
-    "accent_muted":   "#cffafe",
-    "success":        "#059669",
-    "success_hover":  "#047857",
-    "danger":         "#dc2626",
-    "danger_hover":   "#b91c1c",
-    "toggle_on":      "#10b981",
-    "toggle_off":     "#d1d5db",
-    "toggle_knob":    "#ffffff",
-    "progress_bg":    "#e5e7eb",
-    "progress_fill":  "#0891b2",
-}
-
-# Active palette — starts as dark
-COLORS = dict(DARK_THEME)
-_is_dark = True
-
-def toggle_theme():
-    """Switch between dark and light themes."""
-    global _is_dark
-    _is_dark = not _is_dark
-    theme = DARK_THEME if _is_dark else LIGHT_THEME
-    COLORS.update(theme)
-    _apply_theme()
-
-def _apply_theme():
-    """Rebuild all widget colors after theme change."""
-    _walk_retheme(root)
-    # Rescale also redraws custom canvas widgets with new colors
-    for w in _scalable_widgets:
-        try:
-            w.rescale()
-        except Exception:
-            pass
-    # Re-style combobox
-    sty = ttk.Style()
-    sty.configure("Modern.TCombobox",
-                  fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
-                  foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
-                  bordercolor=COLORS["border_input"])
-    sty.map("Modern.TCombobox",
-            fieldbackground=[("readonly", COLORS["bg_input"])],
-            foreground=[("readonly", COLORS["text_primary"])])
-    log_message(f"  Theme: {'Dark' if _is_dark else 'Light'}")
-
-def _walk_retheme(widget):
-    """Recursively recolor standard widgets."""
-    try:
-        wtype = widget.winfo_class()
-        if wtype == 'Frame':
-            # Determine if it's a card (bg_secondary) or main (bg_primary)
-            try:
-                old_bg = widget.cget("bg")
-            except:
-                old_bg = ""
-            if old_bg in (DARK_THEME["bg_secondary"], LIGHT_THEME["bg_secondary"]):
-                widget.config(bg=COLORS["bg_secondary"])
-            elif old_bg in (DARK_THEME["accent_muted"], LIGHT_THEME["accent_muted"]):
-                widget.config(bg=COLORS["accent_muted"])
-            else:
-                widget.config(bg=COLORS["bg_primary"])
-        elif wtype == 'Label':
-            parent_bg = COLORS["bg_primary"]
-            try:
-                parent_bg = widget.master.cget("bg")
-            except:
-                pass
-            widget.config(bg=parent_bg)
-            # Determine text color from font tag
-            fg = widget.cget("fg")
-            if fg in (DARK_THEME["text_primary"], LIGHT_THEME["text_primary"]):
-                widget.config(fg=COLORS["text_primary"])
-            elif fg in (DARK_THEME["text_secondary"], LIGHT_THEME["text_secondary"]):
-                widget.config(fg=COLORS["text_secondary"])
-            elif fg in (DARK_THEME["text_tertiary"], LIGHT_THEME["text_tertiary"]):
-                widget.config(fg=COLORS["text_tertiary"])
-            elif fg in (DARK_THEME["accent"], LIGHT_THEME["accent"]):
-                widget.config(fg=COLORS["accent"])
-        elif wtype == 'Entry':
-            widget.config(bg=COLORS["bg_input"], fg=COLORS["text_primary"],
-                         insertbackground=COLORS["accent"],
-                         highlightbackground=COLORS["border_input"],
-                         highlightcolor=COLORS["border_focus"])
-        elif wtype == 'Text':
-            widget.config(bg=COLORS["bg_log"], fg=COLORS["text_secondary"],
-                         insertbackground=COLORS["accent"],
-                         highlightbackground=COLORS["border_input"])
-    except Exception:
-        pass
-    try:
-        for child in widget.winfo_children():
-            _walk_retheme(child)
-    except Exception:
-        pass
-
-
-# =====================================================================
-#  CUSTOM WIDGETS — Polished, DPI-aware, visible borders
-# =====================================================================
-
-class ModernCard(tk.Frame):
-    def __init__(self, parent, title=None, icon=None, **kwargs):
-        super().__init__(parent, bg=COLORS["bg_secondary"],
-                         highlightbackground=COLORS["border"], highlightthickness=1, **kwargs)
-        if title:
-            header = tk.Frame(self, bg=COLORS["bg_secondary"])
-            header.pack(fill=tk.X, padx=S(20), pady=(S(14), S(6)))
-            text = f"{icon}  {title}" if icon else title
-            _labeled(header, text, "heading_md",
-                     bg=COLORS["bg_secondary"], fg=COLORS["text_primary"]).pack(side=tk.LEFT)
-
-
-class ModernButton(tk.Canvas):
-    """Rounded button with proper text sizing and visible borders."""
-    def __init__(self, parent, text, command=None, style="primary",
-                 width=140, height=38, icon=None, **kwargs):
-        self._base_w = width
-        self._base_h = height
-        w, h = S(width), S(height)
-        super().__init__(parent, width=w, height=h,
-                         bg=parent.cget("bg"), highlightthickness=0, **kwargs)
-        self._command = command
-        self._icon = icon
-        self._label = text
-        self._text = f"{icon} {text}" if icon else text
-        self._style_name = style
-        self._width = w
-        self._height = h
-        self._hovered = False
-        self._pressed = False
-
-        styles = {
-            "primary":   (COLORS["accent"],      COLORS["accent_hover"],  "#ffffff",             ""),
-            "success":   (COLORS["success"],      COLORS["success_hover"], "#ffffff",             ""),
-            "danger":    (COLORS["danger"],       COLORS["danger_hover"],  "#ffffff",             ""),
-            "ghost":     (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
-            "outline":   ("transparent",          COLORS["bg_tertiary"],   COLORS["accent"],      COLORS["accent"]),
-            "secondary": (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
-        }
-        self._bg, self._hover_bg, self._fg, self._outline = styles.get(style, styles["primary"])
-
-        self._draw()
-        self.bind("<Enter>", self._on_enter)
-        self.bind("<Leave>", self._on_leave)
-        self.bind("<ButtonPress-1>", self._on_press)
-        self.bind("<ButtonRelease-1>", self._on_release)
-
-    def _draw(self):
-        self.delete("all")
-        r = S(6)
-        w, h = self._width, self._height
-        bg = self._hover_bg if self._hovered else self._bg
-        if bg == "transparent":
-            bg = self.master.cget("bg")
-        outline = self._outline if (self._outline and not self._hovered) else ""
-        self._rrect(1, 1, w-1, h-1, r, fill=bg, outline=outline, width=1)
-        # Font that won't overflow: use smaller font for compact buttons
-        font = F("button") if self._base_w >= 120 else F("button_sm")
-        self.create_text(w/2, h/2, text=self._text, font=font, fill=self._fg)
-
-    def _rrect(self, x1, y1, x2, y2, r, **kw):
-        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
-               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
-               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
-        return self.create_polygon(pts, smooth=True, **kw)
-
-    def _on_enter(self, e):
-        self._hovered = True; self._draw(); self.config(cursor="hand2")
-    def _on_leave(self, e):
-        self._hovered = False; self._draw()
-    def _on_press(self, e):
-        self._pressed = True
-    def _on_release(self, e):
-        if self._pressed and self._hovered and self._command: self._command()
-        self._pressed = False
-
-    def rescale(self):
-        self._width, self._height = S(self._base_w), S(self._base_h)
-        self.config(width=self._width, height=self._height)
-        # Re-read colors for theme switch
-        styles = {
-            "primary":   (COLORS["accent"],      COLORS["accent_hover"],  "#ffffff",             ""),
-            "success":   (COLORS["success"],      COLORS["success_hover"], "#ffffff",             ""),
-            "danger":    (COLORS["danger"],       COLORS["danger_hover"],  "#ffffff",             ""),
-            "ghost":     (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
-            "outline":   ("transparent",          COLORS["bg_tertiary"],   COLORS["accent"],      COLORS["accent"]),
-            "secondary": (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
-        }
-        self._bg, self._hover_bg, self._fg, self._outline = styles.get(self._style_name, styles["primary"])
-        try:
-            self.config(bg=self.master.cget("bg"))
-        except: pass
-        self._draw()
-
-
-class ModernEntry(tk.Frame):
-    """Entry with visible border and focus ring."""
-    def __init__(self, parent, width=45, placeholder="", **kwargs):
-        super().__init__(parent, bg=parent.cget("bg"))
-        self.entry = tk.Entry(
-            self, width=width,
-            bg=COLORS["bg_input"], fg=COLORS["text_primary"],
-            insertbackground=COLORS["accent"], font=F("body"),
-            relief="flat", bd=0,
-            highlightbackground=COLORS["border_input"],
-            highlightcolor=COLORS["border_focus"],
-            highlightthickness=1,
-        )
-        self.entry.pack(padx=0, pady=0, ipady=S(5), ipadx=S(6))
-        self._placeholder = placeholder
-        self._has_placeholder = False
-        if placeholder:
-            self._show_placeholder()
-            self.entry.bind("<FocusIn>", self._on_focus_in)
-            self.entry.bind("<FocusOut>", self._on_focus_out)
-
-    def _show_placeholder(self):
-        self.entry.insert(0, self._placeholder)
-        self.entry.config(fg=COLORS["text_tertiary"]); self._has_placeholder = True
-    def _on_focus_in(self, e):
-        if self._has_placeholder:
-            self.entry.delete(0, tk.END); self.entry.config(fg=COLORS["text_primary"]); self._has_placeholder = False
-    def _on_focus_out(self, e):
-        if not self.entry.get(): self._show_placeholder()
-    def get(self):
-        return "" if self._has_placeholder else self.entry.get()
-    def delete(self, *a): self.entry.delete(*a)
-    def insert(self, *a):
-        if self._has_placeholder:
-            self.entry.delete(0, tk.END); self.entry.config(fg=COLORS["text_primary"]); self._has_placeholder = False
-        self.entry.insert(*a)
-    def rescale(self):
-        self.entry.config(font=F("body"))
-
-
-class ModernCombobox(ttk.Combobox):
-    def __init__(self, parent, **kwargs):
-        sty = ttk.Style()
-        sty.configure("Modern.TCombobox",
-                      fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
-                      foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
-                      bordercolor=COLORS["border_input"], lightcolor=COLORS["border_input"],
-                      darkcolor=COLORS["border_input"],
-                      selectbackground=COLORS["accent_muted"], selectforeground=COLORS["text_primary"],
-                      padding=(S(8), S(5)))
-        sty.map("Modern.TCombobox",
-                fieldbackground=[("readonly", COLORS["bg_input"])],
-                foreground=[("readonly", COLORS["text_primary"])],
-                bordercolor=[("focus", COLORS["border_focus"])])
-        super().__init__(parent, style="Modern.TCombobox", **kwargs)
-
-
-class ModernProgressBar(tk.Canvas):
-    def __init__(self, parent, height=6, **kwargs):
-        self._base_h = height; h = S(height)
-        super().__init__(parent, height=h, bg=parent.cget("bg"), highlightthickness=0, **kwargs)
-        self._height = h; self._value = 0
-        self.bind("<Configure>", lambda e: self._draw())
-    def _draw(self):
-        self.delete("all"); w = self.winfo_width(); h = self._height
-        if w < 10: return
-        r = h // 2
-        self._rrect(0, 0, w, h, r, fill=COLORS["progress_bg"])
-        if self._value > 0:
-            self._rrect(0, 0, max(h, (self._value/100)*w), h, r, fill=COLORS["progress_fill"])
-    def _rrect(self, x1, y1, x2, y2, r, **kw):
-        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
-               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
-               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
-        return self.create_polygon(pts, smooth=True, **kw)
-    def set_value(self, v):
-        self._value = max(0, min(100, v)); self._draw()
-    def rescale(self):
-        self._height = S(self._base_h); self.config(height=self._height); self._draw()
-
-
-class ModernToggle(tk.Canvas):
-    """Toggle with GREEN on / GRAY off — clearly visible states."""
-    def __init__(self, parent, text="", variable=None, **kwargs):
-        self._frame = tk.Frame(parent, bg=parent.cget("bg"))
-        tw, th = S(44), S(24)
-        super().__init__(self._frame, width=tw, height=th,
-                         bg=parent.cget("bg"), highlightthickness=0)
-        self._var = variable or tk.BooleanVar(value=False)
-        self._tw, self._th = tw, th
-        self.pack(side=tk.LEFT)
-        self._label = None
-        if text:
-            self._label = _labeled(self._frame, text, "body",
-                                   bg=parent.cget("bg"), fg=COLORS["text_secondary"])
-            self._label.pack(side=tk.LEFT, padx=(S(8), 0))
-        self._draw()
-        self.bind("<Button-1>", self._toggle)
-
-    @property
-    def frame(self):
-        return self._frame
-
-    def _draw(self):
-        self.delete("all")
-        on = self._var.get()
-        w, h = self._tw, self._th
-        r = h // 2
-        # GREEN when on, visible GRAY when off
-        track = COLORS["toggle_on"] if on else COLORS["toggle_off"]
-        self._pill(1, 1, w-1, h-1, r, fill=track, outline="")
-        # White knob
-        knob_d = int(h * 0.7)
-        margin = (h - knob_d) // 2
-        kx = w - margin - knob_d if on else margin
-        self.create_oval(kx, margin, kx+knob_d, margin+knob_d,
-                        fill=COLORS["toggle_knob"], outline="")
-
-    def _pill(self, x1, y1, x2, y2, r, **kw):
-        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
-               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
-               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
-        return self.create_polygon(pts, smooth=True, **kw)
-
-    def _toggle(self, e=None):
-        self._var.set(not self._var.get()); self._draw(); self.config(cursor="hand2")
-
-    def get(self):
-        return self._var.get()
-
-    def rescale(self):
-        self._tw, self._th = S(44), S(24)
-        self.config(width=self._tw, height=self._th); self._draw()
-        if self._label: self._label.config(font=F("body"))
-
-
-
-
-
-# =====================================================================
-#  SOIL DEPTH CONFIGS
-# =====================================================================
-SOIL_TEMP_DEPTHS = {
-    "1cm": 5, "5cm": 6, "10cm": 7, "20cm": 8, "30cm": 9, "40cm": 10,
-    "50cm": 11, "60cm": 12, "70cm": 13, "80cm": 14, "90cm": 15, "100cm": 16,
-    "110cm": 17, "120cm": 18, "130cm": 19, "140cm": 20, "150cm": 21,
-    "160cm": 22, "170cm": 23, "180cm": 24, "190cm": 25, "200cm": 26
-}
-
-SOIL_MOISTURE_DEPTHS = {
-    "1cm": 27, "5cm": 28, "10cm": 29, "20cm": 30, "30cm": 31, "40cm": 32,
-    "50cm": 33, "60cm": 34, "70cm": 35, "80cm": 36, "90cm": 37, "100cm": 38,
-    "110cm": 39, "120cm": 40, "130cm": 41, "140cm": 42, "150cm": 43,
-    "160cm": 44, "170cm": 45, "180cm": 46, "190cm": 47, "200cm": 48
-}
-
-ROOT_FOLDER = r"C:\DNDC"
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-
-# =====================================================================
-#  DYNAMIC PATH BUILDER
-# =====================================================================
-def get_output_paths(root_folder, site_name):
-    output_dir = os.path.join(root_folder, "output_files")
-    return {
-        "output_dir": output_dir,
-        "batch_record_root": os.path.join(output_dir, "Record", "Batch"),
-        "results_dir": os.path.join(root_folder, "calibration_results", site_name),
-    }
-
-def detect_dndc_output_folder(batch_record_root):
-    """After DNDC runs, find the most recently modified subfolder in Record/Batch/."""
-    if not os.path.exists(batch_record_root):
-        return None
-    subfolders = [
-        os.path.join(batch_record_root, d)
-        for d in os.listdir(batch_record_root)
-        if os.path.isdir(os.path.join(batch_record_root, d))
-    ]
-    if not subfolders:
-        return None
-    # Return the most recently modified
-    return max(subfolders, key=os.path.getmtime)
-
-def get_modeled_paths(dndc_record_dir):
-    """Build CSV paths from the detected DNDC output folder."""
-    return {
-        "modeled_yield_csv": os.path.join(dndc_record_dir, "Multi_year_summary.csv"),
-        "modeled_soil_climate_csv": os.path.join(dndc_record_dir, "Day_SoilClimate_1.csv"),
-        "modeled_climate_csv": os.path.join(dndc_record_dir, "Day_Climate_1.csv"),
-        "modeled_nee_csv": os.path.join(dndc_record_dir, "Day_SoilC_1.csv"),
-        "modeled_n2o_csv": os.path.join(dndc_record_dir, "Day_SoilN_1.csv"),
-    }
-
-def auto_detect_site_name(batch_file_path):
-    try:
-        if not os.path.exists(batch_file_path):
-            return ""
-        with open(batch_file_path, 'r') as f:
-            content = f.read()
-        for line in content.strip().split('\n'):
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            if line.endswith('.dnd') or '-stc' in line:
-                name = os.path.splitext(os.path.basename(line))[0]
-                if name:
-                    return name
-        import re
-        match = re.search(r'(\S+\.dnd)', content)
-        if match:
-            return os.path.splitext(os.path.basename(match.group(1)))[0]
-    except Exception:
-        pass
-    return ""
-
-
-# =====================================================================
-#  UTILITY FUNCTIONS
-# =====================================================================
-def show_error(message):
-    def _show():
-        messagebox.showerror("Error", message)
-    if threading.current_thread() is threading.main_thread():
-        _show()
-    else:
-        root.after(0, _show)
-
-def log_message(message):
-    def _log():
-        try:
-            log_display.insert(tk.END, message + "\n")
-            log_display.see(tk.END)
-        except Exception:
-            pass
-    if threading.current_thread() is threading.main_thread():
-        _log()
-    else:
-        root.after(0, _log)
-
-def check_file_exists(file_path):
-    if not os.path.exists(file_path):
-        log_message(f"✗ File not found: {file_path}")
-        return False
-    if not os.access(file_path, os.R_OK):
-        log_message(f"✗ File not readable: {file_path}")
-        return False
-    return True
-
-def read_dnd_file(dnd_path):
-    try:
-        with open(dnd_path, 'r') as file:
-            return file.readlines()
-    except Exception as e:
-        log_message(f"✗ Failed to read .dnd file: {e}")
-        return []
-
-def write_dnd_file(dnd_path, lines):
-    try:
-        with open(dnd_path, 'w') as file:
-            file.writelines(lines)
-    except Exception as e:
-        log_message(f"✗ Failed to write .dnd file: {e}")
-
-def read_param_ranges(param_csv):
-    try:
-        df = pd.read_csv(param_csv)
-        required_cols = ["parameter_name", "min", "max", "line_number"]
-        missing = [c for c in required_cols if c not in df.columns]
-        if missing:
-            raise ValueError(f"Missing columns: {missing}")
-        for _, row in df.iterrows():
-            if row['min'] >= row['max']:
-                raise ValueError(f"'{row['parameter_name']}': min >= max")
-            if row['line_number'] < 0:
-                raise ValueError(f"'{row['parameter_name']}': line_number < 1")
-        return df
-    except Exception as e:
-        log_message(f"✗ Parameter CSV error: {e}")
-        return pd.DataFrame()
-
-def update_parameters(lines, param_values, param_ranges_df):
-    """Update .dnd lines with new parameter values.
-    param_values: list of values (same order as param_ranges_df rows)."""
-    updated_lines = copy.deepcopy(lines)
-    for i, (_, row) in enumerate(param_ranges_df.iterrows()):
-        if i >= len(param_values):
-            break
-        value = param_values[i]
-        line_idx = int(row["line_number"])
-        if 0 <= line_idx < len(updated_lines):
-            parts = updated_lines[line_idx].strip().split()
-            if len(parts) >= 2:
-                parts[1] = f"{value:.6f}"
-                updated_lines[line_idx] = ' '.join(parts) + '\n'
-        else:
-            log_message(f"⚠ Line {line_idx + 1} out of range for '{row['parameter_name']}'")
-    return updated_lines
-    return updated_lines
-
-def run_dndc(output_dir, root_folder, batch_file):
-    dndc_exe = os.path.join(root_folder, "DNDC95.exe")
-    if not os.path.exists(dndc_exe):
-        raise FileNotFoundError(f"DNDC executable not found: {dndc_exe}")
-    try:
-        result = subprocess.run([
-            dndc_exe, "-root", root_folder, "-output", output_dir,
-            "-s", batch_file, "-daily", "1"
-        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-           text=True, timeout=600)
-        log_message("  ✓ DNDC run completed")
-    except subprocess.TimeoutExpired:
-        log_message("✗ DNDC timed out (600s)")
-        raise
-    except subprocess.CalledProcessError as e:
-        log_message(f"✗ DNDC failed: {e.stderr}")
-        raise
-
-
-# =====================================================================
-#  DATA READING FUNCTIONS
-# =====================================================================
-def read_yield_data(modeled_path, observed_path):
-    try:
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        modeled_df = pd.read_csv(modeled_path, skiprows=5, usecols=[0, 2], names=['Year', 'Yield'], header=None)
-        modeled_df.columns = ['Year', 'Yield_MOD']
-        observed_df = pd.read_csv(observed_path, skiprows=2, usecols=[0, 1], names=['Year', 'Yield'], header=None)
-        observed_df.columns = ['Year', 'Yield_OBS']
-        return modeled_df, observed_df
-    except Exception as e:
-        log_message(f"✗ Yield read error: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-def read_soil_temp_data(modeled_path, observed_path, depth):
-    try:
-        if isinstance(depth, (int, float)):
-            depth = next((k for k, v in SOIL_TEMP_DEPTHS.items() if v == int(depth)), None)
-            if depth is None:
-                raise ValueError(f"Invalid depth: {depth}")
-        if depth not in SOIL_TEMP_DEPTHS:
-            raise ValueError(f"Invalid depth '{depth}'")
-        col_idx = SOIL_TEMP_DEPTHS[depth]
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        modeled_df = pd.read_csv(modeled_path, skiprows=4, header=0)
-        if col_idx >= len(modeled_df.columns):
-            raise IndexError(f"Column {col_idx} out of range")
-        modeled_df = modeled_df.iloc[:, [0, 1, col_idx]]
-        modeled_df.columns = ['Year', 'Day', 'SoilTemp_MOD']
-        observed_df = pd.read_csv(observed_path, skiprows=2, header=None,
-                                  usecols=[0, 1, 2], names=['Year', 'Day', 'SoilTemp_OBS'])
-        return modeled_df.dropna(), observed_df.dropna()
-    except Exception as e:
-        log_message(f"✗ SoilTemp read error at {depth}: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-def read_soil_moisture_data(modeled_path, observed_path, depth):
-    try:
-        if isinstance(depth, (int, float)):
-            depth = next(
-                (k for k, v in SOIL_MOISTURE_DEPTHS.items() if v == int(depth) or int(depth) == int(k.replace("cm", ""))),
-                None)
-            if depth is None:
-                return pd.DataFrame(), pd.DataFrame()
-        if depth not in SOIL_MOISTURE_DEPTHS:
-            return pd.DataFrame(), pd.DataFrame()
-        col_idx = SOIL_MOISTURE_DEPTHS[depth]
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        modeled_df = pd.read_csv(modeled_path, skiprows=4, header=0)
-        if col_idx >= len(modeled_df.columns):
-            raise IndexError(f"Column {col_idx} out of range")
-        modeled_df = modeled_df.iloc[:, [0, 1, col_idx]]
-        modeled_df.columns = ['Year', 'Day', 'SoilMoisture_MOD']
-        observed_df = pd.read_csv(observed_path, skiprows=2, header=None,
-                                  usecols=[0, 1, 2], names=['Year', 'Day', 'SoilMoisture_OBS'])
-        for df in [modeled_df, observed_df]:
-            df['Year'] = pd.to_numeric(df['Year'], errors='coerce').fillna(0).astype(int)
-            df['Day'] = pd.to_numeric(df['Day'], errors='coerce').fillna(0).astype(int)
-            df.iloc[:, 2] = pd.to_numeric(df.iloc[:, 2], errors='coerce')
-        return modeled_df.dropna(), observed_df.dropna()
-    except Exception as e:
-        log_message(f"✗ SoilMoisture read error at {depth}: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-def read_et_data(modeled_path, observed_path):
-    try:
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        modeled_df = pd.read_csv(modeled_path, skiprows=[0], header=1)
-        modeled_df = modeled_df.iloc[:, [0, 1, 9]]
-        modeled_df.columns = ['Year', 'Day', 'ET_MOD']
-        modeled_df['Year'] = modeled_df['Year'].astype(int)
-        modeled_df['Day'] = modeled_df['Day'].astype(int)
-        modeled_df['ET_MOD'] = pd.to_numeric(modeled_df['ET_MOD'], errors='coerce')
-        observed_df = pd.read_csv(observed_path, skiprows=2, header=None,
-                                  usecols=[0, 1, 2], names=['Year', 'Day', 'ET_OBS'])
-        observed_df['Year'] = observed_df['Year'].astype(int)
-        observed_df['Day'] = observed_df['Day'].astype(int)
-        observed_df['ET_OBS'] = pd.to_numeric(observed_df['ET_OBS'], errors='coerce')
-        return modeled_df.dropna(), observed_df.dropna()
-    except Exception as e:
-        log_message(f"✗ ET read error: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-def read_nee_data(modeled_path, observed_path):
-    try:
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        modeled_df = pd.read_csv(modeled_path, skiprows=1)
-        modeled_df = modeled_df.iloc[:, [0, 1, 42]]
-        modeled_df.columns = ['Year', 'Day', 'NEE_MOD']
-        modeled_df['Year'] = modeled_df['Year'].astype(int)
-        modeled_df['Day'] = modeled_df['Day'].astype(int)
-        modeled_df['NEE_MOD'] = pd.to_numeric(modeled_df['NEE_MOD'], errors='coerce')
-        observed_df = pd.read_csv(observed_path, skiprows=2, usecols=[0, 1, 2],
-                                  names=['Year', 'Day', 'NEE'], header=None)
-        observed_df.columns = ['Year', 'Day', 'NEE_OBS']
-        observed_df['Year'] = observed_df['Year'].astype(int)
-        observed_df['Day'] = observed_df['Day'].astype(int)
-        observed_df['NEE_OBS'] = pd.to_numeric(observed_df['NEE_OBS'], errors='coerce')
-        return modeled_df, observed_df
-    except Exception as e:
-        log_message(f"✗ NEE read error: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-
-def read_n2o_data(modeled_path, observed_path):
-    try:
-        if not check_file_exists(modeled_path) or not check_file_exists(observed_path):
-            return pd.DataFrame(), pd.DataFrame()
-        # Day_SoilN_1.csv: rows 1-2 junk, row 3 header, rows 4-5 units, data from row 6
-        modeled_df = pd.read_csv(modeled_path, header=2, skiprows=[3, 4])
-        modeled_df = modeled_df.iloc[:, [0, 1, 35]]  # Year, Day, column AJ (index 35)
-        modeled_df.columns = ['Year', 'Day', 'N2O_MOD']
-        modeled_df['Year'] = modeled_df['Year'].astype(int)
-        modeled_df['Day'] = modeled_df['Day'].astype(int)
-        modeled_df['N2O_MOD'] = pd.to_numeric(modeled_df['N2O_MOD'], errors='coerce')
-        # Observed: same format as NEE (2 header rows, then Year,Day,Value)
-        observed_df = pd.read_csv(observed_path, skiprows=2, usecols=[0, 1, 2],
-                                  names=['Year', 'Day', 'N2O'], header=None)
-        observed_df.columns = ['Year', 'Day', 'N2O_OBS']
-        observed_df['Year'] = observed_df['Year'].astype(int)
-        observed_df['Day'] = observed_df['Day'].astype(int)
-        observed_df['N2O_OBS'] = pd.to_numeric(observed_df['N2O_OBS'], errors='coerce')
-        return modeled_df, observed_df
-    except Exception as e:
-        log_message(f"✗ N2O read error: {e}")
-        return pd.DataFrame(), pd.DataFrame()
-
-
-# =====================================================================
-#  METRICS
-# =====================================================================
-def calculate_metrics(y_true, y_pred):
-    r2 = r2_score(y_true, y_pred)
-    rmse = np.sqrt(mean_squared_error(y_true, y_pred))
-    mae = mean_absolute_error(y_true, y_pred)
-    mbe = np.mean(y_pred - y_true)
-    mean_obs = np.mean(y_true)
-    nrmse = (rmse / mean_obs * 100) if mean_obs != 0 else np.nan
-    try:
-        X = np.array(y_pred).reshape(-1, 1)
-        model = LinearRegression()
-        model.fit(X, y_true)
-        lr_r2 = model.score(X, y_true)
-    except Exception:
-        lr_r2 = np.nan
-    return {'R2': r2, 'LR_R2': lr_r2, 'RMSE': rmse, 'nRMSE': nrmse, 'MAE': mae, 'MBE': mbe}
-
-def match_and_evaluate(modeled_df, observed_df, target_var, yield_conversion_factor=0.4):
-    if modeled_df.empty or observed_df.empty:
-        return None, pd.DataFrame()
-    for col in ['Year', 'Day']:
-        if col in modeled_df.columns:
-            modeled_df[col] = modeled_df[col].astype(int)
-        if col in observed_df.columns:
-            observed_df[col] = observed_df[col].astype(int)
-    if target_var == "Yield":
-        if 'Yield_MOD' in modeled_df.columns and yield_conversion_factor > 0:
-            modeled_df['Yield_MOD'] = modeled_df['Yield_MOD'] / yield_conversion_factor
-        merge_on = ['Year']
-    else:
-        merge_on = ['Year', 'Day']
-    merged_df = pd.merge(modeled_df, observed_df, on=merge_on, how='inner')
-    if merged_df.empty:
-        return None, pd.DataFrame()
-    observed_col = f"{target_var}_OBS"
-    merged_df.dropna(subset=[observed_col], inplace=True)
-    if merged_df.empty:
-        return None, pd.DataFrame()
-    metrics = calculate_metrics(merged_df[observed_col], merged_df[f"{target_var}_MOD"])
-    return metrics, merged_df
-
-
-# =====================================================================
-#  CHECKPOINT SAVING
-# =====================================================================
-def save_iteration_outputs(results_dir, iteration, dndc_record_dir):
-    """Copy the entire DNDC output folder for this iteration."""
-    iter_dir = os.path.join(results_dir, "iteration_outputs", f"iter_{iteration:04d}")
-    try:
-        if os.path.exists(dndc_record_dir):
-            shutil.copytree(dndc_record_dir, iter_dir, dirs_exist_ok=True)
-    except Exception as e:
-        log_message(f"⚠ Failed to save iteration {iteration} outputs: {e}")
-
-
-# =====================================================================
-#  OPTIMIZATION CORE
-# =====================================================================
-def objective_function(params, param_ranges_df, lines, target_var, depth, paths, batch_file, dnd_file, observed_csv):
-    updated_lines = update_parameters(lines, params, param_ranges_df)
-    write_dnd_file(dnd_file, updated_lines)
-    root_folder = root_folder_entry.get().strip()
-    run_dndc(paths["output_dir"], root_folder, batch_file)
-
-    # Detect where DNDC actually wrote its output
-    dndc_dir = detect_dndc_output_folder(paths["batch_record_root"])
-    if not dndc_dir:
-        log_message("✗ Could not find DNDC output folder")
-        return np.inf
-    mp = get_modeled_paths(dndc_dir)
-
-    reader_map = {
-        "Yield":        lambda: read_yield_data(mp["modeled_yield_csv"], observed_csv),
-        "SoilTemp":     lambda: read_soil_temp_data(mp["modeled_soil_climate_csv"], observed_csv, depth),
-        "SoilMoisture": lambda: read_soil_moisture_data(mp["modeled_soil_climate_csv"], observed_csv, depth),
-        "ET":           lambda: read_et_data(mp["modeled_climate_csv"], observed_csv),
-        "NEE":          lambda: read_nee_data(mp["modeled_nee_csv"], observed_csv),
-        "N2O":          lambda: read_n2o_data(mp["modeled_n2o_csv"], observed_csv),
-    }
-
-    reader = reader_map.get(target_var)
-    if not reader:
-        return np.inf
-
-    modeled_df, observed_df = reader()
-    metrics, _ = match_and_evaluate(modeled_df, observed_df, target_var)
-    if metrics is None:
-        return np.inf
-
-    return metrics['RMSE']
-
-
-def bayesian_optimization(param_ranges, param_ranges_df, lines, target_var, depth,
-                          paths, batch_file, dnd_file, observed_csv,
-                          save_dnd_backups, save_iter_results):
-
-    log_message(f"\n{'━'*50}")
-    log_message(f"  Bayesian Optimization: {target_var}{f' @ {depth}' if depth else ''}")
-    log_message(f"{'━'*50}")
-
-    all_results = []
-    best_rmse = np.inf
-    best_params = None
-    best_merged = None
-    best_metrics = None
-    best_iteration = 0
-    iteration_counter = 0
-
-    try:
-        total_iterations = int(iterations_entry.get())
-    except ValueError:
-        total_iterations = 10
-
-    results_dir = paths["results_dir"]
-    os.makedirs(results_dir, exist_ok=True)
-
-    dnd_backup_dir = os.path.join(results_dir, "dnd_backups")
-    if save_dnd_backups:
-        os.makedirs(dnd_backup_dir, exist_ok=True)
-
-    def _read_after_run(observed_csv):
-        """Detect DNDC output folder and build reader for current target."""
-        dndc_dir = detect_dndc_output_folder(paths["batch_record_root"])
-        if not dndc_dir:
-            log_message("✗ Could not find DNDC output folder")
-            return None, None, None
-        mp = get_modeled_paths(dndc_dir)
-        reader_map = {
-            "Yield":        lambda: read_yield_data(mp["modeled_yield_csv"], observed_csv),
-            "SoilTemp":     lambda: read_soil_temp_data(mp["modeled_soil_climate_csv"], observed_csv, depth),
-            "SoilMoisture": lambda: read_soil_moisture_data(mp["modeled_soil_climate_csv"], observed_csv, depth),
-            "ET":           lambda: read_et_data(mp["modeled_climate_csv"], observed_csv),
-            "NEE":          lambda: read_nee_data(mp["modeled_nee_csv"], observed_csv),
-            "N2O":          lambda: read_n2o_data(mp["modeled_n2o_csv"], observed_csv),
-        }
-        reader = reader_map.get(target_var)
-        if not reader:
-            return None, None, dndc_dir
-        modeled_df, observed_df = reader()
-        return modeled_df, observed_df, dndc_dir
-
-    # ── Baseline run (iteration 0): original .dnd, no modifications ──
-    log_message(f"\n  ⓪ Baseline: running with original parameters...")
-    write_dnd_file(dnd_file, lines)
-    root_folder = root_folder_entry.get().strip()
-    run_dndc(paths["output_dir"], root_folder, batch_file)
-
-    modeled_df, observed_df, dndc_dir = _read_after_run(observed_csv)
-    if modeled_df is not None and not modeled_df.empty:
-        baseline_metrics, baseline_merged = match_and_evaluate(modeled_df, observed_df, target_var)
-        if baseline_metrics:
-            # Extract actual parameter values from original .dnd
-            original_params = []
-            for _, row in param_ranges_df.iterrows():
-                line_idx = int(row['line_number'])
-                try:
-                    parts = lines[line_idx].strip().split()
-                    original_params.append(float(parts[1]) if len(parts) >= 2 else 0.0)
-                except (IndexError, ValueError):
-                    original_params.append(0.0)
-            all_results.append({
-                "Iteration": 0, "Parameters": original_params,
-                "Metrics": baseline_metrics, "Merged_Data": baseline_merged
-            })
-            best_rmse = baseline_metrics['RMSE']
-            best_params = original_params
-            best_merged = baseline_merged
-            best_metrics = baseline_metrics
-            best_iteration = 0
-            log_message(f"    R²={baseline_metrics['R2']:.4f}  RMSE={baseline_metrics['RMSE']:.2f}  "
-                       f"nRMSE={baseline_metrics['nRMSE']:.1f}%")
-            if save_dnd_backups:
-                try: shutil.copy(dnd_file, os.path.join(dnd_backup_dir, "iter_0000_baseline.dnd"))
-                except: pass
-            if save_iter_results and dndc_dir:
-                save_iteration_outputs(results_dir, 0, dndc_dir)
-        else:
-            log_message("    ⚠ Baseline produced no valid metrics")
-    else:
-        log_message("    ⚠ Baseline: no modeled data found")
-
-    def callback(res):
-        nonlocal best_rmse, best_params, best_merged, best_metrics, best_iteration, iteration_counter
-        iteration_counter += 1
-
-        global stop_calibration_flag
-        if stop_calibration_flag:
-            raise StopIteration("Stopped by user.")
-
-        try:
-            current_rmse = res.func_vals[-1]
-            params = res.x_iters[-1]
-
-            modeled_df, observed_df, dndc_dir = _read_after_run(observed_csv)
-            if modeled_df is None or modeled_df.empty:
-                return
-
-            yield_metrics, merged_df = match_and_evaluate(modeled_df, observed_df, target_var)
-            if yield_metrics is None:
-                return
-
-            all_results.append({
-                "Iteration": iteration_counter, "Parameters": params,
-                "Metrics": yield_metrics, "Merged_Data": merged_df
-            })
-
-            is_new_best = current_rmse < best_rmse
-            if is_new_best:
-                best_rmse = current_rmse
-                best_params = params
-                best_merged = merged_df
-                best_metrics = yield_metrics
-                best_iteration = iteration_counter
-
-            marker = "★" if is_new_best else "·"
-            log_message(f"\n  {marker} Iteration {iteration_counter}/{total_iterations}")
-            log_message(f"    R²={yield_metrics['R2']:.4f}  RMSE={yield_metrics['RMSE']:.2f}  "
-                       f"nRMSE={yield_metrics['nRMSE']:.1f}%  MAE={yield_metrics['MAE']:.2f}")
-
-            pct = (iteration_counter / total_iterations) * 100
-            root.after(0, lambda p=pct: progress_bar.set_value(p))
-            root.after(0, lambda p=pct: progress_label.config(text=f"{p:.0f}%"))
-
-            if save_dnd_backups:
-                try: shutil.copy(dnd_file, os.path.join(dnd_backup_dir, f"iter_{iteration_counter:04d}.dnd"))
-                except: pass
-
-            if save_iter_results and dndc_dir:
-                save_iteration_outputs(results_dir, iteration_counter, dndc_dir)
-
-        except StopIteration:
-            raise
-        except Exception as e:
-            log_message(f"  ✗ Iteration {iteration_counter} error: {e}")
-
-    try:
-        gp_minimize(
-            lambda p: objective_function(p, param_ranges_df, lines, target_var, depth,
-                                         paths, batch_file, dnd_file, observed_csv),
-            param_ranges,
-            n_calls=total_iterations,
-            callback=callback,
-            random_state=42,
-            n_jobs=1
-        )
-        log_message("\n  ✓ Optimization complete.")
-    except StopIteration:
-        log_message("\n  ⏹ Stopped by user. Saving results...")
-
-    return all_results, best_params, best_merged, best_metrics, best_iteration
-
-
-# =====================================================================
-#  RESULTS SAVING
-# =====================================================================
-def save_results(all_results, best_params, best_metrics, best_merged, best_iteration,
-                 param_ranges_df, target_var, depth, results_dir):
-    if not all_results:
-        log_message("No results to save.")
-        return
-
-    os.makedirs(results_dir, exist_ok=True)
-
-    if target_var in ["SoilTemp", "SoilMoisture"] and depth:
-        output_file = os.path.join(results_dir, f"{target_var.lower()}_{depth}_results.xlsx")
-    else:
-        output_file = os.path.join(results_dir, f"{target_var.lower()}_calibration_results.xlsx")
-
-    wb = Workbook()
-
-    # All Iterations
-    ws1 = wb.active
-    ws1.title = "All Iterations"
-    headers = ["Iteration"] + param_ranges_df['parameter_name'].tolist() + \
-              ["R2", "LR_R2", "RMSE", "nRMSE(%)", "MAE", "MBE"]
-    ws1.append(headers)
-
-    best_fill = PatternFill(start_color='90EE90', end_color='90EE90', fill_type='solid')
-    for result in all_results:
-        row = [result["Iteration"]] + list(result["Parameters"]) + [
-            result["Metrics"]["R2"], result["Metrics"]["LR_R2"],
-            result["Metrics"]["RMSE"], result["Metrics"]["nRMSE"],
-            result["Metrics"]["MAE"], result["Metrics"]["MBE"]
-        ]
-        ws1.append(row)
-        if result["Iteration"] == best_iteration:
-            for cell in ws1[ws1.max_row]:
-                cell.fill = best_fill
-
-    # Best Iteration
-    ws2 = wb.create_sheet("Best Iteration")
-    ws2.append(["Best Iter #"] + param_ranges_df['parameter_name'].tolist() +
-               ["R2", "LR_R2", "RMSE", "nRMSE(%)", "MAE", "MBE"])
-    if best_params and best_metrics:
-        ws2.append([best_iteration, *best_params,
-                    best_metrics['R2'], best_metrics['LR_R2'],
-                    best_metrics['RMSE'], best_metrics['nRMSE'],
-                    best_metrics['MAE'], best_metrics['MBE']])
-
-    # Data Comparison
-    ws3 = wb.create_sheet("Data Comparison")
-    if best_merged is not None and not best_merged.empty:
-        has_day = 'Day' in best_merged.columns
-        if has_day:
-            ws3.append(["Year", "Day", "Observed", "Modeled"])
-            for _, r in best_merged.iterrows():
-                ws3.append([r['Year'], r['Day'], r[f"{target_var}_OBS"], r[f"{target_var}_MOD"]])
-        else:
-            ws3.append(["Year", "Observed", "Modeled"])
-            for _, r in best_merged.iterrows():
-                ws3.append([r['Year'], r[f"{target_var}_OBS"], r[f"{target_var}_MOD"]])
-
-        ChartClass = LineChart if has_day else BarChart
-        chart = ChartClass()
-        chart.title = f"{target_var}{f' @ {depth}' if depth else ''} — Best Calibration"
-        chart.style = 2
-        chart.width = 28
-        chart.height = 14
-        data_col_start = 3 if has_day else 2
-        data = Reference(ws3, min_col=data_col_start, max_col=data_col_start + 1,
-                         min_row=1, max_row=len(best_merged) + 1)
-        cats = Reference(ws3, min_col=1, min_row=2, max_row=len(best_merged) + 1)
-        chart.add_data(data, titles_from_data=True)
-        chart.set_categories(cats)
-        if len(chart.series) >= 2:
-            chart.series[0].graphicalProperties.solidFill = "4DC4E3"
-            chart.series[1].graphicalProperties.solidFill = "FF6F61"
-        # Legend outside plot area — bottom, no overlap
-        from openpyxl.chart.layout import Layout, ManualLayout
-        from openpyxl.chart.legend import Legend
-        chart.legend = Legend()
-        chart.legend.position = 'b'
-        ws3.add_chart(chart, "F2")
-
-    # Iteration Data — modeled values from each iteration side by side
-    ws4 = wb.create_sheet("Iteration Data")
-    if all_results:
-        # Determine structure from first result's Merged_Data
-        sample_merged = all_results[0].get("Merged_Data")
-        if sample_merged is not None and not sample_merged.empty:
-            has_day = 'Day' in sample_merged.columns
-            mod_col = f"{target_var}_MOD"
-
-            # Header row
-            if has_day:
-                header = ["Year", "Day"] + [f"Iteration {r['Iteration']}" for r in all_results]
-            else:
-                header = ["Year"] + [f"Iteration {r['Iteration']}" for r in all_results]
-            ws4.append(header)
-
-            # Build a dict of iteration data keyed by (Year,) or (Year, Day)
-            # Use the merged data from each iteration
-            all_keys = []
-            iter_data = {}
-            for result in all_results:
-                md = result.get("Merged_Data")
-                if md is None or md.empty:
-                    continue
-                it = result["Iteration"]
-                iter_data[it] = {}
-                for _, row in md.iterrows():
-                    if has_day:
-                        key = (int(row['Year']), int(row['Day']))
-                    else:
-                        key = (int(row['Year']),)
-                    if key not in all_keys:
-                        all_keys.append(key)
-                    iter_data[it][key] = row[mod_col]
-
-            # Sort keys
-            all_keys.sort()
-
-            # Write rows
-            for key in all_keys:
-                if has_day:
-                    row = [key[0], key[1]]
-                else:
-                    row = [key[0]]
-                for result in all_results:
-                    it = result["Iteration"]
-                    row.append(iter_data.get(it, {}).get(key, ""))
-                ws4.append(row)
-
-    # Save with graceful handling if file is locked/open
-    for attempt in range(10):
-        try:
-            wb.save(output_file)
-            log_message(f"  ✓ Results saved: {output_file}")
-            break
-        except PermissionError:
-            if attempt == 0:
-                log_message(f"  ⚠ Cannot write to {os.path.basename(output_file)} — file may be open in Excel.")
-            # Try incremented filename
-            base, ext = os.path.splitext(output_file)
-            # Strip any existing _N suffix before adding new one
-            import re
-            base_clean = re.sub(r'_\d+$', '', base)
-            output_file = f"{base_clean}_{attempt + 1}{ext}"
-            if attempt == 9:
-                log_message(f"  ✗ Could not save results after 10 attempts. Close Excel and re-run.")
-            else:
-                continue
-
-
-# =====================================================================
-#  CALIBRATION WORKFLOW
-# =====================================================================
-def start_calibration():
-    global calibration_thread, stop_calibration_flag
-    stop_calibration_flag = False
-
-    if calibration_thread and calibration_thread.is_alive():
-        log_message("⚠ A calibration is already running.")
-        return
-
-    rf = root_folder_entry.get().strip()
-    bf = batch_file_entry.get().strip()
-    df = dnd_file_entry.get().strip()
-    oc = observed_csv_entry.get().strip()
-    pc = param_csv_entry.get().strip()
-    sn = site_name_entry.get().strip()
-
-    if not all([rf, bf, df, oc, pc]):
-        log_message("✗ Please fill all required fields.")
-        return
-
-    if not sn:
-        sn = auto_detect_site_name(bf)
-        site_name_entry.delete(0, tk.END)
-        site_name_entry.insert(0, sn)
-        log_message(f"  Auto-detected site: {sn}")
-
-    try:
-        n_iter = int(iterations_entry.get())
-        if n_iter < 1:
-            raise ValueError
-    except ValueError:
-        log_message("✗ Iterations must be a positive integer.")
-        return
-
-    for path, label in [(bf, "Batch"), (df, ".dnd"), (oc, "Observed CSV"), (pc, "Param CSV")]:
-        if not os.path.exists(path):
-            log_message(f"✗ {label} not found: {path}")
-            return
-
-    if not os.path.exists(os.path.join(rf, "DNDC95.exe")):
-        log_message(f"✗ DNDC95.exe not found in: {rf}")
-        return
-
-    target_var = target_var_combo.get()
-    depth = depth_combo.get() if target_var in ["SoilTemp", "SoilMoisture"] else None
-    if target_var in ["SoilTemp", "SoilMoisture"] and not depth:
-        log_message(f"✗ Select a depth for {target_var}.")
-        return
-
-    save_dnd = save_dnd_toggle.get()
-    save_iter = save_checkpoint_toggle.get()
-
-    log_message(f"\n{'═'*50}")
-    log_message(f"  CALIBRATION START")
-    log_message(f"  Target: {target_var}{f' @ {depth}' if depth else ''}")
-    log_message(f"  Site: {sn}  |  Iterations: {n_iter}")
-    log_message(f"  DND backups: {'on' if save_dnd else 'off'}  |  Save iteration results: {'on' if save_iter else 'off'}")
-    log_message(f"{'═'*50}")
-
-    progress_bar.set_value(0)
-    progress_label.config(text="0%")
-
-    calibration_thread = threading.Thread(
-        target=calibrate_variable,
-        args=(target_var, depth, rf, sn, bf, df, oc, pc, save_dnd, save_iter),
-        daemon=True
-    )
-    calibration_thread.start()
-
-
-def calibrate_variable(target_var, depth, root_folder, site_name,
-                       batch_file, dnd_file, observed_csv, param_csv,
-                       save_dnd_backups, save_iter_results):
-    global stop_calibration_flag
-    stop_calibration_flag = False
-
-    paths = get_output_paths(root_folder, site_name)
-    os.makedirs(paths["results_dir"], exist_ok=True)
-
-    backup_path = dnd_file + ".backup"
-    shutil.copy(dnd_file, backup_path)
-    log_message(f"  ✓ .dnd backed up")
-
-    try:
-        lines = read_dnd_file(dnd_file)
-        if not lines:
-            log_message("✗ .dnd file empty or unreadable.")
-            return
-
-        param_ranges_df = read_param_ranges(param_csv)
-        if param_ranges_df.empty:
-            log_message("✗ Parameter CSV invalid.")
-            return
-
-        param_ranges = [(row['min'], row['max']) for _, row in param_ranges_df.iterrows()]
-
-        results = bayesian_optimization(
-            param_ranges, param_ranges_df, lines, target_var, depth,
-            paths, batch_file, dnd_file, observed_csv,
-            save_dnd_backups, save_iter_results
-        )
-
-        all_results, best_params, best_merged, best_metrics, best_iter = results
-
-        if best_params and best_metrics:
-            save_results(all_results, best_params, best_metrics, best_merged, best_iter,
-                        param_ranges_df, target_var, depth, paths["results_dir"])
-            log_message(f"\n  ✓ Best: Iteration #{best_iter}  RMSE={best_metrics['RMSE']:.4f}")
-        else:
-            log_message("⚠ No valid results found.")
-
-    except Exception as e:
-        log_message(f"✗ Calibration error: {e}")
-        show_error(str(e))
-    finally:
-        shutil.copy(backup_path, dnd_file)
-        log_message("  ✓ .dnd restored from backup")
-
-
-def stop_calibration():
-    global stop_calibration_flag
-    if calibration_thread and calibration_thread.is_alive():
-        def _confirm():
-            global stop_calibration_flag
-            if messagebox.askyesno("Stop", "Stop calibration? Results saved up to current iteration."):
-                stop_calibration_flag = True
-                log_message("  ⏹ Stopping after current iteration...")
-        root.after(0, _confirm)
-    else:
-        log_message("No active calibration.")
-
-
-# =====================================================================
-#  UI EVENT HANDLERS
-# =====================================================================
-def on_target_var_change(event):
-    tv = target_var_combo.get()
-    if tv in ["SoilTemp", "SoilMoisture"]:
-        depth_label.pack(side=tk.LEFT, padx=(0, S(8)), after=target_var_combo)
-        depth_combo.pack(side=tk.LEFT, padx=(0, S(20)), after=depth_label)
-        depth_combo['values'] = list(SOIL_TEMP_DEPTHS.keys() if tv == "SoilTemp" else SOIL_MOISTURE_DEPTHS.keys())
-        depth_combo.current(0)
-    else:
-        depth_label.pack_forget()
-        depth_combo.pack_forget()
-
-def browse_file(entry_widget, file_type, title):
-    f = filedialog.askopenfilename(filetypes=[(f"{file_type[1:].upper()} files", file_type)], title=title)
-    if f:
-        if isinstance(entry_widget, ModernEntry):
-            entry_widget.delete(0, tk.END)
-            entry_widget.insert(0, f)
-        else:
-            entry_widget.delete(0, tk.END)
-            entry_widget.insert(0, f)
-
-def browse_directory(entry_widget, title):
-    d = filedialog.askdirectory(title=title)
-    if d:
-        if isinstance(entry_widget, ModernEntry):
-            entry_widget.delete(0, tk.END)
-            entry_widget.insert(0, d)
-        else:
-            entry_widget.delete(0, tk.END)
-            entry_widget.insert(0, d)
-
-def download_observed_template():
-    try:
-        save_dir = filedialog.askdirectory(title="Save Template To")
-        if not save_dir:
-            return
-        tv = target_var_combo.get()
-        if tv == "Yield":
-            t = "Description: Observed yield\nUnits: kgC/ha/y\nYear,Value\n1,5000\n2,5200\n3,5100\n"
-        else:
-            t = "Description: Observed daily data\nUnits: see variable\nYear,Day,Value\n1,1,5.0\n1,2,5.2\n"
-        fname = f"observed_{tv.lower()}_template.csv"
-        with open(os.path.join(save_dir, fname), "w") as f:
-            f.write(t)
-        log_message(f"  ✓ Template saved: {fname}")
-    except Exception as e:
-        log_message(f"✗ Template error: {e}")
-
-def download_param_template():
-    try:
-        save_dir = filedialog.askdirectory(title="Save Template To")
-        if not save_dir:
-            return
-        with open(os.path.join(save_dir, "parameter_template.csv"), "w") as f:
-            f.write("parameter_name,min,max,line_number\nparam1,0.1,1.0,10\nparam2,0.5,2.0,15\n")
-        log_message("  ✓ Param template saved")
-    except Exception as e:
-        log_message(f"✗ Template error: {e}")
-
-def open_results_directory():
-    try:
-        rf = root_folder_entry.get().strip()
-        sn = site_name_entry.get().strip()
-        if rf and sn:
-            d = os.path.join(rf, "calibration_results", sn)
-            if os.path.exists(d):
-                os.startfile(d)
-                return
-        if rf:
-            os.startfile(rf)
-    except Exception as e:
-        log_message(f"✗ Could not open results: {e}")
-
-def exit_application():
-    global calibration_thread, stop_calibration_flag
-    if calibration_thread and calibration_thread.is_alive():
-        if not messagebox.askyesno("Exit", "Calibration running. Exit anyway?"):
-            return
-        stop_calibration_flag = True
-        calibration_thread.join(timeout=10)
-    root.destroy()
-
-def is_already_running():
-    lock_path = os.path.join(ROOT_FOLDER, "dnccalibration.lock")
-    lock_file = None
-    try:
-        lock_file = open(lock_path, 'w')
-        portalocker.lock(lock_file, portalocker.LOCK_EX | portalocker.LOCK_NB)
-        return False
-    except (portalocker.exceptions.LockException, OSError):
-        if lock_file:
-            lock_file.close()
-        return True
-
-
-# ── Short aliases used by UI builder ──
-_browse_file = browse_file
-_browse_dir = browse_directory
-_dl_obs_template = download_observed_template
-_dl_param_template = download_param_template
-_open_results = open_results_directory
-_exit = exit_application
-
-
-# =====================================================================
-#  BUILD THE UI
-# =====================================================================
-
-def create_ui():
-    global root, log_display, batch_file_entry, dnd_file_entry, observed_csv_entry
-    global param_csv_entry, iterations_entry, progress_bar, progress_label
-    global target_var_combo, depth_combo, depth_label
-    global root_folder_entry, site_name_entry
-    global save_dnd_toggle, save_checkpoint_toggle
-
-    root = tk.Tk()
-    root.title("DNDC Calibration Studio")
-    root.geometry(f"{S(1100)}x{S(820)}")
-    root.minsize(S(800), S(600))
-    root.resizable(True, True)
-    root.config(bg=COLORS["bg_primary"])
-
-    # DPI awareness already set at module level
-    # Keyboard shortcuts
-    root.bind("<Control-plus>", lambda e: zoom_in())
-    root.bind("<Control-equal>", lambda e: zoom_in())
-    root.bind("<Control-minus>", lambda e: zoom_out())
-    root.bind("<Control-0>", lambda e: reset_zoom())
-    root.bind("<F1>", lambda e: start_calibration())
-    root.bind("<Escape>", lambda e: exit_application())
-    root.bind("<Control-t>", lambda e: toggle_theme())
-
-    # TTK style
-    sty = ttk.Style(); sty.theme_use('clam')
-    sty.configure("Modern.TCombobox",
-                  fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
-                  foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
-                  bordercolor=COLORS["border_input"], padding=(S(8), S(5)))
-    sty.map("Modern.TCombobox",
-            fieldbackground=[("readonly", COLORS["bg_input"])],
-            foreground=[("readonly", COLORS["text_primary"])])
-
-    # ── NO outer scroll — fixed layout, only log scrolls ──
-    main = tk.Frame(root, bg=COLORS["bg_primary"])
-    main.pack(fill=tk.BOTH, expand=True)
-
-    pad = S(28)
-
-    # ══════════ HEADER BAR ══════════
-    hbar = tk.Frame(main, bg=COLORS["bg_primary"])
-    hbar.pack(fill=tk.X, padx=pad, pady=(S(18), S(8)))
-
-    # Left: title
-    _labeled(hbar, "DNDC", "heading_xl",
-             bg=COLORS["bg_primary"], fg=COLORS["accent"]).pack(side=tk.LEFT)
-    _labeled(hbar, "  Calibration Studio", "heading_xl",
-             bg=COLORS["bg_primary"], fg=COLORS["text_primary"]).pack(side=tk.LEFT)
-
-    # Right side: theme toggle + zoom hint
-    right_bar = tk.Frame(hbar, bg=COLORS["bg_primary"])
-    right_bar.pack(side=tk.RIGHT)
-    _labeled(right_bar, "Ctrl +/-  Zoom", "body_sm",
-             bg=COLORS["bg_primary"], fg=COLORS["text_tertiary"]).pack(side=tk.RIGHT)
-    # Theme toggle button
-    theme_btn = ModernButton(right_bar, "◐ Theme", toggle_theme,
-                             style="ghost", width=100, height=30)
-    theme_btn.pack(side=tk.RIGHT, padx=(0, S(16))); _register(theme_btn)
-
-    # Divider
-    tk.Frame(main, bg=COLORS["border"], height=1).pack(fill=tk.X, padx=pad, pady=(S(4), S(10)))
-
-    # ══════════ PROJECT CONFIG ══════════
-    c1 = ModernCard(main, title="Project Configuration", icon="⚙")
-    c1.pack(fill=tk.X, padx=pad, pady=(0, S(8)))
-    g1 = tk.Frame(c1, bg=COLORS["bg_secondary"])
-    g1.pack(fill=tk.X, padx=S(20), pady=(S(2), S(14)))
-
-    # DNDC Root hardcoded — no UI row needed
-    class _RootStub:
-        def get(self): return ROOT_FOLDER
-        def strip(self): return ROOT_FOLDER
-    root_folder_entry = _RootStub()
-
-    _labeled(g1, "Site Name", "label",
-             bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(12)))
-    site_name_entry = ModernEntry(g1, width=25, placeholder="e.g. F14-2024WEST")
-    site_name_entry.pack(side=tk.LEFT)
-    _labeled(g1, "auto-detected from batch file if blank", "body_sm",
-             bg=COLORS["bg_secondary"], fg=COLORS["text_tertiary"]).pack(side=tk.LEFT, padx=(S(16), 0))
-
-    # ══════════ CALIBRATION SETTINGS ══════════
-    c2 = ModernCard(main, title="Calibration Settings", icon="◎")
-    c2.pack(fill=tk.X, padx=pad, pady=(0, S(8)))
-    g2 = tk.Frame(c2, bg=COLORS["bg_secondary"])
-    g2.pack(fill=tk.X, padx=S(20), pady=(S(2), S(14)))
-
-    # Row 0: Target + Depth only
-    r0 = tk.Frame(g2, bg=COLORS["bg_secondary"])
-    r0.pack(fill=tk.X, pady=(0, S(4)))
-
-    _labeled(r0, "Target", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
-    target_var_combo = ModernCombobox(r0, values=["Yield", "SoilTemp", "SoilMoisture", "ET", "NEE", "N2O"],
-                                     width=14, state="readonly", font=F("body"))
-    target_var_combo.pack(side=tk.LEFT, padx=(0, S(20)))
-    target_var_combo.current(0)
-    target_var_combo.bind("<<ComboboxSelected>>", on_target_var_change)
-
-    depth_label = _labeled(r0, "Depth", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"])
-    depth_label.pack(side=tk.LEFT, padx=(0, S(8)))
-    depth_combo = ModernCombobox(r0, width=8, state="readonly", font=F("body"))
-    depth_combo.pack(side=tk.LEFT, padx=(0, S(20)))
-    depth_label.pack_forget()
-    depth_combo.pack_forget()
-
-    # File rows: grid for alignment — NO weight=1 on entry col, use fixed width
-    file_grid = tk.Frame(g2, bg=COLORS["bg_secondary"])
-    file_grid.pack(fill=tk.X, pady=(0, S(4)))
-
-    file_defs = [
-        ("Batch File",    "*.txt", "Select Batch File",   None),
-        (".dnd File",     "*.dnd", "Select .dnd File",    None),
-        ("Observed CSV",  "*.csv", "Select Observed CSV",  "obs"),
-        ("Parameter CSV", "*.csv", "Select Parameter CSV", "param"),
-    ]
-
-    entries = []
-    for i, (label_text, ftype, title, tmpl) in enumerate(file_defs):
-        _labeled(file_grid, label_text, "label",
-                 bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).grid(
-            row=i, column=0, sticky="e", pady=S(3), padx=(0, S(10)))
-
-        e = ModernEntry(file_grid, width=55)
-        e.grid(row=i, column=1, pady=S(3), padx=(0, S(8)), sticky="w")
-        entries.append(e)
-
-        bb = ModernButton(file_grid, "Browse",
-                          lambda ew=e, ft=ftype, t=title: _browse_file(ew, ft, t),
-                          style="ghost", width=90, height=30)
-        bb.grid(row=i, column=2, pady=S(3), padx=(0, S(4))); _register(bb)
-
-        if tmpl == "obs":
-            tb = ModernButton(file_grid, "↓ Template", _dl_obs_template,
-                              style="outline", width=110, height=30)
-            tb.grid(row=i, column=3, pady=S(3)); _register(tb)
-        elif tmpl == "param":
-            tb = ModernButton(file_grid, "↓ Template", _dl_param_template,
-                              style="outline", width=110, height=30)
-            tb.grid(row=i, column=3, pady=S(3)); _register(tb)
-
-    batch_file_entry, dnd_file_entry, observed_csv_entry, param_csv_entry = entries
-
-    # Options row: Iterations + toggles — BELOW file rows
-    opts = tk.Frame(g2, bg=COLORS["bg_secondary"])
-    opts.pack(fill=tk.X, pady=(S(6), 0))
-
-    _labeled(opts, "Iterations", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
-    iterations_entry = ModernEntry(opts, width=6)
-    iterations_entry.pack(side=tk.LEFT)
-    iterations_entry.insert(0, "10")
-
-    _spacer = tk.Frame(opts, bg=COLORS["bg_secondary"], width=S(30))
-    _spacer.pack(side=tk.LEFT)
-    save_dnd_var = tk.BooleanVar(value=False)
-    save_cp_var = tk.BooleanVar(value=True)
-    t1 = ModernToggle(opts, text="Save .dnd backups", variable=save_dnd_var)
-    t1.frame.pack(side=tk.LEFT, padx=(0, S(20))); _register(t1)
-    save_dnd_toggle = t1
-    t2 = ModernToggle(opts, text="Save iteration results", variable=save_cp_var)
-    t2.frame.pack(side=tk.LEFT); _register(t2)
-    save_checkpoint_toggle = t2
-
-    # ══════════ OUTPUT LOG (this is the only scrollable part) ══════════
-    c3 = ModernCard(main, title="Output Log", icon="▸")
-    c3.pack(fill=tk.BOTH, expand=True, padx=pad, pady=(0, S(8)))
-    lc = tk.Frame(c3, bg=COLORS["bg_secondary"])
-    lc.pack(fill=tk.BOTH, expand=True, padx=S(20), pady=(S(2), S(14)))
-
-    log_display = tk.Text(lc, height=10,
-                          bg=COLORS["bg_log"], fg=COLORS["text_secondary"],
-                          insertbackground=COLORS["accent"],
-                          font=F("mono"), wrap=tk.WORD,
-                          relief="flat", bd=0,
-                          highlightbackground=COLORS["border_input"],
-                          highlightthickness=1,
-                          padx=S(12), pady=S(8))
-    ls = tk.Scrollbar(lc, orient="vertical", command=log_display.yview)
-    log_display.configure(yscrollcommand=ls.set)
-    log_display.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-    ls.pack(side=tk.RIGHT, fill=tk.Y)
-
-    # ══════════ BOTTOM BAR: Progress + Actions ══════════
-    bottom = tk.Frame(main, bg=COLORS["bg_primary"])
-    bottom.pack(fill=tk.X, padx=pad, pady=(S(4), S(16)))
-
-    # Progress
-    prow = tk.Frame(bottom, bg=COLORS["bg_primary"])
-    prow.pack(fill=tk.X, pady=(0, S(10)))
-    progress_label = _labeled(prow, "0%", "heading_sm",
-                              bg=COLORS["bg_primary"], fg=COLORS["accent"])
-    progress_label.pack(side=tk.RIGHT, padx=(S(10), 0))
-    progress_bar = ModernProgressBar(prow, height=6)
-    progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
-    _register(progress_bar)
-
-    # Buttons
-    brow = tk.Frame(bottom, bg=COLORS["bg_primary"])
-    brow.pack(fill=tk.X)
-    for text, cmd, sty, w, ico in [
-        ("Start Calibration", start_calibration, "success", 220, "▶"),
-        ("Stop",              stop_calibration,  "danger",  80,  "■"),
-        ("Results",           _open_results,     "secondary", 110, "📂"),
-    ]:
-        b = ModernButton(brow, text, cmd, style=sty, width=w, height=40, icon=ico)
-        b.pack(side=tk.LEFT, padx=(0, S(10))); _register(b)
-
-    b_exit = ModernButton(brow, "Exit", _exit, style="ghost", width=80, height=40)
-    b_exit.pack(side=tk.RIGHT); _register(b_exit)
-
-    # ── Welcome ──
-    log_message("  DNDC Calibration Studio")
-    log_message(f"  DPI: {base_dpi_scale:.2f}x ({int(base_dpi_scale * 96)} DPI)")
-    log_message(f"  {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    log_message("")
-    log_message("  Ctrl++/Ctrl+-  Zoom  ·  Ctrl+0 Reset")
-    log_message("  Ctrl+T  Toggle light/dark theme")
-    log_message("  F1: Start  ·  Esc: Exit")
-    log_message("  Output: <root>/calibration_results/<site>/")
-    log_message("")
-
-    root.mainloop()
-
-
-# =====================================================================
-#  ENTRY POINT
-# =====================================================================
-if __name__ == "__main__":
-    if is_already_running():
-        try:
-            r = tk.Tk(); r.withdraw()
-            messagebox.showerror("Error", "Another instance running."); r.destroy()
-        except: print("Another instance running.")
-        sys.exit(1)
+import os
+import sys
+import numpy as np
+import argparse
+import ast
+import subprocess
+import shutil
+import signal
+import copy
+import errno
+import hashlib
+import hmac
+import importlib
+import io
+import ipaddress
+import itertools
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import tkinter as tk
+from tkinter import filedialog, messagebox
+from tkinter import ttk
+import ctypes
+import threading
+import queue
+import re
+import socket
+import time
+import types
+import urllib.error
+import urllib.request
+import portalocker
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+
+
+# --------------------- Deferred heavy imports ---------------------
+# pandas, scikit-optimize (scipy, scikit-learn) and openpyxl take seconds to
+# import, so the window and short-lived worker processes start without them:
+# pandas loads on first use, the rest are imported inside the functions that
+# need them. `python caln.py importtime` guards against eager imports creeping back.
+class _LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access."""
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+pd = _LazyModule("pandas")
+
+HEAVY_MODULES = ["pandas", "skopt", "scipy", "sklearn", "openpyxl"]
+
+def preload_heavy_modules():
+    """Import the deferred dependencies now (e.g. in the background once the UI is up)."""
+    for name in ("pandas", "skopt", "skopt.space", "skopt.sampler", "skopt.acquisition",
+                 "sklearn.metrics", "sklearn.linear_model", "openpyxl", "openpyxl.chart"):
+        importlib.import_module(name)
+
+# --------------------- Path Handling for PyInstaller ---------------------
+def resource_path(relative_path):
+    try:
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
+
+# Global variables
+stop_calibration_flag = False
+calibration_thread = None
+
+class CalibrationStopped(Exception):
+    """Raised where a run notices Stop (or its job's cancel event) to unwind it."""
+
+def run_stopped(ctx=None):
+    """Stop was pressed (stops every run), or this run's own job was cancelled
+    (ctx["cancel_event"], from the queued job's settings)."""
+    if stop_calibration_flag:
+        return True
+    event = (ctx or {}).get("cancel_event")
+    return event is not None and event.is_set()
+
+# =====================================================================
+#  SCALING ENGINE
+#  All dimensions flow through S()/SF() so the entire UI scales uniformly.
+#  base_dpi_scale: detected from OS (1.0 at 96dpi, 1.5 at 144dpi, 2.0 at 4K)
+#  user_zoom: manual Ctrl+/- zoom (0.5x to 2.5x)
+# =====================================================================
+base_dpi_scale = 1.0
+user_zoom = 1.0
+
+def _detect_dpi_scale():
+    """Detect OS DPI scaling BEFORE creating any tk window."""
+    global base_dpi_scale
+    try:
+        ctypes.windll.shcore.SetProcessDpiAwareness(2)  # Per-monitor DPI v2
+    except Exception:
+        try:
+            ctypes.windll.user32.SetProcessDPIAware()
+        except Exception:
+            pass
+    try:
+        hdc = ctypes.windll.user32.GetDC(0)
+        dpi = ctypes.windll.gdi32.GetDeviceCaps(hdc, 88)  # LOGPIXELSX
+        ctypes.windll.user32.ReleaseDC(0, hdc)
+        base_dpi_scale = dpi / 96.0
+    except Exception:
+        base_dpi_scale = 1.0
+
+def _scale_factor():
+    return base_dpi_scale * user_zoom
+
+def S(val):
+    """Scale a pixel value by DPI * zoom. Returns int."""
+    return int(val * _scale_factor())
+
+def SF(base_size):
+    """Scale a font size. Minimum 7."""
+    return max(7, int(base_size * _scale_factor()))
+
+def F(key):
+    """Get a scaled font tuple by name."""
+    fonts = {
+        "heading_xl":  ("Segoe UI", SF(22), "bold"),
+        "heading_lg":  ("Segoe UI", SF(16), "bold"),
+        "heading_md":  ("Segoe UI", SF(13), "bold"),
+        "heading_sm":  ("Segoe UI", SF(11), "bold"),
+        "body":        ("Segoe UI", SF(10)),
+        "body_sm":     ("Segoe UI", SF(9)),
+        "mono":        ("Cascadia Code", SF(9)),
+        "mono_sm":     ("Cascadia Code", SF(8)),
+        "label":       ("Segoe UI", SF(10)),
+        "label_bold":  ("Segoe UI", SF(10), "bold"),
+        "button":      ("Segoe UI", SF(10), "bold"),
+        "button_sm":   ("Segoe UI", SF(9), "bold"),
+        "tag":         ("Segoe UI", SF(8), "bold"),
+    }
+    return fonts.get(key, fonts["body"])
+
+# Widget registry for zoom rescaling
+_scalable_widgets = []
+
+def _register(widget):
+    """Register a custom widget for rescaling on zoom."""
+    _scalable_widgets.append(widget)
+    return widget
+
+def _labeled(parent, text, font_tag, **kw):
+    """Create a Label with a font tag for zoom rescaling."""
+    lbl = tk.Label(parent, text=text, font=F(font_tag), **kw)
+    lbl._font_tag = font_tag
+    return lbl
+
+# =====================================================================
+#  ZOOM FUNCTIONS (Ctrl+/- and Ctrl+0)
+# =====================================================================
+def zoom_in(event=None):
+    global user_zoom
+    user_zoom = min(2.5, round(user_zoom + 0.1, 1))
+    _apply_zoom()
+
+def zoom_out(event=None):
+    global user_zoom
+    user_zoom = max(0.5, round(user_zoom - 0.1, 1))
+    _apply_zoom()
+
+def reset_zoom(event=None):
+    global user_zoom
+    user_zoom = 1.0
+    _apply_zoom()
+
+def _apply_zoom():
+    """Walk entire widget tree and update all fonts + rescale custom widgets."""
+    log_message(f"  Zoom: {user_zoom:.1f}x  ·  DPI: {base_dpi_scale:.2f}x  ·  Effective: {_scale_factor():.2f}x")
+    _walk_rescale(root)
+    for w in _scalable_widgets:
+        try:
+            w.rescale()
+        except Exception:
+            pass
+
+def _walk_rescale(widget):
+    """Recursively update fonts on standard tk widgets."""
+    try:
+        if isinstance(widget, tk.Label) and hasattr(widget, '_font_tag'):
+            widget.config(font=F(widget._font_tag))
+        elif isinstance(widget, tk.Entry):
+            widget.config(font=F("body"))
+        elif isinstance(widget, tk.Text):
+            widget.config(font=F("mono"))
+        elif isinstance(widget, ttk.Combobox):
+            widget.config(font=F("body"))
+    except Exception:
+        pass
+    try:
+        for child in widget.winfo_children():
+            _walk_rescale(child)
+    except Exception:
+        pass
+
+
+# =====================================================================
+#  DESIGN SYSTEM  — Vercel/Linear inspired dark theme
+# =====================================================================
+
+
+# =====================================================================
+#  DUAL THEME SYSTEM — Dark (default) + Light
+# =====================================================================
+
+DARK_THEME = {
+    "bg_primary":     "#10131a",
+    "bg_secondary":   "#181c27",
+    "bg_tertiary":    "#212636",
+    "bg_input":       "#1a1e2a",
+    "bg_log":         "#0c0e14",
+    "border":         "#2e3446",
+    "border_focus":   "#3b82f6",
+    "border_hover":   "#3d4456",
+    "border_input":   "#363c50",
+    "text_primary":   "#edf0f7",
+    "text_secondary": "#a0a8be",
+    "text_tertiary":  "#6b7280",
+    "text_on_accent": "#ffffff",
+    "accent":         "#06b6d4",
+    "accent_hover":   "#0891b2",
+    "accent_muted":   "#164e63",
+    "success":        "#10b981",
+    "success_hover":  "#059669",
+    "danger":         "#ef4444",
+    "danger_hover":   "#dc2626",
+    "toggle_on":      "#10b981",
+    "toggle_off":     "#3d4456",
+    "toggle_knob":    "#ffffff",
+    "progress_bg":    "#252a38",
+    "progress_fill":  "#06b6d4",
+}
+
+LIGHT_THEME = {
+    "bg_primary":     "#f0f2f5",
+    "bg_secondary":   "#ffffff",
+    "bg_tertiary":    "#e8ebf0",
+    "bg_input":       "#f7f8fa",
+    "bg_log":         "#fafbfc",
+    "border":         "#d1d5db",
+    "border_focus":   "#3b82f6",
+    "border_hover":   "#b0b6c2",
+    "border_input":   "#c8cdd6",
+    "text_primary":   "#1a1d27",
+    "text_secondary": "#4b5563",
+    "text_tertiary":  "#9ca3af",
+    "text_on_accent": "#ffffff",
+    "accent":         "#0891b2",
+    "accent_hover":   "#0e7490",
+    "accent_muted":   "#cffafe",
+    "success":        "#059669",
+    "success_hover":  "#047857",
+    "danger":         "#dc2626",
+    "danger_hover":   "#b91c1c",
+    "toggle_on":      "#10b981",
+    "toggle_off":     "#d1d5db",
+    "toggle_knob":    "#ffffff",
+    "progress_bg":    "#e5e7eb",
+    "progress_fill":  "#0891b2",
+}
+
+# Active palette — starts as dark
+COLORS = dict(DARK_THEME)
+_is_dark = True
+
+def toggle_theme():
+    """Switch between dark and light themes."""
+    global _is_dark
+    _is_dark = not _is_dark
+    theme = DARK_THEME if _is_dark else LIGHT_THEME
+    COLORS.update(theme)
+    _apply_theme()
+
+def _apply_theme():
+    """Rebuild all widget colors after theme change."""
+    _walk_retheme(root)
+    # Rescale also redraws custom canvas widgets with new colors
+    for w in _scalable_widgets:
+        try:
+            w.rescale()
+        except Exception:
+            pass
+    # Re-style combobox
+    sty = ttk.Style()
+    sty.configure("Modern.TCombobox",
+                  fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
+                  foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
+                  bordercolor=COLORS["border_input"])
+    sty.map("Modern.TCombobox",
+            fieldbackground=[("readonly", COLORS["bg_input"])],
+            foreground=[("readonly", COLORS["text_primary"])])
+    log_message(f"  Theme: {'Dark' if _is_dark else 'Light'}")
+
+def _walk_retheme(widget):
+    """Recursively recolor standard widgets."""
+    try:
+        wtype = widget.winfo_class()
+        if wtype == 'Frame':
+            # Determine if it's a card (bg_secondary) or main (bg_primary)
+            try:
+                old_bg = widget.cget("bg")
+            except:
+                old_bg = ""
+            if old_bg in (DARK_THEME["bg_secondary"], LIGHT_THEME["bg_secondary"]):
+                widget.config(bg=COLORS["bg_secondary"])
+            elif old_bg in (DARK_THEME["accent_muted"], LIGHT_THEME["accent_muted"]):
+                widget.config(bg=COLORS["accent_muted"])
+            else:
+                widget.config(bg=COLORS["bg_primary"])
+        elif wtype == 'Label':
+            parent_bg = COLORS["bg_primary"]
+            try:
+                parent_bg = widget.master.cget("bg")
+            except:
+                pass
+            widget.config(bg=parent_bg)
+            # Determine text color from font tag
+            fg = widget.cget("fg")
+            if fg in (DARK_THEME["text_primary"], LIGHT_THEME["text_primary"]):
+                widget.config(fg=COLORS["text_primary"])
+            elif fg in (DARK_THEME["text_secondary"], LIGHT_THEME["text_secondary"]):
+                widget.config(fg=COLORS["text_secondary"])
+            elif fg in (DARK_THEME["text_tertiary"], LIGHT_THEME["text_tertiary"]):
+                widget.config(fg=COLORS["text_tertiary"])
+            elif fg in (DARK_THEME["accent"], LIGHT_THEME["accent"]):
+                widget.config(fg=COLORS["accent"])
+        elif wtype == 'Entry':
+            widget.config(bg=COLORS["bg_input"], fg=COLORS["text_primary"],
+                         insertbackground=COLORS["accent"],
+                         highlightbackground=COLORS["border_input"],
+                         highlightcolor=COLORS["border_focus"])
+        elif wtype == 'Text':
+            widget.config(bg=COLORS["bg_log"], fg=COLORS["text_secondary"],
+                         insertbackground=COLORS["accent"],
+                         highlightbackground=COLORS["border_input"])
+    except Exception:
+        pass
+    try:
+        for child in widget.winfo_children():
+            _walk_retheme(child)
+    except Exception:
+        pass
+
+
+# =====================================================================
+#  CUSTOM WIDGETS — Polished, DPI-aware, visible borders
+# =====================================================================
+
+class ModernCard(tk.Frame):
+    def __init__(self, parent, title=None, icon=None, **kwargs):
+        super().__init__(parent, bg=COLORS["bg_secondary"],
+                         highlightbackground=COLORS["border"], highlightthickness=1, **kwargs)
+        if title:
+            header = tk.Frame(self, bg=COLORS["bg_secondary"])
+            header.pack(fill=tk.X, padx=S(20), pady=(S(14), S(6)))
+            text = f"{icon}  {title}" if icon else title
+            _labeled(header, text, "heading_md",
+                     bg=COLORS["bg_secondary"], fg=COLORS["text_primary"]).pack(side=tk.LEFT)
+
+
+class ModernButton(tk.Canvas):
+    """Rounded button with proper text sizing and visible borders."""
+    def __init__(self, parent, text, command=None, style="primary",
+                 width=140, height=38, icon=None, **kwargs):
+        self._base_w = width
+        self._base_h = height
+        w, h = S(width), S(height)
+        super().__init__(parent, width=w, height=h,
+                         bg=parent.cget("bg"), highlightthickness=0, **kwargs)
+        self._command = command
+        self._icon = icon
+        self._label = text
+        self._text = f"{icon} {text}" if icon else text
+        self._style_name = style
+        self._width = w
+        self._height = h
+        self._hovered = False
+        self._pressed = False
+
+        styles = {
+            "primary":   (COLORS["accent"],      COLORS["accent_hover"],  "#ffffff",             ""),
+            "success":   (COLORS["success"],      COLORS["success_hover"], "#ffffff",             ""),
+            "danger":    (COLORS["danger"],       COLORS["danger_hover"],  "#ffffff",             ""),
+            "ghost":     (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
+            "outline":   ("transparent",          COLORS["bg_tertiary"],   COLORS["accent"],      COLORS["accent"]),
+            "secondary": (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
+        }
+        self._bg, self._hover_bg, self._fg, self._outline = styles.get(style, styles["primary"])
+
+        self._draw()
+        self.bind("<Enter>", self._on_enter)
+        self.bind("<Leave>", self._on_leave)
+        self.bind("<ButtonPress-1>", self._on_press)
+        self.bind("<ButtonRelease-1>", self._on_release)
+
+    def _draw(self):
+        self.delete("all")
+        r = S(6)
+        w, h = self._width, self._height
+        bg = self._hover_bg if self._hovered else self._bg
+        if bg == "transparent":
+            bg = self.master.cget("bg")
+        outline = self._outline if (self._outline and not self._hovered) else ""
+        self._rrect(1, 1, w-1, h-1, r, fill=bg, outline=outline, width=1)
+        # Font that won't overflow: use smaller font for compact buttons
+        font = F("button") if self._base_w >= 120 else F("button_sm")
+        self.create_text(w/2, h/2, text=self._text, font=font, fill=self._fg)
+
+    def _rrect(self, x1, y1, x2, y2, r, **kw):
+        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
+               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
+               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
+        return self.create_polygon(pts, smooth=True, **kw)
+
+    def _on_enter(self, e):
+        self._hovered = True; self._draw(); self.config(cursor="hand2")
+    def _on_leave(self, e):
+        self._hovered = False; self._draw()
+    def _on_press(self, e):
+        self._pressed = True
+    def _on_release(self, e):
+        if self._pressed and self._hovered and self._command: self._command()
+        self._pressed = False
+
+    def rescale(self):
+        self._width, self._height = S(self._base_w), S(self._base_h)
+        self.config(width=self._width, height=self._height)
+        # Re-read colors for theme switch
+        styles = {
+            "primary":   (COLORS["accent"],      COLORS["accent_hover"],  "#ffffff",             ""),
+            "success":   (COLORS["success"],      COLORS["success_hover"], "#ffffff",             ""),
+            "danger":    (COLORS["danger"],       COLORS["danger_hover"],  "#ffffff",             ""),
+            "ghost":     (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
+            "outline":   ("transparent",          COLORS["bg_tertiary"],   COLORS["accent"],      COLORS["accent"]),
+            "secondary": (COLORS["bg_tertiary"],  COLORS["border_hover"],  COLORS["text_primary"], COLORS["border"]),
+        }
+        self._bg, self._hover_bg, self._fg, self._outline = styles.get(self._style_name, styles["primary"])
+        try:
+            self.config(bg=self.master.cget("bg"))
+        except: pass
+        self._draw()
+
+
+class ModernEntry(tk.Frame):
+    """Entry with visible border and focus ring."""
+    def __init__(self, parent, width=45, placeholder="", **kwargs):
+        super().__init__(parent, bg=parent.cget("bg"))
+        self.entry = tk.Entry(
+            self, width=width,
+            bg=COLORS["bg_input"], fg=COLORS["text_primary"],
+            insertbackground=COLORS["accent"], font=F("body"),
+            relief="flat", bd=0,
+            highlightbackground=COLORS["border_input"],
+            highlightcolor=COLORS["border_focus"],
+            highlightthickness=1,
+        )
+        self.entry.pack(padx=0, pady=0, ipady=S(5), ipadx=S(6))
+        self._placeholder = placeholder
+        self._has_placeholder = False
+        if placeholder:
+            self._show_placeholder()
+            self.entry.bind("<FocusIn>", self._on_focus_in)
+            self.entry.bind("<FocusOut>", self._on_focus_out)
+
+    def _show_placeholder(self):
+        self.entry.insert(0, self._placeholder)
+        self.entry.config(fg=COLORS["text_tertiary"]); self._has_placeholder = True
+    def _on_focus_in(self, e):
+        if self._has_placeholder:
+            self.entry.delete(0, tk.END); self.entry.config(fg=COLORS["text_primary"]); self._has_placeholder = False
+    def _on_focus_out(self, e):
+        if not self.entry.get(): self._show_placeholder()
+    def get(self):
+        return "" if self._has_placeholder else self.entry.get()
+    def delete(self, *a): self.entry.delete(*a)
+    def insert(self, *a):
+        if self._has_placeholder:
+            self.entry.delete(0, tk.END); self.entry.config(fg=COLORS["text_primary"]); self._has_placeholder = False
+        self.entry.insert(*a)
+    def rescale(self):
+        self.entry.config(font=F("body"))
+
+
+class ModernCombobox(ttk.Combobox):
+    def __init__(self, parent, **kwargs):
+        sty = ttk.Style()
+        sty.configure("Modern.TCombobox",
+                      fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
+                      foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
+                      bordercolor=COLORS["border_input"], lightcolor=COLORS["border_input"],
+                      darkcolor=COLORS["border_input"],
+                      selectbackground=COLORS["accent_muted"], selectforeground=COLORS["text_primary"],
+                      padding=(S(8), S(5)))
+        sty.map("Modern.TCombobox",
+                fieldbackground=[("readonly", COLORS["bg_input"])],
+                foreground=[("readonly", COLORS["text_primary"])],
+                bordercolor=[("focus", COLORS["border_focus"])])
+        super().__init__(parent, style="Modern.TCombobox", **kwargs)
+
+
+class ModernProgressBar(tk.Canvas):
+    def __init__(self, parent, height=6, **kwargs):
+        self._base_h = height; h = S(height)
+        super().__init__(parent, height=h, bg=parent.cget("bg"), highlightthickness=0, **kwargs)
+        self._height = h; self._value = 0
+        self.bind("<Configure>", lambda e: self._draw())
+    def _draw(self):
+        self.delete("all"); w = self.winfo_width(); h = self._height
+        if w < 10: return
+        r = h // 2
+        self._rrect(0, 0, w, h, r, fill=COLORS["progress_bg"])
+        if self._value > 0:
+            self._rrect(0, 0, max(h, (self._value/100)*w), h, r, fill=COLORS["progress_fill"])
+    def _rrect(self, x1, y1, x2, y2, r, **kw):
+        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
+               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
+               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
+        return self.create_polygon(pts, smooth=True, **kw)
+    def set_value(self, v):
+        self._value = max(0, min(100, v)); self._draw()
+    def rescale(self):
+        self._height = S(self._base_h); self.config(height=self._height); self._draw()
+
+
+class ModernToggle(tk.Canvas):
+    """Toggle with GREEN on / GRAY off — clearly visible states."""
+    def __init__(self, parent, text="", variable=None, **kwargs):
+        self._frame = tk.Frame(parent, bg=parent.cget("bg"))
+        tw, th = S(44), S(24)
+        super().__init__(self._frame, width=tw, height=th,
+                         bg=parent.cget("bg"), highlightthickness=0)
+        self._var = variable or tk.BooleanVar(value=False)
+        self._tw, self._th = tw, th
+        self.pack(side=tk.LEFT)
+        self._label = None
+        if text:
+            self._label = _labeled(self._frame, text, "body",
+                                   bg=parent.cget("bg"), fg=COLORS["text_secondary"])
+            self._label.pack(side=tk.LEFT, padx=(S(8), 0))
+        self._draw()
+        self.bind("<Button-1>", self._toggle)
+
+    @property
+    def frame(self):
+        return self._frame
+
+    def _draw(self):
+        self.delete("all")
+        on = self._var.get()
+        w, h = self._tw, self._th
+        r = h // 2
+        # GREEN when on, visible GRAY when off
+        track = COLORS["toggle_on"] if on else COLORS["toggle_off"]
+        self._pill(1, 1, w-1, h-1, r, fill=track, outline="")
+        # White knob
+        knob_d = int(h * 0.7)
+        margin = (h - knob_d) // 2
+        kx = w - margin - knob_d if on else margin
+        self.create_oval(kx, margin, kx+knob_d, margin+knob_d,
+                        fill=COLORS["toggle_knob"], outline="")
+
+    def _pill(self, x1, y1, x2, y2, r, **kw):
+        pts = [x1+r, y1, x2-r, y1, x2, y1, x2, y1+r,
+               x2, y2-r, x2, y2, x2-r, y2, x1+r, y2,
+               x1, y2, x1, y2-r, x1, y1+r, x1, y1]
+        return self.create_polygon(pts, smooth=True, **kw)
+
+    def _toggle(self, e=None):
+        self._var.set(not self._var.get()); self._draw(); self.config(cursor="hand2")
+
+    def get(self):
+        return self._var.get()
+
+    def rescale(self):
+        self._tw, self._th = S(44), S(24)
+        self.config(width=self._tw, height=self._th); self._draw()
+        if self._label: self._label.config(font=F("body"))
+
+
+
+
+
+# =====================================================================
+#  SOIL DEPTH CONFIGS
+# =====================================================================
+SOIL_TEMP_DEPTHS = {
+    "1cm": 5, "5cm": 6, "10cm": 7, "20cm": 8, "30cm": 9, "40cm": 10,
+    "50cm": 11, "60cm": 12, "70cm": 13, "80cm": 14, "90cm": 15, "100cm": 16,
+    "110cm": 17, "120cm": 18, "130cm": 19, "140cm": 20, "150cm": 21,
+    "160cm": 22, "170cm": 23, "180cm": 24, "190cm": 25, "200cm": 26
+}
+
+SOIL_MOISTURE_DEPTHS = {
+    "1cm": 27, "5cm": 28, "10cm": 29, "20cm": 30, "30cm": 31, "40cm": 32,
+    "50cm": 33, "60cm": 34, "70cm": 35, "80cm": 36, "90cm": 37, "100cm": 38,
+    "110cm": 39, "120cm": 40, "130cm": 41, "140cm": 42, "150cm": 43,
+    "160cm": 44, "170cm": 45, "180cm": 46, "190cm": 47, "200cm": 48
+}
+
+TARGET_VARIABLES = ["Yield", "SoilTemp", "SoilMoisture", "ET", "NEE", "N2O"]
+
+ROOT_FOLDER = r"C:\DNDC"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# =====================================================================
+#  DYNAMIC PATH BUILDER
+# =====================================================================
+def get_output_paths(root_folder, site_name):
+    output_dir = os.path.join(root_folder, "output_files")
+    return {
+        "output_dir": output_dir,
+        "batch_record_root": os.path.join(output_dir, "Record", "Batch"),
+        "results_dir": os.path.join(root_folder, "calibration_results", site_name),
+        "workers_dir": os.path.join(output_dir, "workers"),
+        "cache_dir": os.path.join(root_folder, "calibration_results", site_name, "sim_cache"),
+        "obs_cache_dir": os.path.join(root_folder, "calibration_results", "obs_cache"),
+        "root_folder": root_folder,
+    }
+
+def detect_dndc_output_folder(batch_record_root):
+    """After DNDC runs, find the most recently modified subfolder in Record/Batch/."""
+    if not os.path.exists(batch_record_root):
+        return None
+    subfolders = [
+        os.path.join(batch_record_root, d)
+        for d in os.listdir(batch_record_root)
+        if os.path.isdir(os.path.join(batch_record_root, d))
+    ]
+    if not subfolders:
+        return None
+    # Return the most recently modified
+    return max(subfolders, key=os.path.getmtime)
+
+def prune_run_outputs(output_dir, keep=()):
+    """Delete every file under a run's output folder whose name is not in keep
+    (then the emptied folders). Returns the bytes freed."""
+    freed = 0
+    for dirpath, dirnames, filenames in os.walk(output_dir, topdown=False):
+        for name in filenames:
+            if name in keep:
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except OSError:
+                pass  # still locked by antivirus / indexer: the next run clears it
+        if dirpath != output_dir:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # not empty
+    return freed
+
+def get_modeled_paths(dndc_record_dir):
+    """Output file name -> path in the detected DNDC output folder."""
+    return {name: os.path.join(dndc_record_dir, name) for name in OUTPUT_SCHEMAS}
+
+def auto_detect_site_name(batch_file_path):
+    try:
+        if not os.path.exists(batch_file_path):
+            return ""
+        with open(batch_file_path, 'r') as f:
+            content = f.read()
+        for line in content.strip().split('\n'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.endswith('.dnd') or '-stc' in line:
+                name = os.path.splitext(os.path.basename(line))[0]
+                if name:
+                    return name
+        import re
+        match = re.search(r'(\S+\.dnd)', content)
+        if match:
+            return os.path.splitext(os.path.basename(match.group(1)))[0]
+    except Exception:
+        pass
+    return ""
+
+
+# =====================================================================
+#  UTILITY FUNCTIONS
+# =====================================================================
+def show_error(message):
+    if "root" not in globals():
+        return  # headless: the message is already in the log
+    def _show():
+        messagebox.showerror("Error", message)
+    if threading.current_thread() is threading.main_thread():
+        _show()
+    else:
+        root.after(0, _show)
+
+# ── Log pipeline: producers enqueue, the Tk loop drains in batches on a timer ──
+LOG_MAX_LINES = 5000        # ring-buffer size of the on-screen log
+LOG_DRAIN_MS = 100          # drain interval
+LOG_DRAIN_BATCH = 500       # max lines inserted per drain
+LOG_FILE_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+LOG_FILE_MAX_AGE_DAYS = 30  # other processes' log files older than this are removed
+
+_log_queue = queue.Queue()
+_log_context = threading.local()     # .source = "worker N" inside parallel workers, .levels = its run's
+_worker_log_levels = {"default": logging.INFO}
+_file_logger = None
+_file_logger_root = None
+_file_logger_lock = threading.Lock()
+
+def _attach_log_file(logger, root_folder):
+    """Send logger to <root_folder>/logs/calibration-<pid>.log. Each process rotates only
+    its own file: Windows cannot rename a log that another process holds open."""
+    global _file_logger_root
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    _file_logger_root = os.path.abspath(root_folder)
+    try:
+        log_dir = os.path.join(root_folder, "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        cutoff = time.time() - LOG_FILE_MAX_AGE_DAYS * 86400
+        for name in os.listdir(log_dir):
+            path = os.path.join(log_dir, name)
+            if name.startswith("calibration-") and os.path.getmtime(path) < cutoff:
+                try: os.remove(path)
+                except OSError: pass
+        handler = RotatingFileHandler(os.path.join(log_dir, f"calibration-{os.getpid()}.log"),
+                                      maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS,
+                                      encoding="utf-8")
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+    except OSError:
+        logger.addHandler(logging.NullHandler())
+
+def _get_file_logger():
+    """This process's full-log file (see set_log_root); until a root is set it goes
+    under ROOT_FOLDER when that folder exists, else nowhere."""
+    global _file_logger
+    if _file_logger is None:
+        with _file_logger_lock:
+            if _file_logger is None:
+                logger = logging.getLogger("dndc_calibration")
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+                if os.path.isdir(ROOT_FOLDER):
+                    _attach_log_file(logger, ROOT_FOLDER)
+                else:
+                    logger.addHandler(logging.NullHandler())
+                _file_logger = logger
+    return _file_logger
+
+def set_log_root(root_folder):
+    """Write the log under <root_folder>/logs, the DNDC root the run was configured with."""
+    logger = _get_file_logger()
+    with _file_logger_lock:
+        if root_folder and os.path.isdir(root_folder) and os.path.abspath(root_folder) != _file_logger_root:
+            _attach_log_file(logger, root_folder)
+
+def worker_log_levels(settings):
+    """Per-worker screen log levels of one run: worker_log_level (default) and
+    worker_log_levels {"worker 2": "DEBUG", ...}. The log file always gets everything.
+    Worker threads apply them through _log_context.levels, so concurrent queued jobs
+    each keep their own."""
+    def _level(name):
+        return logging.getLevelName(str(name).upper()) if not isinstance(name, int) else name
+    levels = {"default": _level(settings.get("worker_log_level") or "INFO")}
+    for source, level in (settings.get("worker_log_levels") or {}).items():
+        levels[source] = _level(level)
+    return levels
+
+def log_message(message, level=logging.INFO):
+    source = getattr(_log_context, "source", None)
+    _get_file_logger().log(level, f"[{source}] {message}" if source else message)
+    levels = getattr(_log_context, "levels", None) or _worker_log_levels
+    if source is not None and level < levels.get(source, levels["default"]):
+        return
+    if "log_display" not in globals():
+        # Headless use (CLI, worker processes): no Tk window to write to
+        print(message)
+        return
+    _log_queue.put(message)
+
+def _drain_log_queue():
+    """Tk timer: insert queued lines in one batch and trim the widget to LOG_MAX_LINES."""
+    lines = []
+    try:
+        while len(lines) < LOG_DRAIN_BATCH:
+            lines.append(_log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if lines:
+        try:
+            log_display.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(log_display.index("end-1c").split(".")[0]) - 1 - LOG_MAX_LINES
+            if excess > 0:
+                log_display.delete("1.0", f"{excess + 1}.0")
+            log_display.see(tk.END)
+        except Exception:
+            pass
+    root.after(LOG_DRAIN_MS, _drain_log_queue)
+
+def set_progress(pct, eta=None):
+    """Update the progress bar (and ETA, in seconds) from any thread. No-op when running headless."""
+    if "progress_bar" not in globals():
+        return
+    root.after(0, lambda p=pct: progress_bar.set_value(p))
+    text = f"{pct:.0f}%" if eta is None else f"{pct:.0f}%  ·  ETA {format_duration(eta)}"
+    root.after(0, lambda t=text: progress_label.config(text=t))
+
+def check_file_exists(file_path):
+    if not os.path.exists(file_path):
+        log_message(f"✗ File not found: {file_path}")
+        return False
+    if not os.access(file_path, os.R_OK):
+        log_message(f"✗ File not readable: {file_path}")
+        return False
+    return True
+
+def read_dnd_file(dnd_path):
+    try:
+        with open(dnd_path, 'r') as file:
+            return file.readlines()
+    except Exception as e:
+        log_message(f"✗ Failed to read .dnd file: {e}")
+        return []
+
+def write_dnd_file(dnd_path, lines):
+    try:
+        with open(dnd_path, 'w') as file:
+            file.writelines(lines)
+    except Exception as e:
+        log_message(f"✗ Failed to write .dnd file: {e}")
+
+PARAM_TYPES = ["real", "integer", "categorical"]
+PARAM_PRIORS = ["uniform", "log-uniform"]
+
+def _param_cell(row, column, default):
+    """Optional parameter CSV cell as a lower-case string (default when absent or blank)."""
+    value = row.get(column, None)
+    if value is None or (isinstance(value, float) and np.isnan(value)) or not str(value).strip():
+        return default
+    return str(value).strip().lower()
+
+def _param_prior(row):
+    prior = _param_cell(row, "prior", "uniform").replace("_", "-").replace(" ", "-")
+    if prior in ("log", "loguniform"):
+        prior = "log-uniform"
+    if _param_cell(row, "transform", "none") in ("log", "log10", "ln"):
+        prior = "log-uniform"
+    return prior
+
+def _param_categories(row):
+    return [c.strip() for c in str(row.get("categories", "")).split(";") if c.strip()]
+
+def read_param_ranges(param_csv):
+    """Parameter CSV: parameter_name, min, max, line_number, plus optional
+    type (real / integer / categorical), prior (uniform / log-uniform),
+    transform (none / log) and categories ("a;b;c", categorical only)."""
+    try:
+        df = pd.read_csv(param_csv)
+        required_cols = ["parameter_name", "min", "max", "line_number"]
+        missing = [c for c in required_cols if c not in df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {missing}")
+        for _, row in df.iterrows():
+            kind = _param_cell(row, "type", "real")
+            if kind not in PARAM_TYPES:
+                raise ValueError(f"'{row['parameter_name']}': type must be one of {PARAM_TYPES}")
+            if kind == "categorical":
+                if len(_param_categories(row)) < 2:
+                    raise ValueError(f"'{row['parameter_name']}': categorical needs categories like 'a;b'")
+            else:
+                if row['min'] >= row['max']:
+                    raise ValueError(f"'{row['parameter_name']}': min >= max")
+                if _param_prior(row) not in PARAM_PRIORS:
+                    raise ValueError(f"'{row['parameter_name']}': prior must be one of {PARAM_PRIORS}")
+                if _param_prior(row) == "log-uniform" and row['min'] <= 0:
+                    raise ValueError(f"'{row['parameter_name']}': log-uniform needs min > 0")
+            if row['line_number'] < 0:
+                raise ValueError(f"'{row['parameter_name']}': line_number < 1")
+        return df
+    except Exception as e:
+        log_message(f"✗ Parameter CSV error: {e}")
+        return pd.DataFrame()
+
+def build_search_space(param_ranges_df):
+    """skopt dimensions for the parameter CSV. Log-uniform parameters are searched on a
+    log scale but, like every other dimension, proposed and reported in natural units."""
+    from skopt.space import Real, Integer, Categorical
+    dims = []
+    for _, row in param_ranges_df.iterrows():
+        name = str(row['parameter_name'])
+        kind = _param_cell(row, "type", "real")
+        if kind == "categorical":
+            dims.append(Categorical(_param_categories(row), name=name))
+        elif kind == "integer":
+            dims.append(Integer(int(row['min']), int(row['max']), prior=_param_prior(row), name=name))
+        else:
+            dims.append(Real(float(row['min']), float(row['max']), prior=_param_prior(row), name=name))
+    return dims
+
+def describe_dimension(dim):
+    from skopt.space import Integer, Categorical
+    if isinstance(dim, Categorical):
+        return f"{dim.name} ∈ {{{', '.join(str(c) for c in dim.categories)}}}"
+    kind = "int " if isinstance(dim, Integer) else ""
+    return f"{dim.name} {kind}[{dim.low:g}, {dim.high:g}]{' log' if dim.prior == 'log-uniform' else ''}"
+
+def format_parameter_value(value, row):
+    """Text written into the .dnd for a parameter value of this CSV row."""
+    kind = _param_cell(row, "type", "real")
+    if kind == "categorical":
+        return str(value)
+    if kind == "integer":
+        return str(int(round(float(value))))
+    return f"{float(value):.6f}"
+
+def coerce_parameter_values(values, param_ranges_df):
+    """Values (e.g. read back from a workbook) converted to each parameter's type."""
+    out = []
+    for value, (_, row) in zip(values, param_ranges_df.iterrows()):
+        kind = _param_cell(row, "type", "real")
+        if kind == "categorical":
+            text = str(value).strip()
+            # Excel may have turned "2" into 2.0
+            match = next((c for c in _param_categories(row)
+                          if c == text or (_is_number(c) and _is_number(text) and float(c) == float(text))), text)
+            out.append(match)
+        elif kind == "integer":
+            out.append(int(round(float(value))))
+        else:
+            out.append(float(value))
+    return out
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def update_parameters(lines, param_values, param_ranges_df):
+    """Update .dnd lines with new parameter values.
+    param_values: list of values (same order as param_ranges_df rows)."""
+    updated_lines = copy.deepcopy(lines)
+    for i, (_, row) in enumerate(param_ranges_df.iterrows()):
+        if i >= len(param_values):
+            break
+        value = param_values[i]
+        line_idx = int(row["line_number"])
+        if 0 <= line_idx < len(updated_lines):
+            parts = updated_lines[line_idx].strip().split()
+            if len(parts) >= 2:
+                parts[1] = format_parameter_value(value, row)
+                updated_lines[line_idx] = ' '.join(parts) + '\n'
+        else:
+            log_message(f"⚠ Line {line_idx + 1} out of range for '{row['parameter_name']}'")
+    return updated_lines
+
+# Every running DNDC child is registered here so Stop / Exit can kill it at once
+_active_processes = set()
+_active_processes_lock = threading.Lock()
+
+def kill_process_tree(proc):
+    """Kill a DNDC child together with anything it spawned."""
+    if proc.poll() is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except Exception:
+        pass
+    try:
+        proc.kill()
+    except Exception:
+        pass
+
+def terminate_active_processes():
+    """Kill all registered DNDC runs. Returns how many were running."""
+    with _active_processes_lock:
+        procs = list(_active_processes)
+    for proc in procs:
+        kill_process_tree(proc)
+    return len(procs)
+
+def run_dndc(output_dir, root_folder, batch_file, timeout=600, daily=True):
+    dndc_exe = os.path.join(root_folder, "DNDC95.exe")
+    if not os.path.exists(dndc_exe):
+        raise FileNotFoundError(f"DNDC executable not found: {dndc_exe}")
+    cmd = [dndc_exe, "-root", root_folder, "-output", output_dir, "-s", batch_file,
+           "-daily", "1" if daily else "0"]
+    # Own process group, so the whole tree can be killed on Stop / Exit
+    if os.name == "nt":
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group = {"start_new_session": True}
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **group)
+    with _active_processes_lock:
+        _active_processes.add(proc)
+    try:
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(proc)
+            proc.communicate()
+            log_message(f"✗ DNDC timed out ({timeout}s)")
+            raise
+    finally:
+        with _active_processes_lock:
+            _active_processes.discard(proc)
+    if proc.returncode != 0:
+        if stop_calibration_flag:
+            raise CalibrationStopped("Stopped by user.")
+        log_message(f"✗ DNDC failed: {stderr}")
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    log_message("  ✓ DNDC run completed", logging.DEBUG)
+
+
+# =====================================================================
+#  OUTPUT SCHEMA REGISTRY
+#  Each DNDC output file is declared once: its header/unit rows and the
+#  named columns it holds. Calibration targets are (file, column) entries,
+#  so several targets in one file are pulled out in a single pass, and a
+#  new target is a settings entry ("output_schemas" / "output_targets").
+# =====================================================================
+# "read": pandas.read_csv keywords for the header/unit rows; "columns": name -> position.
+# Year must be column 0; files with a Day column (position 1) are daily.
+OUTPUT_SCHEMAS = {
+    "Multi_year_summary.csv": {
+        "read": {"skiprows": 5, "header": None},
+        "columns": {"Year": 0, "Yield": 2},
+    },
+    "Day_SoilClimate_1.csv": {
+        "read": {"skiprows": 4, "header": 0},
+        "columns": {"Year": 0, "Day": 1,
+                    **{f"SoilTemp_{d}": c for d, c in SOIL_TEMP_DEPTHS.items()},
+                    **{f"SoilMoisture_{d}": c for d, c in SOIL_MOISTURE_DEPTHS.items()}},
+    },
+    "Day_Climate_1.csv": {
+        "read": {"skiprows": [0], "header": 1},
+        "columns": {"Year": 0, "Day": 1, "ET": 9},
+    },
+    "Day_SoilC_1.csv": {
+        "read": {"skiprows": 1},
+        "columns": {"Year": 0, "Day": 1, "NEE": 42},
+    },
+    "Day_SoilN_1.csv": {  # rows 1-2 junk, row 3 header, rows 4-5 units
+        "read": {"header": 2, "skiprows": [3, 4]},
+        "columns": {"Year": 0, "Day": 1, "N2O": 35},  # N2O flux is column AJ
+    },
+}
+
+# Calibration target -> output file and column; "{depth}" is filled from the depth list
+OUTPUT_TARGETS = {
+    "Yield":        {"file": "Multi_year_summary.csv", "column": "Yield"},
+    "SoilTemp":     {"file": "Day_SoilClimate_1.csv", "column": "SoilTemp_{depth}",
+                     "depths": list(SOIL_TEMP_DEPTHS)},
+    "SoilMoisture": {"file": "Day_SoilClimate_1.csv", "column": "SoilMoisture_{depth}",
+                     "depths": list(SOIL_MOISTURE_DEPTHS)},
+    "ET":           {"file": "Day_Climate_1.csv", "column": "ET"},
+    "NEE":          {"file": "Day_SoilC_1.csv", "column": "NEE"},
+    "N2O":          {"file": "Day_SoilN_1.csv", "column": "N2O"},
+}
+
+_READ_KEYWORDS = {"skiprows", "header"}
+
+class OutputParser:
+    """A validated OUTPUT_SCHEMAS entry: read layout plus name -> position map.
+    parse() reads any set of its columns in one pass over the file."""
+
+    def __init__(self, name, schema):
+        read = dict(schema.get("read", {}))
+        unknown = set(read) - _READ_KEYWORDS
+        if unknown:
+            raise ValueError(f"{name}: unsupported read options {sorted(unknown)}")
+        columns = dict(schema.get("columns", {}))
+        for col, pos in columns.items():
+            if not isinstance(pos, int) or isinstance(pos, bool) or pos < 0:
+                raise ValueError(f"{name}: column '{col}' needs a non-negative integer position")
+        if columns.get("Year") != 0:
+            raise ValueError(f"{name}: Year must be column 0")
+        if "Day" in columns and columns["Day"] != 1:
+            raise ValueError(f"{name}: Day must be column 1")
+        taken = {}
+        for col, pos in columns.items():
+            if pos in taken:
+                raise ValueError(f"{name}: '{col}' and '{taken[pos]}' both map to column {pos}")
+            taken[pos] = col
+        self.name, self.read, self.columns = name, read, columns
+        self.time = ["Year", "Day"] if "Day" in columns else ["Year"]
+
+    @property
+    def daily(self):
+        return len(self.time) == 2
+
+    def parse(self, path, fields, window=None):
+        """Year[, Day] plus the named fields of path (numeric; rows without a date dropped)."""
+        missing = [f for f in fields if f not in self.columns]
+        if missing:
+            raise KeyError(f"{self.name} has no column {', '.join(missing)}")
+        names = self.time + [f for f in dict.fromkeys(fields) if f not in self.time]
+        df = read_output_table(path, [self.columns[n] for n in names], window)
+        df.columns = names
+        df = df.apply(pd.to_numeric, errors='coerce').dropna(subset=self.time)
+        df[self.time] = df[self.time].astype(int)
+        return df.reset_index(drop=True)
+
+_OUTPUT_PARSERS = {}
+
+def register_output_schemas(settings=None):
+    """Compile OUTPUT_SCHEMAS (plus settings["output_schemas"]) and add the
+    settings["output_targets"] entries. Invalid entries raise ValueError."""
+    settings = settings or {}
+    schemas = {**OUTPUT_SCHEMAS, **(settings.get("output_schemas") or {})}
+    parsers = {name: OutputParser(name, schema) for name, schema in schemas.items()}
+    targets = {**OUTPUT_TARGETS, **(settings.get("output_targets") or {})}
+    for target, spec in targets.items():
+        parser = parsers.get(spec.get("file"))
+        if parser is None:
+            raise ValueError(f"Target {target}: unknown output file {spec.get('file')!r}")
+        for depth in spec.get("depths") or [None]:
+            column = spec["column"].format(depth=depth) if depth else spec["column"]
+            if column not in parser.columns:
+                raise ValueError(f"Target {target}: {parser.name} has no column {column!r}")
+    OUTPUT_SCHEMAS.update(schemas)
+    OUTPUT_TARGETS.update(targets)
+    _OUTPUT_PARSERS.clear()
+    _OUTPUT_PARSERS.update(parsers)
+    TARGET_VARIABLES[:] = list(targets)
+    return parsers
+
+def output_schema_settings():
+    """The schemas and targets registered in this process, as settings for
+    register_output_schemas. Process pools pass them to their initializer: spawned
+    children (Windows) never run the __main__ block that registers the user's schemas."""
+    return {"output_schemas": dict(OUTPUT_SCHEMAS), "output_targets": dict(OUTPUT_TARGETS)}
+
+def output_parser(name):
+    if not _OUTPUT_PARSERS:
+        register_output_schemas()
+    return _OUTPUT_PARSERS.get(name)
+
+def target_depths(target_var):
+    """Depth choices for target_var ([] if it has none)."""
+    return list(OUTPUT_TARGETS.get(target_var, {}).get("depths") or [])
+
+def target_field(target_var, depth=None):
+    """(output file, column name) target_var is read from.
+    Depths are names ("10cm"), centimetres (10) or, for old callers, column positions."""
+    spec = OUTPUT_TARGETS.get(target_var)
+    if spec is None:
+        raise ValueError(f"Unknown target '{target_var}'")
+    depths = spec.get("depths")
+    if not depths:
+        return spec["file"], spec["column"]
+    if isinstance(depth, (int, float)) and not isinstance(depth, bool):
+        cm = f"{int(depth)}cm"
+        if cm not in depths:
+            parser = output_parser(spec["file"])
+            cm = next((d for d in depths if parser.columns.get(spec["column"].format(depth=d)) == int(depth)), None)
+        depth = cm
+    if depth not in depths:
+        raise ValueError(f"Invalid depth '{depth}' for {target_var}")
+    return spec["file"], spec["column"].format(depth=depth)
+
+def target_is_daily(target_var):
+    parser = output_parser(OUTPUT_TARGETS.get(target_var, {}).get("file"))
+    return parser is None or parser.daily
+
+def read_targets(requests, modeled_paths, window=None):
+    """Modeled series for several (target_var, depth) pairs, parsing each output
+    file once. Returns {(target_var, depth): DataFrame[Year, (Day,) <target>_MOD]}."""
+    by_file = {}
+    for target_var, depth in requests:
+        name, column = target_field(target_var, depth)
+        by_file.setdefault(name, []).append((target_var, depth, column))
+    out = {}
+    for name, wanted in by_file.items():
+        parser = output_parser(name)
+        table = parser.parse(modeled_paths[name], [c for _, _, c in wanted], window)
+        for target_var, depth, column in wanted:
+            out[(target_var, depth)] = table[parser.time + [column]].rename(
+                columns={column: f"{target_var}_MOD"})
+    return out
+
+
+# =====================================================================
+#  COLUMNAR OUTPUT CACHE
+#  Optional binary copy of a run's DNDC CSVs: one .npy per column plus a
+#  manifest, loaded with memory mapping so readers touch only the columns
+#  they need instead of re-tokenising the text.
+# =====================================================================
+COLUMNAR_DIR = "columnar"
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def convert_outputs_to_columnar(run_dir):
+    """Write columnar/<file>/cNNN.npy + columnar/manifest.json for the CSVs in run_dir.
+    Returns the number of files converted."""
+    col_root = os.path.join(run_dir, COLUMNAR_DIR)
+    manifest_path = os.path.join(col_root, "manifest.json")
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    converted = 0
+    for name, schema in OUTPUT_SCHEMAS.items():
+        layout = schema.get("read", {})
+        src = os.path.join(run_dir, name)
+        if not os.path.exists(src):
+            continue
+        stamp = _source_stamp(src)
+        if manifest.get(name, {}).get("source") == stamp:
+            continue
+        try:
+            df = pd.read_csv(src, low_memory=False, **layout)
+        except Exception as e:
+            log_message(f"  ⚠ Columnar: skipped {name}: {e}", logging.DEBUG)
+            continue
+        table_dir = os.path.join(col_root, os.path.splitext(name)[0])
+        os.makedirs(table_dir, exist_ok=True)
+        dtypes = []
+        for i in range(df.shape[1]):
+            col = df.iloc[:, i]
+            arr = col.to_numpy() if col.dtype.kind in "iufb" else col.astype(str).to_numpy(dtype=str)
+            np.save(os.path.join(table_dir, f"c{i:03d}.npy"), arr)
+            dtypes.append(arr.dtype.str)
+        manifest[name] = {"columns": [c if isinstance(c, str) else int(c) for c in df.columns],
+                          "dtypes": dtypes, "rows": int(len(df)), "source": stamp}
+        converted += 1
+    if converted:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    return converted
+
+def _load_columnar(path, columns):
+    """Memory-mapped columns of path from its columnar copy, or None if there is no fresh copy."""
+    run_dir, name = os.path.split(path)
+    manifest_path = os.path.join(run_dir, COLUMNAR_DIR, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            entry = json.load(f).get(name)
+        if not entry or entry["source"] != _source_stamp(path):
+            return None
+        names = entry["columns"]
+        for i in columns:
+            if i >= len(names):
+                raise IndexError(f"Column {i} out of range")
+        table_dir = os.path.join(run_dir, COLUMNAR_DIR, os.path.splitext(name)[0])
+        return pd.DataFrame({names[i]: np.load(os.path.join(table_dir, f"c{i:03d}.npy"), mmap_mode='r')
+                             for i in columns}, columns=[names[i] for i in columns])
+    except (OSError, ValueError, KeyError):
+        return None
+
+READ_CHUNK_ROWS = 3650  # ten years of daily rows per parsed chunk
+
+def observation_window(observed_df):
+    """((first_year, first_day), (last_year, last_day)) covered by observed_df, or None.
+    Days are None for annual observations."""
+    if observed_df is None or observed_df.empty:
+        return None
+    year = pd.to_numeric(observed_df['Year'], errors='coerce')
+    if 'Day' not in observed_df.columns:
+        return ((int(year.min()), None), (int(year.max()), None)) if year.notna().any() else None
+    key = (year * 1000 + pd.to_numeric(observed_df['Day'], errors='coerce')).dropna()
+    if key.empty:
+        return None
+    return ((int(key.min() // 1000), int(key.min() % 1000)), (int(key.max() // 1000), int(key.max() % 1000)))
+
+def _window_mask(df, window, day_pos):
+    """Rows of df (Year first, Day at day_pos) inside window, and the parsed years."""
+    (y0, d0), (y1, d1) = window
+    year = pd.to_numeric(df.iloc[:, 0], errors='coerce')
+    if day_pos is None or d0 is None:
+        return (year >= y0) & (year <= y1), year
+    key = year * 1000 + pd.to_numeric(df.iloc[:, day_pos], errors='coerce')
+    return (key >= y0 * 1000 + d0) & (key <= y1 * 1000 + d1), year
+
+def read_output_table(path, columns, window=None):
+    """Positional columns of a DNDC output file, preferring its columnar copy.
+    With an observation window (see observation_window), only rows inside it are
+    kept and the CSV is streamed in chunks, stopping once past the last observed year."""
+    day_pos = columns.index(1) if 1 in columns and columns[0] == 0 else None
+    if window is not None and columns[0] != 0:
+        window = None  # the filter needs Year in front
+    df = _load_columnar(path, columns)
+    if df is not None:
+        if window is not None:
+            df = df[_window_mask(df, window, day_pos)[0].to_numpy()].reset_index(drop=True)
+        return df
+    layout = OUTPUT_SCHEMAS.get(os.path.basename(path), {}).get("read", {})
+    wanted = sorted(set(columns))
+    order = [wanted.index(i) for i in columns]
+    try:
+        if window is None:
+            return pd.read_csv(path, usecols=wanted, **layout).iloc[:, order]
+        parts = []
+        with pd.read_csv(path, usecols=wanted, chunksize=READ_CHUNK_ROWS, **layout) as reader:
+            for chunk in reader:
+                chunk = chunk.iloc[:, order]
+                mask, year = _window_mask(chunk, window, day_pos)
+                parts.append(chunk[mask])
+                if year.max() > window[1][0]:
+                    break  # DNDC writes years in order; the rest is after the observations
+        return pd.concat(parts, ignore_index=True)
+    except ValueError as e:
+        if "usecols" in str(e).lower():
+            raise IndexError(f"Column {max(wanted)} out of range") from e
+        raise
+
+
+# =====================================================================
+#  DATA READING FUNCTIONS
+# =====================================================================
+def read_observed_data(target_var, observed_csv):
+    """Observed Year[, Day], <target>_OBS series (numeric, incomplete rows dropped)."""
+    try:
+        if not check_file_exists(observed_csv):
+            return pd.DataFrame()
+        obs_col = f"{target_var}_OBS"
+        if not target_is_daily(target_var):
+            observed_df = pd.read_csv(observed_csv, skiprows=2, usecols=[0, 1],
+                                      names=['Year', obs_col], header=None)
+        else:
+            observed_df = pd.read_csv(observed_csv, skiprows=2, header=None,
+                                      usecols=[0, 1, 2], names=['Year', 'Day', obs_col])
+            observed_df['Day'] = pd.to_numeric(observed_df['Day'], errors='coerce')
+        observed_df['Year'] = pd.to_numeric(observed_df['Year'], errors='coerce')
+        observed_df[obs_col] = pd.to_numeric(observed_df[obs_col], errors='coerce')
+        return observed_df.dropna()
+    except Exception as e:
+        log_message(f"✗ Observed read error: {e}")
+        return pd.DataFrame()
+
+def read_target_data(target_var, modeled_paths, observed_csv, depth=None, windowed=True):
+    """Modeled and observed series for target_var. Returns (modeled_df, observed_df).
+    windowed=True parses only the modeled rows inside the observed (Year, Day) span."""
+    try:
+        name, _ = target_field(target_var, depth)
+        if not check_file_exists(modeled_paths[name]) or not check_file_exists(observed_csv):
+            return pd.DataFrame(), pd.DataFrame()
+        observed_df = read_observed_data(target_var, observed_csv)
+        window = observation_window(observed_df) if windowed else None
+        modeled_df = read_targets([(target_var, depth)], modeled_paths, window)[(target_var, depth)]
+        return modeled_df.dropna(), observed_df
+    except Exception as e:
+        log_message(f"✗ {target_var} read error{f' at {depth}' if depth else ''}: {e}")
+        return pd.DataFrame(), pd.DataFrame()
+
+
+# =====================================================================
+#  OBSERVATION INGESTION (half-hourly flux-tower files)
+# =====================================================================
+# Per-target defaults: candidate value columns, conversion of one record to the
+# DNDC daily unit, and how records are combined into a day.
+FLUX_PRESETS = {
+    # µmol CO2 m-2 s-1 over 30 min → kg C/ha
+    "NEE": {"columns": ["NEE_VUT_REF", "NEE_CUT_REF", "NEE_F", "NEE", "FC"],
+            "scale": 1800 * 12.011e-6 * 10, "how": "sum"},
+    # W m-2 latent heat over 30 min → mm; an ET column is already mm per record
+    "ET":  {"columns": ["ET", "LE_F_MDS", "LE_CORR", "LE"],
+            "scale": 1800 / 2.45e6, "column_scales": {"ET": 1.0}, "how": "sum"},
+    # nmol N2O m-2 s-1 over 30 min → kg N/ha
+    "N2O": {"columns": ["FN2O", "N2O_FLUX", "N2O"],
+            "scale": 1800 * 28.013e-9 * 10, "how": "sum"},
+    "SoilTemp":     {"columns": ["TS_1", "TS_F_MDS_1", "TS"], "scale": 1.0, "how": "mean"},
+    "SoilMoisture": {"columns": ["SWC_1", "SWC_F_MDS_1", "SWC"], "scale": 0.01, "how": "mean"},
+}
+FLUX_TIME_COLUMNS = ["TIMESTAMP_START", "TIMESTAMP_END", "TIMESTAMP", "DATETIME", "DATE_TIME"]
+
+def _flux_header_row(path, max_lines=20):
+    """Index of the header line of a flux file, or None if path is a daily Year,Day,Value CSV."""
+    with open(path, 'r', errors='replace') as f:
+        for i, line in enumerate(itertools.islice(f, max_lines)):
+            tokens = {t.strip().strip('"').upper() for t in line.split(",")}
+            if tokens & set(FLUX_TIME_COLUMNS) or {"YEAR", "DOY", "HOUR"} <= tokens:
+                return i
+    return None
+
+def _file_digest(path, block=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _flux_days(chunk, time_col):
+    """(Year, Day-of-year) arrays for a chunk of half-hourly records."""
+    if time_col is None:
+        return (pd.to_numeric(chunk["YEAR"], errors='coerce').to_numpy(),
+                pd.to_numeric(chunk["DOY"], errors='coerce').to_numpy())
+    raw = chunk[time_col]
+    if time_col.startswith("TIMESTAMP_") or pd.api.types.is_numeric_dtype(raw):
+        stamp = pd.to_datetime(raw.astype("Int64").astype(str), format="%Y%m%d%H%M", errors='coerce')
+    else:
+        stamp = pd.to_datetime(raw, errors='coerce')
+    if time_col == "TIMESTAMP_END":
+        stamp = stamp - pd.Timedelta(minutes=1)  # 00:00 end stamps belong to the day before
+    return stamp.dt.year.to_numpy(dtype=float), stamp.dt.dayofyear.to_numpy(dtype=float)
+
+def aggregate_flux_file(source, target_var, value_column=None, scale=None, how=None,
+                        min_coverage=0.8, missing=-9999, chunksize=200_000):
+    """Stream a half-hourly file and return daily Year, Day, Value, Coverage.
+    Days with less than min_coverage of their records are dropped; gaps in the
+    kept days are filled with the day's mean before summing."""
+    preset = FLUX_PRESETS.get(target_var, {"columns": [], "scale": 1.0, "how": "mean"})
+    how = how or preset["how"]
+    header = _flux_header_row(source)
+    if header is None:
+        raise ValueError(f"{os.path.basename(source)}: no timestamp column found")
+
+    columns = [c.strip().strip('"') for c in
+               pd.read_csv(source, skiprows=header, nrows=0).columns]
+    upper = {c.upper(): c for c in columns}
+    value_column = value_column or next((c for c in preset["columns"] if c in upper), None)
+    if value_column is None or value_column.upper() not in upper:
+        raise ValueError(f"{os.path.basename(source)}: no {target_var} column "
+                         f"(tried {', '.join(preset['columns'])}); set flux_value_column")
+    if scale is None:
+        scale = preset.get("column_scales", {}).get(value_column.upper(), preset["scale"])
+    scale = float(scale)
+    time_col = next((c for c in FLUX_TIME_COLUMNS if c in upper), None)
+    wanted = [upper[value_column.upper()]] + ([upper[time_col]] if time_col else [upper["YEAR"], upper["DOY"]])
+
+    partial = []
+    for chunk in pd.read_csv(source, skiprows=header, usecols=wanted, chunksize=chunksize,
+                             na_values=[missing, str(missing)], low_memory=False):
+        chunk.columns = [c.strip().strip('"').upper() for c in chunk.columns]
+        year, day = _flux_days(chunk, time_col)
+        value = pd.to_numeric(chunk[value_column.upper()], errors='coerce').to_numpy(dtype=float) * scale
+        df = pd.DataFrame({"Year": year, "Day": day, "Sum": value,
+                           "Valid": np.isfinite(value).astype(int), "Records": 1})
+        df = df.dropna(subset=["Year", "Day"])
+        partial.append(df.groupby(["Year", "Day"], sort=False)[["Sum", "Valid", "Records"]].sum())
+        # Fold the partial sums now and then so memory stays bounded by the number of days
+        if len(partial) >= 16:
+            partial = [pd.concat(partial).groupby(level=[0, 1]).sum()]
+    if not partial:
+        return pd.DataFrame(columns=["Year", "Day", "Value", "Coverage"])
+
+    daily = pd.concat(partial).groupby(level=[0, 1]).sum().reset_index()
+    per_day = float(daily["Records"].median())  # 48 for half-hourly, 24 for hourly
+    daily["Coverage"] = daily["Valid"] / per_day
+    daily = daily[(daily["Valid"] > 0) & (daily["Coverage"] >= min_coverage)].copy()
+    mean = daily["Sum"] / daily["Valid"]
+    daily["Value"] = mean * per_day if how == "sum" else mean
+    daily["Year"] = daily["Year"].astype(int)
+    daily["Day"] = daily["Day"].astype(int)
+    return daily[["Year", "Day", "Value", "Coverage"]].sort_values(["Year", "Day"]).reset_index(drop=True)
+
+def prepare_observations(target_var, observed_csv, cache_dir, settings=None):
+    """Path of a daily Year,Day,Value CSV for observed_csv.
+    Daily files are returned unchanged; flux-tower files are aggregated once and
+    cached as .npz keyed by the file's hash and the aggregation settings."""
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if not target_is_daily(target_var) or not os.path.exists(observed_csv) or _flux_header_row(observed_csv) is None:
+        return observed_csv
+
+    options = {k: settings.get(k) for k in
+               ("flux_value_column", "flux_scale", "flux_aggregate", "flux_min_coverage", "flux_missing")}
+    os.makedirs(cache_dir, exist_ok=True)
+    # Hashing hundreds of MB takes a moment, so remember it per (path, size, mtime)
+    index_path = os.path.join(cache_dir, "index.json")
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    st = os.stat(observed_csv)
+    stamp = f"{os.path.abspath(observed_csv)}|{st.st_size}|{st.st_mtime_ns}"
+    digest = index.get(stamp)
+    if digest is None:
+        digest = _file_digest(observed_csv)
+        index[stamp] = digest
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=1)
+    key = hashlib.sha1(json.dumps([digest, target_var, options], sort_keys=True).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(observed_csv))[0]
+    npz_path = os.path.join(cache_dir, f"{stem}_{target_var}_{key}.npz")
+    csv_path = npz_path[:-4] + "_daily.csv"
+
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as data:
+            daily = pd.DataFrame({k: data[k] for k in ("Year", "Day", "Value", "Coverage")})
+        log_message(f"  ✓ Observations: {len(daily)} days from cache ({os.path.basename(npz_path)})")
+    else:
+        log_message(f"  Aggregating {os.path.basename(observed_csv)} to daily {target_var}...")
+        started = time.time()
+        daily = aggregate_flux_file(
+            observed_csv, target_var,
+            value_column=options["flux_value_column"], scale=options["flux_scale"],
+            how=options["flux_aggregate"],
+            min_coverage=float(options["flux_min_coverage"] if options["flux_min_coverage"] is not None else 0.8),
+            missing=options["flux_missing"] if options["flux_missing"] is not None else -9999)
+        np.savez_compressed(npz_path, Year=daily["Year"].to_numpy(np.int16),
+                            Day=daily["Day"].to_numpy(np.int16),
+                            Value=daily["Value"].to_numpy(np.float64),
+                            Coverage=daily["Coverage"].to_numpy(np.float32))
+        log_message(f"  ✓ Observations: {len(daily)} days kept in {time.time() - started:.1f}s, "
+                    f"cached as {os.path.basename(npz_path)}")
+
+    if not os.path.exists(csv_path):
+        with open(csv_path, 'w', newline='') as f:
+            f.write(f"Daily {target_var} from {os.path.basename(observed_csv)}\nYear,Day,{target_var}\n")
+            daily[["Year", "Day", "Value"]].to_csv(f, header=False, index=False)
+    return csv_path
+
+
+# =====================================================================
+#  METRICS
+# =====================================================================
+def calculate_metrics(y_true, y_pred):
+    from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+    from sklearn.linear_model import LinearRegression
+    r2 = r2_score(y_true, y_pred)
+    rmse = np.sqrt(mean_squared_error(y_true, y_pred))
+    mae = mean_absolute_error(y_true, y_pred)
+    mbe = np.mean(y_pred - y_true)
+    mean_obs = np.mean(y_true)
+    nrmse = (rmse / mean_obs * 100) if mean_obs != 0 else np.nan
+    try:
+        X = np.array(y_pred).reshape(-1, 1)
+        model = LinearRegression()
+        model.fit(X, y_true)
+        lr_r2 = model.score(X, y_true)
+    except Exception:
+        lr_r2 = np.nan
+    return {'R2': r2, 'LR_R2': lr_r2, 'RMSE': rmse, 'nRMSE': nrmse, 'MAE': mae, 'MBE': mbe}
+
+def match_and_evaluate(modeled_df, observed_df, target_var, yield_conversion_factor=0.4):
+    if modeled_df.empty or observed_df.empty:
+        return None, pd.DataFrame()
+    for col in ['Year', 'Day']:
+        if col in modeled_df.columns:
+            modeled_df[col] = modeled_df[col].astype(int)
+        if col in observed_df.columns:
+            observed_df[col] = observed_df[col].astype(int)
+    if target_var == "Yield" and 'Yield_MOD' in modeled_df.columns and yield_conversion_factor > 0:
+        modeled_df['Yield_MOD'] = modeled_df['Yield_MOD'] / yield_conversion_factor
+    merge_on = ['Year', 'Day'] if 'Day' in modeled_df.columns and 'Day' in observed_df.columns else ['Year']
+    merged_df = pd.merge(modeled_df, observed_df, on=merge_on, how='inner')
+    if merged_df.empty:
+        return None, pd.DataFrame()
+    observed_col = f"{target_var}_OBS"
+    merged_df.dropna(subset=[observed_col], inplace=True)
+    if merged_df.empty:
+        return None, pd.DataFrame()
+    metrics = calculate_metrics(merged_df[observed_col], merged_df[f"{target_var}_MOD"])
+    return metrics, merged_df
+
+
+# =====================================================================
+#  CHECKPOINT SAVING
+# =====================================================================
+def save_iteration_outputs(results_dir, iteration, dndc_record_dir, columnar=False):
+    """Copy the entire DNDC output folder for this iteration (plus a columnar copy if asked)."""
+    iter_dir = os.path.join(results_dir, "iteration_outputs", f"iter_{iteration:04d}")
+    try:
+        if os.path.exists(dndc_record_dir):
+            shutil.copytree(dndc_record_dir, iter_dir, dirs_exist_ok=True)
+            if columnar:
+                convert_outputs_to_columnar(iter_dir)
+    except Exception as e:
+        log_message(f"⚠ Failed to save iteration {iteration} outputs: {e}")
+
+
+# =====================================================================
+#  FEASIBILITY CONSTRAINTS
+#  Expressions over parameter names (e.g. "field_capacity > wilting_point",
+#  "frac_a + frac_b <= 1") checked before a .dnd is rendered, so physically
+#  impossible candidates never cost a DNDC run.
+# =====================================================================
+_CONSTRAINT_FUNCS = {"abs": abs, "min": min, "max": max, "log": np.log, "log10": np.log10,
+                     "exp": np.exp, "sqrt": np.sqrt}
+_CONSTRAINT_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub,
+                     ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+                     ast.Compare, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq,
+                     ast.Name, ast.Load, ast.Constant, ast.Call)
+
+def compile_constraints(expressions, param_names):
+    """[(text, code)] for constraint expressions; raises ValueError on anything but
+    arithmetic, comparisons, and/or/not, parameter names and a few math functions."""
+    compiled = []
+    for text in expressions:
+        text = str(text).strip()
+        if not text:
+            continue
+        tree = ast.parse(text, mode="eval")
+        for node in ast.walk(tree):
+            if not isinstance(node, _CONSTRAINT_NODES):
+                raise ValueError(f"Constraint '{text}': {type(node).__name__} not allowed")
+            if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name)
+                                                   and node.func.id in _CONSTRAINT_FUNCS):
+                raise ValueError(f"Constraint '{text}': only {', '.join(_CONSTRAINT_FUNCS)} may be called")
+            if isinstance(node, ast.Name) and node.id not in param_names and node.id not in _CONSTRAINT_FUNCS:
+                raise ValueError(f"Constraint '{text}': unknown parameter '{node.id}'")
+        compiled.append((text, compile(tree, "<constraint>", "eval")))
+    return compiled
+
+def gather_constraints(param_ranges_df, settings):
+    """Constraint expressions from the parameter CSV's optional 'constraint' column and settings."""
+    exprs = []
+    if "constraint" in param_ranges_df.columns:
+        exprs += [str(c) for c in param_ranges_df["constraint"] if isinstance(c, str) and c.strip()]
+    exprs += list(settings.get("constraints") or [])
+    return exprs
+
+def violated_constraints(params, constraints, param_names):
+    """Texts of the constraints params break (an expression that fails to evaluate counts as broken)."""
+    scope = {"__builtins__": {}, **_CONSTRAINT_FUNCS, **dict(zip(param_names, params))}
+    broken = []
+    for text, code in constraints:
+        try:
+            if not eval(code, scope):
+                broken.append(text)
+        except Exception:
+            broken.append(text)
+    return broken
+
+def repair_candidate(params, anchor, is_feasible, dimensions, steps=20):
+    """Feasible point closest to params on the segment towards a feasible anchor (bisection),
+    or None. Integers are rounded; categorical values switch to the anchor's half-way."""
+    from skopt.space import Integer, Categorical
+    if anchor is None:
+        return None
+
+    def _at(t):
+        point = []
+        for v, a, dim in zip(params, anchor, dimensions):
+            if isinstance(dim, Categorical):
+                point.append(v if t < 0.5 else a)
+            else:
+                x = float(v) + t * (float(a) - float(v))
+                point.append(int(round(x)) if isinstance(dim, Integer) else x)
+        return point
+
+    lo, hi = 0.0, 1.0  # t=1 is the anchor (feasible)
+    for _ in range(steps):
+        mid = (lo + hi) / 2
+        if is_feasible(_at(mid)):
+            hi = mid
+        else:
+            lo = mid
+    point = _at(hi)
+    return point if is_feasible(point) else None
+
+def _box_center(dimensions):
+    from skopt.space import Integer, Categorical
+    center = []
+    for dim in dimensions:
+        if isinstance(dim, Categorical):
+            center.append(dim.categories[0])
+        else:
+            mid = np.sqrt(dim.low * dim.high) if dim.prior == "log-uniform" else (dim.low + dim.high) / 2
+            center.append(int(round(mid)) if isinstance(dim, Integer) else float(mid))
+    return center
+
+def constraint_checker(param_ranges_df, settings, dimensions, anchors=()):
+    """Callable(params) -> (params to run or None, violated constraint texts), or None without constraints.
+    constraint_action "repair" moves infeasible candidates towards the first feasible anchor."""
+    names = param_ranges_df['parameter_name'].tolist()
+    constraints = compile_constraints(gather_constraints(param_ranges_df, settings), names)
+    if not constraints:
+        return None
+    action = str(settings.get("constraint_action") or "reject").lower()
+    is_feasible = lambda p: not violated_constraints(p, constraints, names)
+    anchor = next((a for a in anchors if a is not None and _in_bounds(a, dimensions) and is_feasible(a)), None)
+    log_message(f"  Constraints ({action}): " + "; ".join(t for t, _ in constraints))
+    if action == "repair" and anchor is None:
+        log_message("  ⚠ No feasible reference point for repairs; infeasible candidates will be rejected")
+
+    def check(params):
+        broken = violated_constraints(params, constraints, names)
+        if not broken:
+            return params, []
+        if action == "repair":
+            repaired = repair_candidate(params, anchor, is_feasible, dimensions)
+            if repaired is not None:
+                return repaired, broken
+        return None, broken
+    return check
+
+
+# =====================================================================
+#  PARALLEL EVALUATION
+#  Each worker slot owns a private copy of the .dnd, a batch file that
+#  points at it and its own DNDC output folder, so runs never collide.
+# =====================================================================
+INITIAL_DESIGNS = ["LHS", "Sobol", "Halton", "Random"]
+
+DEFAULT_SETTINGS = {
+    "iterations": 10,
+    "workers": max(1, (os.cpu_count() or 2) // 2),
+    "initial_design": "LHS",
+    "initial_points": 10,
+    # Multi-fidelity screening: successive halving on shortened simulations
+    "multi_fidelity": False,
+    "fidelity_eta": 3,              # keep the best 1/eta at each rung
+    "fidelity_rungs": 2,            # number of reduced-length rungs before full runs
+    "fidelity_years_line": None,    # .dnd line of Simulated_years (auto-detected if None)
+    "use_cache": True,              # reuse parsed output of identical simulations
+    # Uncertainty quantification (Mode = GLUE / DREAM); Iterations = DNDC run budget
+    "mode": "Calibrate",
+    "glue_threshold": 0.5,          # behavioural runs: NSE (R²) at or above this
+    "dream_chains": None,           # default: max(3, workers)
+    # Distributed evaluation: serve jobs to remote workers instead of running DNDC locally
+    "broker_port": None,
+    "broker_host": "127.0.0.1",     # "0.0.0.0" to accept workers on other machines (needs a token)
+    "broker_token": None,           # shared secret workers send (worker --token); required off-loopback
+    "broker_lease_timeout": 60,     # seconds without a heartbeat before a job is re-queued
+    "broker_lease_wait": 120,       # seconds a job may wait for a worker before it runs locally (0 = forever)
+    "broker_job_timeout": 3600,     # seconds before a leased job is given up and retried (0 = never)
+    # Screen log level for parallel workers ("DEBUG" shows every DNDC run); per worker:
+    # {"worker 0": "DEBUG"}. The full log always goes to <root>/logs/calibration-<pid>.log
+    "worker_log_level": "INFO",
+    "worker_log_levels": {},
+    # Early stopping (None = off). Tolerances are fractions of the best RMSE so far
+    "converge_tol": None,           # stop when the best RMSE improved less than this ...
+    "converge_patience": 10,        # ... over this many iterations
+    "ei_threshold": None,           # stop when the best expected improvement falls below this
+    "time_budget_hours": None,      # wall-clock budget for the optimization
+    "deadline": None,               # "HH:MM" — finish by this time of day (next occurrence)
+    "cpu_hours_budget": None,       # total DNDC run time over all workers
+    # Half-hourly flux-tower observations (None = FLUX_PRESETS default for the target)
+    "flux_value_column": None,
+    "flux_scale": None,             # multiplier turning one record into the daily unit
+    "flux_aggregate": None,         # "sum" or "mean"
+    "flux_min_coverage": 0.8,       # fraction of a day's records that must be valid
+    "flux_missing": -9999,
+    # Keep a memory-mappable columnar copy of each saved iteration's outputs
+    "columnar_outputs": False,
+    # Feasibility constraints over parameter names, e.g. ["fc > wp", "frac_a + frac_b <= 1"]
+    # (also read from a 'constraint' column in the parameter CSV)
+    "constraints": [],
+    "constraint_action": "reject",  # "reject" (tell the optimizer, no DNDC run) or "repair"
+    # Failed runs: transient failures (timeouts, locked files, network) are retried elsewhere;
+    # the optimizer skips candidates the failure model thinks will crash with this probability
+    "retry_attempts": 2,
+    "failure_skip_probability": 0.8,
+    # Year-split validation of the top candidates after calibrating (None = off)
+    "validation": None,             # "kfold" or "rolling"
+    "validation_folds": 5,
+    "validation_top_k": 10,
+    # Scratch workspaces: DNDC output + rendered .dnd on a RAM disk / tmpfs (None = on disk)
+    "scratch_dir": None,            # e.g. "R:\\" (RAM disk) or "auto" (/dev/shm)
+    "scratch_max_mb": 2048,         # above this the next run uses the disk workspace
+    "scratch_min_free_mb": 256,
+    # Calibration queue runner (python caln.py queue run)
+    "machine_slots": None,          # DNDC runs at once over all queued jobs (None = CPU count)
+    "queue_max_jobs": None,         # calibrations at once (None = machine_slots)
+    # Extra DNDC output files / calibration targets, merged into OUTPUT_SCHEMAS / OUTPUT_TARGETS
+    "output_schemas": {},           # {"Day_FieldCrop_1.csv": {"read": {...}, "columns": {"Year": 0, "Day": 1, ...}}}
+    "output_targets": {},           # {"Biomass": {"file": "Day_FieldCrop_1.csv", "column": "Biomass"}}
+    # Output minimization: "-daily 0" for annual targets, run outputs deleted once parsed
+    # (save_iter_results always gets the full output, for offline re-scoring)
+    "minimal_outputs": True,
+    # Metrics export (OpenMetrics): iterations, best RMSE, run durations, failures, cache, queue
+    "metrics_port": None,           # e.g. 9101 → http://<host>:9101/metrics
+    "metrics_host": "127.0.0.1",    # "0.0.0.0" to expose /metrics to other machines (no authentication)
+    "metrics_textfile": None,       # e.g. "C:\\node_exporter\\textfile\\dndc.prom" (textfile collector)
+    "metrics_interval": 15,         # seconds between textfile updates
+    # Adaptive dimension reduction (GP): freeze parameters the fitted surrogate finds flat
+    "freeze_insensitive": False,
+    "freeze_after": 15,             # check every N optimizer iterations (after the initial design)
+    "freeze_length_scale": 10.0,    # ARD length scale, in parameter ranges, above which a parameter is flat
+    "freeze_keep": 2,               # never search fewer parameters than this
+    # Calibration catalog (SQLite) and transfer warm starts from similar earlier sites
+    "catalog": True,                # add every finished calibration to the catalog
+    "catalog_file": None,           # None = calibration_catalog.sqlite next to DNDC (can be on a shared drive)
+    "catalog_descriptors": None,    # .dnd keys that describe a site, e.g. ["Latitude", "Clay_fraction"] (None = all)
+    "warm_start": 0,                # seed the design with the best sets of the N most similar calibrations
+}
+
+SETTINGS_FILE = os.path.join(ROOT_FOLDER, "calibration_settings.json")
+
+def load_user_settings(path=SETTINGS_FILE):
+    """DEFAULT_SETTINGS overlaid with the optional JSON settings file."""
+    settings = dict(DEFAULT_SETTINGS)
+    try:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                settings.update(json.load(f))
+    except (OSError, ValueError) as e:
+        log_message(f"⚠ Ignoring {os.path.basename(path)}: {e}")
+    return settings
+
+def batch_dnd_refs(content):
+    """[(line index, path)] for the lines of DNDC batch text that name a .dnd file.
+    Each such line is one whole path, so folders with spaces stay intact."""
+    refs = []
+    for i, line in enumerate(content.splitlines()):
+        path = line.strip().strip('"')
+        if path.lower().endswith(".dnd"):
+            refs.append((i, path))
+    return refs
+
+def _batch_ref_is(ref, batch_file, dnd_file):
+    """Does a .dnd path from batch_file (relative to its folder) name dnd_file?"""
+    if not os.path.isabs(ref):
+        ref = os.path.join(os.path.dirname(os.path.abspath(batch_file)), ref)
+    try:
+        return os.path.samefile(ref, dnd_file)
+    except OSError:
+        return os.path.normcase(os.path.abspath(ref)) == os.path.normcase(os.path.abspath(dnd_file))
+
+def batch_dnd_ref(batch_file, dnd_file=None):
+    """(line index, path) of the one .dnd a batch file runs. ValueError if it lists none
+    or several (a multi-site batch cannot be calibrated), or, with dnd_file, another file."""
+    with open(batch_file, 'r') as f:
+        refs = batch_dnd_refs(f.read())
+    name = os.path.basename(batch_file)
+    if not refs:
+        raise ValueError(f"{name}: no .dnd file referenced")
+    if len(refs) > 1:
+        raise ValueError(f"{name} lists {len(refs)} .dnd files — use a batch file that runs only "
+                         f"the site being calibrated")
+    if dnd_file is not None and not _batch_ref_is(refs[0][1], batch_file, dnd_file):
+        raise ValueError(f"{name} runs {refs[0][1]}, not {dnd_file}")
+    return refs[0]
+
+def render_batch_file(batch_file, dnd_path, out_path, source_dnd=None):
+    """Copy a DNDC batch file with its .dnd line pointing at dnd_path
+    (see batch_dnd_ref for what the batch may contain)."""
+    index, _ = batch_dnd_ref(batch_file, source_dnd)
+    with open(batch_file, 'r') as f:
+        lines = f.read().splitlines(keepends=True)
+    line = lines[index]
+    indent = line[:len(line) - len(line.lstrip())]
+    quote = '"' if line.lstrip().startswith('"') else ''
+    lines[index] = indent + quote + dnd_path + quote + line[len(line.rstrip("\r\n")):]
+    with open(out_path, 'w') as f:
+        f.write("".join(lines))
+
+# ── Scratch workspaces: DNDC output on a RAM disk / tmpfs instead of the data disk ──
+SCRATCH_AUTO_DIRS = ["/dev/shm"]   # "scratch_dir": "auto"; on Windows name the RAM-disk folder
+SCRATCH_SUBDIR = "dndc_scratch"
+_scratch_owner_ids = itertools.count(1)
+
+def resolve_scratch_dir(setting):
+    """Writable scratch root for the "scratch_dir" setting, or None to stay on disk."""
+    if not setting:
+        return None
+    for base in (SCRATCH_AUTO_DIRS if setting == "auto" else [setting]):
+        path = os.path.join(base, SCRATCH_SUBDIR)
+        try:
+            os.makedirs(path, exist_ok=True)
+            probe = os.path.join(path, f".probe_{os.getpid()}")
+            with open(probe, 'w') as f:
+                f.write("ok")
+            os.remove(probe)
+            return path
+        except OSError:
+            continue
+    log_message(f"⚠ Scratch folder {setting!r} is not usable — DNDC output stays on disk")
+    return None
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+class ScratchSpace:
+    """Capped scratch area for slot workspaces, shared by every calibration of a process
+    (the queue runner hands one to all its jobs). Each calibration owns a folder of
+    slot workspaces; usage is tracked per (folder, slot). A run goes to scratch only if
+    the output all other workspaces still hold plus the largest run seen so far stays
+    under max_mb and leaves min_free_mb free; otherwise that run uses the disk workspace."""
+
+    def __init__(self, root, max_mb=2048, min_free_mb=256):
+        self.root = root
+        self.max_bytes = float(max_mb) * 2 ** 20
+        self.min_free = float(min_free_mb) * 2 ** 20
+        self.run_bytes = 0
+        self._fallbacks = {}
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def fits(self, base, slot):
+        key = (base, slot)
+        with self._lock:
+            others = sum(b for k, b in self._usage.items() if k != key)
+            need = self.run_bytes
+            held = self._usage.get(key, 0)
+        try:
+            free = shutil.disk_usage(self.root).free + held
+        except OSError:
+            return False
+        ok = others + need <= self.max_bytes and free - need >= self.min_free
+        if not ok:
+            with self._lock:
+                self._fallbacks[base] = self._fallbacks.get(base, 0) + 1
+        return ok
+
+    def owner_dir(self, workers_dir):
+        """A new folder for one calibration's slot workspaces (under a hash of its
+        workers folder, plus a per-calibration id so concurrent jobs never share one)."""
+        key = hashlib.sha1(os.path.abspath(workers_dir).encode("utf-8")).hexdigest()[:10]
+        return os.path.join(self.root, key, f"{os.getpid()}_{next(_scratch_owner_ids)}")
+
+    def record(self, base, slot, ws_dir):
+        size = _dir_size(ws_dir)
+        with self._lock:
+            self._usage[(base, slot)] = size
+            self.run_bytes = max(self.run_bytes, size)
+
+    def release(self, base, slot):
+        """Drop a slot's scratch copy (its next run goes to disk)."""
+        shutil.rmtree(os.path.join(base, f"slot_{slot:02d}"), ignore_errors=True)
+        with self._lock:
+            self._usage.pop((base, slot), None)
+
+    def release_all(self, base):
+        """Delete one calibration's scratch folder; returns how many of its runs fell back to disk."""
+        shutil.rmtree(base, ignore_errors=True)
+        with self._lock:
+            for key in [k for k in self._usage if k[0] == base]:
+                del self._usage[key]
+            return self._fallbacks.pop(base, 0)
+
+    def low_on_space(self):
+        try:
+            return shutil.disk_usage(self.root).free < self.min_free
+        except OSError:
+            return True
+
+def make_scratch_space(settings):
+    root = resolve_scratch_dir(settings.get("scratch_dir"))
+    if root is None:
+        return None
+    return ScratchSpace(root, settings.get("scratch_max_mb") or 2048, settings.get("scratch_min_free_mb") or 256)
+
+def make_workspace(paths, batch_file, dnd_file, slot, workers_dir=None):
+    """Prepare (or reuse) the private run folder for a worker slot
+    (under workers_dir if given, e.g. a scratch folder, else paths["workers_dir"])."""
+    base = os.path.join(workers_dir or paths["workers_dir"], f"slot_{slot:02d}")
+    output_dir = os.path.join(base, "output")
+    ws = {
+        "dir": base,
+        "dnd_file": os.path.join(base, os.path.basename(dnd_file)),
+        "batch_file": os.path.join(base, os.path.basename(batch_file)),
+        "output_dir": output_dir,
+        "batch_record_root": os.path.join(output_dir, "Record", "Batch"),
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    render_batch_file(batch_file, ws["dnd_file"], ws["batch_file"], dnd_file)
+    # Clear the previous run so folder detection cannot pick up stale output
+    shutil.rmtree(ws["batch_record_root"], ignore_errors=True)
+    return ws
+
+def read_current_values(lines, param_ranges_df):
+    """Parameter values as currently written in the .dnd lines; a value that is
+    missing or does not convert reads as 0.0 (with a warning naming the parameter)."""
+    values = []
+    for i, (_, row) in enumerate(param_ranges_df.iterrows()):
+        line_idx = int(row['line_number'])
+        try:
+            parts = lines[line_idx].strip().split()
+            text = parts[1] if len(parts) >= 2 else 0.0
+        except IndexError:
+            text = 0.0
+        try:
+            values.extend(coerce_parameter_values([text], param_ranges_df.iloc[[i]]))
+        except (TypeError, ValueError):
+            log_message(f"⚠ {row['parameter_name']}: '{text}' on line {line_idx} is not a valid "
+                        f"value; using 0.0", logging.WARNING)
+            values.append(0.0)
+    return values
+
+def dnd_input_files(dnd_lines):
+    """Existing files a .dnd names by path (climate, management, ... inputs)."""
+    found = []
+    for line in dnd_lines:
+        parts = line.strip().split(None, 1)
+        if len(parts) < 2:
+            continue
+        value = parts[1].strip().strip('"')
+        for candidate in [value] + value.split():
+            if ("/" in candidate or "\\" in candidate) and os.path.isfile(candidate):
+                found.append(candidate)
+                break
+    return found
+
+def file_fingerprint(path):
+    """path|size|mtime, so edits to an input file change every key built from it."""
+    try:
+        st = os.stat(path)
+        return f"{os.path.normcase(os.path.abspath(path))}|{st.st_size}|{st.st_mtime_ns}"
+    except OSError:
+        return f"{path}|missing"
+
+class SimulationCache:
+    """Parsed DNDC output keyed by the exact simulation inputs (rendered .dnd + batch,
+    the input files the .dnd names and the DNDC executable).
+    Kept in memory and as one pickle per simulation under sim_cache/, so repeated
+    candidates — in this run or a later one for the same site — skip DNDC."""
+    def __init__(self, cache_dir, max_memory=512):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(batch_file, dnd_lines, dndc_exe=None):
+        with open(batch_file, 'r') as f:
+            batch = f.read().splitlines()
+        for index, _ in batch_dnd_refs("\n".join(batch)):
+            batch[index] = "<dnd>"
+        batch = "\n".join(batch)
+        h = hashlib.sha1(batch.encode("utf-8"))
+        h.update("".join(dnd_lines).encode("utf-8"))
+        for path in dnd_input_files(dnd_lines) + ([dndc_exe] if dndc_exe else []):
+            h.update(file_fingerprint(path).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _load(self, key):
+        entry = self._memory.get(key)
+        if entry is None and os.path.exists(self._path(key)):
+            try:
+                entry = pd.read_pickle(self._path(key))
+            except Exception:
+                entry = None
+        if entry is not None:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory:
+                self._memory.popitem(last=False)
+        return entry
+
+    def get(self, key, target_key):
+        """Cached modeled frame for target_key, or None."""
+        with self._lock:
+            entry = self._load(key)
+            df = entry.get(target_key) if entry else None
+            if df is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return df.copy()
+
+    def put(self, key, target_key, modeled_df):
+        with self._lock:
+            entry = dict(self._load(key) or {})
+            entry[target_key] = modeled_df.copy()
+            self._memory[key] = entry
+            tmp = self._path(key) + f".{threading.get_ident()}.tmp"
+            try:
+                pd.to_pickle(entry, tmp)
+                os.replace(tmp, self._path(key))
+            except Exception as e:
+                log_message(f"⚠ Cache write failed: {e}")
+
+def target_cache_key(target_var, depth, window=None):
+    """Key of one target's modeled frame inside a SimulationCache entry
+    (a windowed frame only serves the same observation window)."""
+    key = f"{target_var}@{depth or ''}"
+    return key if window is None else f"{key}#{window}"
+
+def cache_extra_targets(cache, sim_key, modeled_paths, extras):
+    """Also cache, from the same run, the series later pipeline stages calibrate against."""
+    for target_var, depth, window, target_key in extras:
+        if not os.path.exists(modeled_paths[target_field(target_var, depth)[0]]):
+            continue
+        try:
+            modeled_df = read_targets([(target_var, depth)], modeled_paths, window)[(target_var, depth)]
+        except Exception as e:
+            log_message(f"  ⚠ {target_var} not cached: {e}", logging.DEBUG)
+            continue
+        if not modeled_df.empty:
+            cache.put(sim_key, target_key, modeled_df.dropna())
+
+def make_eval_context(param_ranges_df, lines, target_var, depth, paths, batch_file, dnd_file,
+                      observed_csv, save_dnd_backups, save_iter_results, settings):
+    """Everything evaluate_candidate needs, bundled once per calibration."""
+    batch_dnd_ref(batch_file, dnd_file)  # a multi-site batch fails here, not on every run
+    use_cache = settings.get("use_cache", True)
+    set_log_root(paths["root_folder"])
+    dimensions = build_search_space(param_ranges_df)
+    constraints = constraint_checker(param_ranges_df, settings, dimensions,
+                                     anchors=(read_current_values(lines, param_ranges_df),
+                                              _box_center(dimensions)))
+    slot_pool = settings.get("slot_pool")
+    if slot_pool is not None:
+        # Queued jobs run in the machine-wide slots, apart from calibrations started in the UI
+        paths = {**paths, "workers_dir": os.path.join(paths["output_dir"], "queue_slots")}
+    # (target, depth, observed) of later pipeline stages, cached from this calibration's runs too
+    cache_also = [(t, d, obs) for t, d, obs in (settings.get("cache_also") or ()) if use_cache
+                  and (t, d) != (target_var, depth) and os.path.exists(obs)]
+    minimal = bool(settings.get("minimal_outputs", True))
+    daily_output = (not minimal or save_iter_results
+                    or any(target_is_daily(t) for t in [target_var] + [c[0] for c in cache_also]))
+    if not daily_output:
+        log_message(f"  DNDC daily output off ({target_var} is annual)", logging.DEBUG)
+    if save_iter_results and settings.get("broker_port"):
+        log_message("  ⚠ Iteration outputs are not saved for runs on remote workers")
+    start_metrics_exporter(settings)
+    scratch = settings.get("scratch_space") or make_scratch_space(settings)
+    return {
+        "metrics": METRICS.begin(site=os.path.basename(paths["results_dir"]), target=target_var,
+                                 depth=depth, job=settings.get("queue_job")),
+        "slot_pool": slot_pool,
+        "cancel_event": settings.get("cancel_event"),
+        "log_levels": worker_log_levels(settings),
+        "daily_output": daily_output, "prune_outputs": minimal,
+        "cache_also": [(t, d, window, target_cache_key(t, d, window)) for t, d, obs in cache_also
+                       for window in [observation_window(read_observed_data(t, obs))]],
+        "constraints": constraints,
+        "obs_window": observation_window(read_observed_data(target_var, observed_csv)),
+        "lines": lines, "param_ranges_df": param_ranges_df,
+        "target_var": target_var, "depth": depth, "paths": paths,
+        "batch_file": batch_file, "dnd_file": dnd_file, "observed_csv": observed_csv,
+        "save_dnd_backups": save_dnd_backups, "save_iter_results": save_iter_results,
+        "cache": SimulationCache(paths["cache_dir"]) if use_cache else None,
+        "broker": start_broker(settings),
+        "columnar_outputs": bool(settings.get("columnar_outputs")),
+        "scratch": scratch,
+        "scratch_base": scratch.owner_dir(paths["workers_dir"]) if scratch is not None else None,
+        "retry_attempts": int(settings.get("retry_attempts", 2)),
+        "broker_lease_wait": float(settings.get("broker_lease_wait") or 0),
+        "broker_job_timeout": float(settings.get("broker_job_timeout") or 0),
+        "failure_skip_probability": float(settings.get("failure_skip_probability", 0.8)),
+        "failure_model": FailureModel(dimensions) if dimensions else None,
+    }
+
+def evaluate_candidate(params, ctx, slot=0, iteration=None):
+    """Run DNDC once for params in the given worker slot and score the output.
+    params=None runs the .dnd unmodified. Returns an all_results-style dict.
+    Candidates already in the simulation cache are scored without running DNDC."""
+    paths = ctx["paths"]
+    check = ctx.get("constraints")
+    if params is not None and check is not None:
+        feasible, broken = check(list(params))
+        if feasible is None:
+            return {"Iteration": iteration, "Parameters": list(params), "Metrics": None,
+                    "Merged_Data": pd.DataFrame(), "Elapsed": 0.0, "Slot": slot,
+                    "Error": "infeasible", "Infeasible": True, "Violations": broken}
+        if broken:
+            log_message(f"  ⊘ Run {iteration if iteration is not None else ''} repaired "
+                        f"({'; '.join(broken)})", logging.DEBUG)
+        params = feasible
+    if params is None:
+        updated_lines = ctx["lines"]
+    else:
+        updated_lines = update_parameters(ctx["lines"], params, ctx["param_ranges_df"])
+    result = {
+        "Iteration": iteration, "Parameters": list(params) if params is not None else None,
+        "Metrics": None, "Merged_Data": pd.DataFrame(), "Elapsed": 0.0, "Slot": slot,
+    }
+    results_dir = paths["results_dir"]
+    backup_name = None
+    if iteration is not None and ctx.get("save_dnd_backups"):
+        backup_name = "iter_0000_baseline.dnd" if iteration == 0 else f"iter_{iteration:04d}.dnd"
+
+    cache = ctx.get("cache")
+    windowed = ctx.get("windowed_reads", True)
+    target_key = target_cache_key(ctx["target_var"], ctx["depth"], ctx.get("obs_window") if windowed else None)
+    sim_key = (cache.key(ctx["batch_file"], updated_lines,
+                         os.path.join(paths["root_folder"], "DNDC95.exe"))
+               if cache is not None else None)
+    # Saved iterations need DNDC's own output, so they always run (and still fill the cache)
+    save_outputs = iteration is not None and ctx.get("save_iter_results")
+    modeled_df = cache.get(sim_key, target_key) if cache is not None and not save_outputs else None
+
+    if modeled_df is not None:
+        result["Cached"] = True
+    elif ctx.get("broker") is not None:
+        remote = evaluate_remote(ctx["broker"], updated_lines, ctx)
+        if remote is not None:  # None: no worker took it in time, so it runs here
+            modeled_df, result["Elapsed"] = remote
+            if cache is not None and not modeled_df.empty:
+                cache.put(sim_key, target_key, modeled_df)
+
+    if modeled_df is not None:
+        observed_df = read_observed_data(ctx["target_var"], ctx["observed_csv"])
+        if backup_name:
+            write_dnd_file(os.path.join(results_dir, "dnd_backups", backup_name), updated_lines)
+    else:
+        scratch, scratch_base = ctx.get("scratch"), ctx.get("scratch_base")
+        on_scratch = scratch is not None and scratch.fits(scratch_base, slot)
+        if scratch is not None and not on_scratch:
+            scratch.release(scratch_base, slot)
+        ws = make_workspace(paths, ctx["batch_file"], ctx["dnd_file"], slot,
+                            scratch_base if on_scratch else None)
+        write_dnd_file(ws["dnd_file"], updated_lines)
+
+        started = time.time()
+        try:
+            run_dndc(ws["output_dir"], paths["root_folder"], ws["batch_file"],
+                     daily=ctx.get("daily_output", True))
+        except subprocess.CalledProcessError:
+            if on_scratch and scratch.low_on_space():
+                # Not the candidate's fault: retry it (on disk, since the scratch is full)
+                scratch.release(scratch_base, slot)
+                raise OSError(errno.ENOSPC, "scratch folder full")
+            raise
+        result["Elapsed"] = time.time() - started
+
+        # Detect where DNDC actually wrote its output
+        dndc_dir = detect_dndc_output_folder(ws["batch_record_root"])
+        if not dndc_dir:
+            log_message("✗ Could not find DNDC output folder")
+            return result
+
+        if backup_name:
+            try: shutil.copy(ws["dnd_file"], os.path.join(results_dir, "dnd_backups", backup_name))
+            except: pass
+        if save_outputs:
+            save_iteration_outputs(results_dir, iteration, dndc_dir, ctx.get("columnar_outputs"))
+
+        modeled_paths = get_modeled_paths(dndc_dir)
+        modeled_df, observed_df = read_target_data(ctx["target_var"], modeled_paths,
+                                                   ctx["observed_csv"], ctx["depth"], windowed)
+        if cache is not None and not modeled_df.empty:
+            cache.put(sim_key, target_key, modeled_df)
+            if windowed and ctx.get("cache_also"):
+                cache_extra_targets(cache, sim_key, modeled_paths, ctx["cache_also"])
+        if ctx.get("prune_outputs"):
+            prune_run_outputs(ws["output_dir"])  # parsed and cached: nothing reads it again
+        if on_scratch:
+            scratch.record(scratch_base, slot, ws["dir"])
+
+    if not modeled_df.empty and 'Year' in modeled_df.columns:
+        result["Modeled_Years"] = sorted(pd.to_numeric(modeled_df['Year'], errors='coerce')
+                                         .dropna().astype(int).unique().tolist())
+    metrics, merged_df = match_and_evaluate(modeled_df, observed_df, ctx["target_var"])
+    result["Metrics"] = metrics
+    result["Merged_Data"] = merged_df
+    return result
+
+def classify_failure(exc):
+    """'transient' for failures worth retrying elsewhere (timeouts, locked files, network),
+    'deterministic' for ones the same inputs will reproduce (DNDC crash, unreadable output)."""
+    if isinstance(exc, (subprocess.TimeoutExpired, FutureTimeout, ConnectionError, urllib.error.URLError)):
+        return "transient"
+    if isinstance(exc, OSError) and not isinstance(exc, FileNotFoundError):
+        return "transient"  # sharing violations, antivirus locks, full or flaky disks
+    return "deterministic"
+
+class FailureModel:
+    """Distance-weighted k-nearest-neighbour estimate of P(DNDC fails) over the
+    normalized search space, learned from every run's outcome."""
+
+    def __init__(self, dimensions, k=5, min_failures=3):
+        from skopt.space import Space
+        self.space = Space(dimensions)
+        self.space.set_transformer("normalize")
+        self.k = k
+        self.min_failures = min_failures
+        self._X, self._failed = [], []
+        self._lock = threading.Lock()
+
+    def observe(self, params, failed):
+        try:
+            x = self.space.transform([list(params)])[0]
+        except Exception:
+            return  # outside the box (e.g. baseline values)
+        with self._lock:
+            self._X.append(np.asarray(x, dtype=float))
+            self._failed.append(1.0 if failed else 0.0)
+
+    def p_fail(self, params):
+        with self._lock:
+            if sum(self._failed) < self.min_failures:
+                return 0.0
+            X, y = np.array(self._X), np.array(self._failed)
+        x = np.asarray(self.space.transform([list(params)])[0], dtype=float)
+        dist = np.linalg.norm(X - x, axis=1)
+        nearest = np.argsort(dist)[:self.k]
+        w = 1.0 / (dist[nearest] + 1e-6)
+        return float(np.sum(w * y[nearest]) / np.sum(w))
+
+def run_with_retries(params, ctx, iteration, slots):
+    """evaluate_candidate with failure handling. Transient failures are retried
+    (up to retry_attempts) on the next free slot; anything else becomes a failed
+    result tagged with its "Failure" kind instead of an exception. CalibrationStopped propagates."""
+    retries = int(ctx.get("retry_attempts", 2))
+    metrics = ctx.get("metrics")
+    if metrics is not None:
+        metrics.slot_wait(1)
+    try:
+        slot = slots.get()
+    finally:
+        if metrics is not None:
+            metrics.slot_wait(-1)
+    if metrics is not None:
+        metrics.run_started()
+    attempt = 0
+    try:
+        while True:
+            _log_context.source = f"worker {slot}"
+            _log_context.levels = ctx.get("log_levels")
+            try:
+                result = evaluate_candidate(params, ctx, slot, iteration)
+                if result["Metrics"] is None and not result.get("Infeasible"):
+                    result.setdefault("Error", "no matched output")
+                    result["Failure"] = "deterministic"
+                break
+            except CalibrationStopped:
+                raise
+            except Exception as e:
+                kind = classify_failure(e)
+                label = iteration if iteration is not None else ''
+                if isinstance(e, subprocess.CalledProcessError):
+                    e = f"DNDC exited with code {e.returncode}"
+                if kind == "transient" and attempt < retries and not run_stopped(ctx):
+                    attempt += 1
+                    log_message(f"  ↻ Run {label}: {e} — retry {attempt}/{retries}")
+                    # Hand the slot back and take the next free one (another worker if there is one)
+                    slots.put(slot)
+                    slot = slots.get()
+                    continue
+                log_message(f"  ✗ Run {label} failed ({kind}): {e}")
+                result = {"Iteration": iteration, "Parameters": params, "Metrics": None,
+                          "Merged_Data": pd.DataFrame(), "Error": str(e), "Failure": kind}
+                break
+    finally:
+        _log_context.source = _log_context.levels = None
+        slots.put(slot)
+        if metrics is not None:
+            metrics.run_finished()
+    if metrics is not None:
+        metrics.record(result)
+    model = ctx.get("failure_model")
+    if model is not None and params is not None and not result.get("Infeasible"):
+        if result["Metrics"] is not None or result.get("Failure") == "deterministic":
+            model.observe(result["Parameters"], result["Metrics"] is None)
+    return result
+
+def evaluate_batch(param_list, ctx, workers=1, first_iteration=1, on_result=None):
+    """Evaluate candidates concurrently, one workspace slot per worker.
+    Results come back in input order; failed runs carry an "Error" entry.
+    first_iteration=None marks throwaway runs (no backups / saved outputs).
+    on_result (optional) is called from the worker thread as each run finishes."""
+    if not param_list:
+        return []
+    workers = max(1, min(int(workers), len(param_list)))
+    slots = ctx.get("slot_pool")
+    if slots is None:
+        slots = queue.Queue()
+        for s in range(workers):
+            slots.put(s)
+
+    def _run(i, params):
+        iteration = None if first_iteration is None else first_iteration + i
+        budget = ctx.get("budget")
+        if run_stopped(ctx) or (budget is not None and budget.exhausted()):
+            result = {"Iteration": iteration, "Parameters": params, "Metrics": None,
+                      "Merged_Data": pd.DataFrame(), "Error": "stopped"}
+        else:
+            try:
+                result = run_with_retries(params, ctx, iteration, slots)
+            except CalibrationStopped:
+                # DNDC was killed by Stop; the run is simply not counted
+                result = {"Iteration": iteration, "Parameters": params, "Metrics": None,
+                          "Merged_Data": pd.DataFrame(), "Error": "stopped"}
+        if on_result:
+            on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_run, range(len(param_list)), param_list))
+
+def build_initial_design(param_ranges, method, n_points, random_state=42):
+    """Space-filling initial points (LHS / Sobol / Halton / Random) over param_ranges."""
+    from skopt.sampler import Lhs, Sobol, Halton
+    from skopt.space import Space
+    if n_points <= 0:
+        return []
+    space = Space(param_ranges)
+    method = (method or "random").lower()
+    if method == "lhs":
+        sampler = Lhs(lhs_type="classic", criterion="maximin", iterations=1000)
+    elif method == "sobol":
+        sampler = Sobol()
+    elif method == "halton":
+        sampler = Halton()
+    else:
+        return [list(p) for p in space.rvs(n_points, random_state=random_state)]
+    return [list(p) for p in sampler.generate(space.dimensions, n_points, random_state=random_state)]
+
+# =====================================================================
+#  MULTI-FIDELITY SCREENING
+# =====================================================================
+def find_simulated_years_line(lines):
+    """Index of the 'Simulated_years N' line in a .dnd, or None."""
+    for i, line in enumerate(lines):
+        parts = line.strip().split()
+        if len(parts) >= 2 and parts[0].lower() == "simulated_years":
+            return i
+    return None
+
+def set_simulated_years(lines, line_idx, years):
+    """Copy of .dnd lines with the simulated period shortened to `years`."""
+    updated_lines = list(lines)
+    parts = updated_lines[line_idx].strip().split()
+    parts[1] = str(int(years))
+    updated_lines[line_idx] = ' '.join(parts) + '\n'
+    return updated_lines
+
+def fidelity_budgets(baseline, full_years, eta, n_rungs):
+    """Reduced run lengths (in simulated years) for each screening rung.
+    Year positions come from the baseline run, so calendar-year and
+    relative-year observation files both work."""
+    modeled_years = baseline.get("Modeled_Years") or []
+    merged = baseline.get("Merged_Data")
+    if not modeled_years or merged is None or merged.empty:
+        return []
+    positions = sorted(modeled_years.index(y) + 1
+                       for y in merged['Year'].astype(int).unique() if y in modeled_years)
+    if not positions:
+        return []
+    first_obs, last_obs = positions[0], positions[-1]
+    budgets = set()
+    for i in range(n_rungs, 0, -1):
+        years = max(first_obs, int(np.ceil(last_obs / eta ** i)))
+        if years < full_years:
+            budgets.add(years)
+    return sorted(budgets)
+
+def multi_fidelity_design(param_ranges, ctx, settings, n_full, workers, baseline,
+                          first_iteration=1, on_result=None):
+    """Successive halving: screen n_full * eta**rungs space-filling candidates on
+    shortened runs, keep the best 1/eta at each rung, and run the n_full
+    survivors at full length. Returns the full-length results."""
+    eta = max(2, int(settings.get("fidelity_eta") or 3))
+    n_rungs = max(0, int(settings.get("fidelity_rungs") or 0))
+    line_idx = settings.get("fidelity_years_line")
+    if line_idx is None:
+        line_idx = find_simulated_years_line(ctx["lines"])
+
+    budgets = []
+    if line_idx is not None and baseline.get("Metrics") is not None:
+        try:
+            full_years = int(float(ctx["lines"][int(line_idx)].split()[1]))
+            budgets = fidelity_budgets(baseline, full_years, eta, n_rungs)
+        except (IndexError, ValueError):
+            budgets = []
+
+    if not budgets:
+        log_message("  ⚠ Multi-fidelity: no Simulated_years line or observed years to shorten; "
+                    "running a full-length design")
+        design = build_initial_design(param_ranges, settings.get("initial_design"), n_full)
+        return evaluate_batch(design, ctx, workers, first_iteration, on_result)
+
+    survivors = build_initial_design(param_ranges, settings.get("initial_design"),
+                                     n_full * eta ** len(budgets))
+    for years in budgets:
+        keep = max(n_full, int(np.ceil(len(survivors) / eta)))
+        log_message(f"\n  ◔ Screening {len(survivors)} candidates on {years}-year runs "
+                    f"(full: {full_years}) → keeping {keep}")
+        rung_ctx = dict(ctx, lines=set_simulated_years(ctx["lines"], int(line_idx), years))
+        rung = evaluate_batch(survivors, rung_ctx, workers, first_iteration=None)
+        if run_stopped(ctx):
+            return []
+        rung.sort(key=lambda r: r["Metrics"]['RMSE'] if r.get("Metrics") else np.inf)
+        survivors = [r["Parameters"] for r in rung[:keep]]
+        if rung and rung[0].get("Metrics"):
+            log_message(f"    best screened RMSE={rung[0]['Metrics']['RMSE']:.2f}")
+
+    log_message(f"\n  ◕ Promoting {len(survivors)} candidates to full-length runs")
+    return evaluate_batch(survivors, ctx, workers, first_iteration, on_result)
+
+# =====================================================================
+#  DISTRIBUTED EVALUATION
+#  The calibrating machine runs a small HTTP/JSON job broker; workers on
+#  other machines (python caln.py worker --broker http://host:port) lease
+#  rendered .dnd + batch payloads, run DNDC and post the parsed series back.
+#  Workers must see the same DNDC input paths (e.g. a mapped network drive).
+#  Every request carries the shared broker_token in BROKER_TOKEN_HEADER; the
+#  broker only listens beyond this machine when such a token is set.
+# =====================================================================
+BROKER_TOKEN_HEADER = "X-Broker-Token"
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+class JobBroker:
+    """Job queue served over HTTP. Workers lease a job, heartbeat while DNDC runs
+    and post the result; leases that miss their heartbeat are re-queued."""
+    def __init__(self, host="127.0.0.1", port=8765, lease_timeout=60, max_attempts=3, token=None):
+        if not token and not _is_loopback(host):
+            raise ValueError(f"broker_host {host} accepts workers from other machines — "
+                             f"set a broker_token first")
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._pending = deque()
+        self._jobs = {}
+        self._workers = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._closed = threading.Event()
+        broker = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass  # keep request noise out of the calibration log
+
+            def _reply(self, code, body=None):
+                data = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _authorized(self):
+                if not token:
+                    return True
+                sent = self.headers.get(BROKER_TOKEN_HEADER) or ""
+                if hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8")):
+                    return True
+                self._reply(401, {"error": "missing or wrong broker token"})
+                return False
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                if self.path.startswith("/stats"):
+                    self._reply(200, broker.stats())
+                else:
+                    self._reply(404, {"error": "unknown route"})
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                routes = {"/lease": broker._lease, "/heartbeat": broker._heartbeat,
+                          "/result": broker._complete}
+                route = routes.get(self.path)
+                if route is None:
+                    return self._reply(404, {"error": "unknown route"})
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    data = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return self._reply(400, {"error": "bad JSON"})
+                body = route(data)
+                self._reply(200 if body is not None else 204, body)
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._reap, daemon=True).start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _worker(self, worker_id):
+        return self._workers.setdefault(worker_id, {
+            "jobs": 0, "failed": 0, "lost": 0, "run_seconds": 0.0,
+            "first_seen": time.time(), "last_seen": time.time(), "current": None,
+        })
+
+    def submit(self, payload):
+        """Queue a job; returns a Future resolved with the worker's reply."""
+        future = Future()
+        with self._lock:
+            job_id = next(self._ids)
+            self._jobs[job_id] = {"payload": payload, "future": future, "attempts": 0,
+                                  "worker": None, "deadline": None}
+            self._pending.append(job_id)
+            self._available.notify()
+        future.job_id = job_id
+        return future
+
+    def withdraw(self, future, reason="withdrawn", unleased_only=False):
+        """Drop a submitted job and fail its future with reason; a worker still running it
+        is told to cancel at its next heartbeat. With unleased_only, only a job no worker
+        has taken yet is dropped. Returns True if the job was dropped."""
+        with self._lock:
+            job = self._jobs.get(future.job_id)
+            if job is None or (unleased_only and job["attempts"] > 0):
+                return False
+            del self._jobs[future.job_id]
+            try:
+                self._pending.remove(future.job_id)
+            except ValueError:
+                pass
+        if not future.done():
+            future.set_exception(RuntimeError(reason))
+        return True
+
+    def _lease(self, data):
+        """Hand out the next job; long-polls up to data["wait"] seconds when idle."""
+        worker_id = str(data.get("worker", "?"))
+        until = time.time() + min(float(data.get("wait") or 0), 30.0)
+        with self._lock:
+            w = self._worker(worker_id)
+            while True:
+                w["last_seen"] = time.time()
+                while self._pending:
+                    job_id = self._pending.popleft()
+                    job = self._jobs.get(job_id)
+                    if job is None or job["future"].done():
+                        continue
+                    job["attempts"] += 1
+                    job["worker"] = worker_id
+                    job["deadline"] = time.time() + self.lease_timeout
+                    w["current"] = job_id
+                    return {"job_id": job_id, "lease_timeout": self.lease_timeout, **job["payload"]}
+                remaining = until - time.time()
+                if remaining <= 0 or self._closed.is_set():
+                    return None
+                self._available.wait(remaining)
+
+    def _heartbeat(self, data):
+        worker_id = str(data.get("worker", "?"))
+        with self._lock:
+            self._worker(worker_id)["last_seen"] = time.time()
+            job = self._jobs.get(data.get("job_id"))
+            if job is not None and job["worker"] == worker_id:
+                job["deadline"] = time.time() + self.lease_timeout
+            return {"cancel": job is None or job["future"].done()}
+
+    def _complete(self, data):
+        worker_id = str(data.get("worker", "?"))
+        with self._lock:
+            w = self._worker(worker_id)
+            w["last_seen"] = time.time()
+            w["current"] = None
+            w["run_seconds"] += float(data.get("elapsed") or 0.0)
+            if data.get("error"):
+                w["failed"] += 1
+            else:
+                w["jobs"] += 1
+            job = self._jobs.pop(data.get("job_id"), None)
+        if job is not None and not job["future"].done():
+            if data.get("error"):
+                job["future"].set_exception(RuntimeError(f"worker {worker_id}: {data['error']}"))
+            else:
+                job["future"].set_result(data)
+        return {"ok": True}
+
+    def _reap(self):
+        """Re-queue jobs whose worker stopped heartbeating."""
+        while not self._closed.wait(2.0):
+            expired = []
+            with self._lock:
+                now = time.time()
+                for job_id, job in list(self._jobs.items()):
+                    if job["worker"] is None or job["deadline"] > now:
+                        continue
+                    lost = job["worker"]
+                    self._worker(lost)["lost"] += 1
+                    self._worker(lost)["current"] = None
+                    job["worker"] = None
+                    if job["attempts"] >= self.max_attempts:
+                        self._jobs.pop(job_id)
+                        expired.append((job, lost))
+                    else:
+                        self._pending.appendleft(job_id)
+                        self._available.notify()
+                        log_message(f"  ⚠ Worker {lost} lost job {job_id}; re-queued")
+            for job, lost in expired:
+                job["future"].set_exception(RuntimeError(
+                    f"job lost {job['attempts']} times (last worker: {lost})"))
+
+    def cancel_all(self, reason="cancelled"):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+            self._pending.clear()
+        for job in jobs:
+            if not job["future"].done():
+                job["future"].set_exception(RuntimeError(reason))
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            out = {"queued": len(self._pending), "in_flight": len(self._jobs) - len(self._pending),
+                   "workers": {}}
+            for worker_id, w in self._workers.items():
+                hours = max(now - w["first_seen"], 1e-9) / 3600.0
+                out["workers"][worker_id] = {
+                    "jobs": w["jobs"], "failed": w["failed"], "lost": w["lost"],
+                    "mean_run_seconds": w["run_seconds"] / max(1, w["jobs"] + w["failed"]),
+                    "jobs_per_hour": w["jobs"] / hours,
+                    "last_seen_seconds": now - w["last_seen"], "current_job": w["current"],
+                }
+        return out
+
+    def log_stats(self):
+        stats = self.stats()
+        if not stats["workers"]:
+            log_message("  Broker: no remote workers connected")
+            return
+        for worker_id, w in stats["workers"].items():
+            log_message(f"  Worker {worker_id}: {w['jobs']} jobs, {w['failed']} failed, {w['lost']} lost  ·  "
+                        f"{w['mean_run_seconds']:.1f}s/run  ·  {w['jobs_per_hour']:.1f} jobs/h")
+
+    def close(self):
+        self.cancel_all("broker closed")
+        self._closed.set()
+        with self._lock:
+            self._available.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+def evaluate_remote(broker, updated_lines, ctx):
+    """Send one rendered simulation through the broker; returns (modeled_df, elapsed), or
+    None when no worker leased it within broker_lease_wait (the caller then runs it locally).
+    Stop, the run's budget / cancel event and broker_job_timeout end the wait."""
+    if "batch_text" not in ctx:
+        with open(ctx["batch_file"], 'r') as f:
+            ctx["batch_text"] = f.read()
+        with open(ctx["observed_csv"], 'r') as f:
+            ctx["observed_text"] = f.read()
+    future = broker.submit({
+        "dnd_name": os.path.basename(ctx["dnd_file"]), "dnd_text": "".join(updated_lines),
+        "batch_name": os.path.basename(ctx["batch_file"]), "batch_text": ctx["batch_text"],
+        "observed_text": ctx["observed_text"],
+        "target_var": ctx["target_var"], "depth": ctx["depth"],
+        "windowed": ctx.get("windowed_reads", True),
+        "daily": ctx.get("daily_output", True), "prune": ctx.get("prune_outputs", False),
+    })
+    budget, submitted = ctx.get("budget"), time.time()
+    lease_wait, job_timeout = ctx.get("broker_lease_wait", 0), ctx.get("broker_job_timeout", 0)
+    while True:
+        try:
+            reply = future.result(timeout=1.0)
+            break
+        except FutureTimeout:
+            pass
+        reason = "Stopped by user." if run_stopped(ctx) else budget.exhausted() if budget else None
+        if reason:
+            broker.withdraw(future, reason)
+            raise CalibrationStopped(reason)
+        waited = time.time() - submitted
+        if lease_wait and waited >= lease_wait and broker.withdraw(future, "no worker", unleased_only=True):
+            if not ctx.get("broker_fallback_logged"):
+                ctx["broker_fallback_logged"] = True
+                log_message(f"  ⚠ No worker took a job within {lease_wait:g}s; running such jobs locally")
+            return None
+        if job_timeout and waited >= job_timeout:
+            broker.withdraw(future, "timed out")
+            raise FutureTimeout(f"remote job not finished after {format_duration(job_timeout)}")
+    modeled_df = pd.read_json(io.StringIO(reply["modeled"]), orient="split")
+    return modeled_df, float(reply.get("elapsed") or 0.0)
+
+def execute_remote_job(job, root_folder, work_dir):
+    """Worker side: render the payload, run DNDC, parse and score it."""
+    os.makedirs(work_dir, exist_ok=True)
+    dnd_path = os.path.join(work_dir, os.path.basename(job["dnd_name"]))
+    with open(dnd_path, 'w') as f:
+        f.write(job["dnd_text"])
+    source_batch = os.path.join(work_dir, "source_" + os.path.basename(job["batch_name"]))
+    with open(source_batch, 'w') as f:
+        f.write(job["batch_text"])
+    batch_path = os.path.join(work_dir, os.path.basename(job["batch_name"]))
+    render_batch_file(source_batch, dnd_path, batch_path)
+    observed_csv = os.path.join(work_dir, "observed.csv")
+    with open(observed_csv, 'w') as f:
+        f.write(job["observed_text"])
+
+    output_dir = os.path.join(work_dir, "output")
+    batch_record_root = os.path.join(output_dir, "Record", "Batch")
+    shutil.rmtree(batch_record_root, ignore_errors=True)
+    started = time.time()
+    run_dndc(output_dir, root_folder, batch_path, daily=job.get("daily", True))
+    elapsed = time.time() - started
+    dndc_dir = detect_dndc_output_folder(batch_record_root)
+    if not dndc_dir:
+        raise RuntimeError("DNDC output folder not found")
+    modeled_df, observed_df = read_target_data(job["target_var"], get_modeled_paths(dndc_dir),
+                                               observed_csv, job.get("depth"), job.get("windowed", True))
+    if job.get("prune"):
+        prune_run_outputs(output_dir)
+    if modeled_df.empty:
+        raise RuntimeError(f"no modeled {job['target_var']} data")
+    metrics, _ = match_and_evaluate(modeled_df.copy(), observed_df, job["target_var"])
+    return {
+        "modeled": modeled_df.to_json(orient="split"),
+        "metrics": {k: float(v) for k, v in metrics.items()} if metrics else None,
+        "elapsed": elapsed,
+    }
+
+def _broker_headers(token):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers[BROKER_TOKEN_HEADER] = token
+    return headers
+
+def run_remote_worker(broker_url, root_folder, worker_id=None, poll_wait=10.0,
+                      heartbeat_interval=5.0, retry_interval=5.0, max_jobs=None, token=None):
+    """Lease jobs from a broker until interrupted (or max_jobs are done).
+    Idle workers long-poll the broker, so new jobs start without delay."""
+    broker_url = broker_url.rstrip("/")
+    headers = _broker_headers(token)
+    set_log_root(root_folder)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    disk_dir = os.path.join(root_folder, "output_files", "remote", re.sub(r'[^\w.-]', '_', worker_id))
+    # Same capped scratch as local slots: a job that does not fit runs in disk_dir
+    scratch = make_scratch_space(load_user_settings())
+    scratch_base = scratch.owner_dir(disk_dir) if scratch is not None else None
+
+    def _execute(job):
+        on_scratch = scratch is not None and scratch.fits(scratch_base, 0)
+        if scratch is not None and not on_scratch:
+            scratch.release(scratch_base, 0)
+        work_dir = os.path.join(scratch_base, "slot_00") if on_scratch else disk_dir
+        try:
+            reply = execute_remote_job(job, root_folder, work_dir)
+        except subprocess.CalledProcessError:
+            if not (on_scratch and scratch.low_on_space()):
+                raise
+            scratch.release(scratch_base, 0)  # scratch full, not the job's fault: run it on disk
+            return execute_remote_job(job, root_folder, disk_dir)
+        if on_scratch:
+            scratch.record(scratch_base, 0, work_dir)
+        return reply
+
+    def _post(route, body):
+        req = urllib.request.Request(broker_url + route, data=json.dumps(body).encode("utf-8"),
+                                     headers=headers, method="POST")
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            payload = resp.read()
+        return json.loads(payload) if payload else None
+
+    log_message(f"  Worker {worker_id} → {broker_url}  (DNDC root: {root_folder})")
+    done = 0
+    try:
+        while max_jobs is None or done < max_jobs:
+            try:
+                job = _post("/lease", {"worker": worker_id, "wait": poll_wait})
+            except urllib.error.HTTPError as e:
+                if e.code == 401:
+                    raise RuntimeError("broker rejected the token (see worker --token)") from None
+                log_message(f"  ⚠ Broker error ({e}); retrying...")
+                time.sleep(retry_interval)
+                continue
+            except (urllib.error.URLError, OSError) as e:
+                log_message(f"  ⚠ Broker unreachable ({e}); retrying...")
+                time.sleep(retry_interval)
+                continue
+            if not job:
+                continue
+
+            finished = threading.Event()
+            def _beat(job_id=job["job_id"]):
+                while not finished.wait(heartbeat_interval):
+                    try:
+                        reply = _post("/heartbeat", {"worker": worker_id, "job_id": job_id})
+                    except Exception:
+                        continue
+                    if reply and reply.get("cancel"):
+                        terminate_active_processes()  # broker no longer wants this job
+            threading.Thread(target=_beat, daemon=True).start()
+
+            reply = {"worker": worker_id, "job_id": job["job_id"]}
+            try:
+                reply.update(_execute(job))
+                log_message(f"  ✓ Job {job['job_id']} done in {reply['elapsed']:.1f}s")
+            except Exception as e:
+                reply["error"] = str(e)
+                log_message(f"  ✗ Job {job['job_id']} failed: {e}")
+            finally:
+                finished.set()
+            try:
+                _post("/result", reply)
+            except (urllib.error.URLError, OSError) as e:
+                log_message(f"  ⚠ Could not deliver job {job['job_id']}: {e}")
+            done += 1
+    finally:
+        if scratch is not None:
+            scratch.release_all(scratch_base)
+    return done
+
+
+_active_brokers = set()
+_active_brokers_lock = threading.Lock()
+
+def start_broker(settings):
+    """JobBroker when settings name a broker_port, else None (local workers)."""
+    port = settings.get("broker_port")
+    if not port:
+        return None
+    host = settings.get("broker_host") or "127.0.0.1"
+    token = settings.get("broker_token")
+    broker = JobBroker(host, int(port), lease_timeout=float(settings.get("broker_lease_timeout", 60)),
+                       token=token)
+    with _active_brokers_lock:
+        _active_brokers.add(broker)
+    address = host if _is_loopback(host) else socket.gethostname()
+    log_message(f"  Job broker listening on {host}:{broker.port} — start workers with:")
+    log_message(f"    python caln.py worker --broker http://{address}:{broker.port} --root C:\\DNDC"
+                + (" --token <broker_token>" if token else ""))
+    return broker
+
+def close_eval_context(ctx):
+    """Report cache / broker statistics, shut the broker down and free the scratch folder."""
+    if ctx.get("metrics") is not None:
+        METRICS.end(ctx["metrics"])
+    cache = ctx.get("cache")
+    if cache is not None and (cache.hits or cache.misses):
+        log_message(f"  Simulation cache: {cache.hits} hit(s), {cache.misses} DNDC run(s)")
+    scratch = ctx.get("scratch")
+    if scratch is not None:
+        fallbacks = scratch.release_all(ctx["scratch_base"])  # only this calibration's workspaces
+        if fallbacks:
+            log_message(f"  Scratch: {fallbacks} run(s) fell back to disk (cap or free space)")
+    broker = ctx.get("broker")
+    if broker is not None:
+        broker.log_stats()
+        broker.close()
+        with _active_brokers_lock:
+            _active_brokers.discard(broker)
+
+def _in_bounds(params, dimensions):
+    return all(v in dim for v, dim in zip(params, dimensions))
+
+
+# =====================================================================
+#  METRICS EXPORT
+#  Progress of every calibration in this process (queue runner included)
+#  as OpenMetrics text: served on http://<host>:<metrics_port>/metrics
+#  and/or written to a node_exporter textfile, for dashboards and alerts.
+# =====================================================================
+RUN_DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)   # seconds
+METRICS_KEEP_FINISHED = 50   # finished calibrations still exported
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics_lock = threading.Lock()
+
+class CalibrationSeries:
+    """Counters and gauges of one calibration; updated from the worker threads."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.active = True
+        self.iterations = 0
+        self.best_rmse = float("nan")
+        self.waiting = 0       # evaluations waiting for a DNDC slot
+        self.in_flight = 0
+        self.failures = {"transient": 0, "deterministic": 0}
+        self.cache = {"hit": 0, "miss": 0}
+        self.buckets = [0] * len(RUN_DURATION_BUCKETS)
+        self.duration_sum = 0.0
+        self.duration_count = 0
+        self.last_progress = time.time()
+
+    def slot_wait(self, delta):
+        with _metrics_lock:
+            self.waiting += delta
+
+    def run_started(self):
+        with _metrics_lock:
+            self.in_flight += 1
+
+    def run_finished(self):
+        with _metrics_lock:
+            self.in_flight -= 1
+
+    def record(self, result):
+        """Count one finished evaluation (an all_results-style dict)."""
+        elapsed = float(result.get("Elapsed") or 0.0)
+        with _metrics_lock:
+            if result.get("Cached"):
+                self.cache["hit"] += 1
+            elif elapsed > 0:
+                self.cache["miss"] += 1
+                self.duration_sum += elapsed
+                self.duration_count += 1
+                for i, bound in enumerate(RUN_DURATION_BUCKETS):
+                    if elapsed <= bound:
+                        self.buckets[i] += 1  # rendered cumulatively
+                        break
+            kind = result.get("Failure")
+            if kind:
+                self.failures[kind] = self.failures.get(kind, 0) + 1
+            if result.get("Iteration") is None or result.get("Infeasible"):
+                return  # screening / re-simulation runs are not calibration progress
+            self.iterations += 1
+            self.last_progress = time.time()
+            rmse = (result.get("Metrics") or {}).get("RMSE")
+            if rmse is not None and np.isfinite(rmse) and (np.isnan(self.best_rmse) or rmse < self.best_rmse):
+                self.best_rmse = float(rmse)
+
+class MetricsRegistry:
+    """The calibrations exported by this process, in start order."""
+
+    def __init__(self):
+        self._series = OrderedDict()
+
+    def begin(self, **labels):
+        labels = {k: str(v) for k, v in labels.items() if v not in (None, "")}
+        key = tuple(sorted(labels.items()))
+        with _metrics_lock:
+            self._series.pop(key, None)  # a re-run of the same calibration starts over
+            series = self._series[key] = CalibrationSeries(labels)
+            finished = [k for k, s in self._series.items() if not s.active]
+            for k in finished[:max(0, len(finished) - METRICS_KEEP_FINISHED)]:
+                del self._series[k]
+        return series
+
+    def end(self, series):
+        with _metrics_lock:
+            series.active = False
+        write_metrics_textfile()
+
+    def snapshot(self):
+        with _metrics_lock:
+            return [copy.deepcopy(s) for s in self._series.values()]
+
+METRICS = MetricsRegistry()
+_metrics_exporter = {"server": None, "textfile": None}
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+def _metric_value(value):
+    value = float(value)
+    if np.isnan(value):
+        return "NaN"
+    if np.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+
+def render_metrics(openmetrics=True):
+    """Exposition text for every calibration in METRICS plus the queue on this machine.
+    openmetrics=False gives the Prometheus 0.0.4 text format (node_exporter textfiles)."""
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        # OpenMetrics names a counter family without "_total"; the Prometheus format with it
+        typed = name + "_total" if kind == "counter" and not openmetrics else name
+        lines.append(f"# TYPE {typed} {kind}")
+        lines.append(f"# HELP {typed} {help_text}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_metric_labels(labels)} {_metric_value(value)}")
+
+    series = METRICS.snapshot()
+    family("dndc_calibration_active", "gauge", "1 while the calibration is running.",
+           [("", s.labels, s.active) for s in series])
+    family("dndc_iterations", "counter", "Calibration iterations completed.",
+           [("_total", s.labels, s.iterations) for s in series])
+    family("dndc_best_rmse", "gauge", "Best RMSE so far.",
+           [("", s.labels, s.best_rmse) for s in series])
+    family("dndc_evaluations_in_flight", "gauge", "Evaluations holding a DNDC slot.",
+           [("", s.labels, s.in_flight) for s in series])
+    family("dndc_evaluations_waiting", "gauge", "Evaluations waiting for a DNDC slot.",
+           [("", s.labels, s.waiting) for s in series])
+    family("dndc_last_progress_timestamp_seconds", "gauge", "When the last iteration finished.",
+           [("", s.labels, s.last_progress) for s in series])
+    family("dndc_run_failures", "counter", "Failed evaluations by kind.",
+           [("_total", {**s.labels, "kind": kind}, n) for s in series for kind, n in s.failures.items()])
+    family("dndc_cache_lookups", "counter", "Simulation cache hits and misses (DNDC runs).",
+           [("_total", {**s.labels, "result": r}, n) for s in series for r, n in s.cache.items()])
+    samples = []
+    for s in series:
+        for bound, n in zip(RUN_DURATION_BUCKETS, itertools.accumulate(s.buckets)):
+            samples.append(("_bucket", {**s.labels, "le": repr(float(bound))}, n))
+        samples.append(("_bucket", {**s.labels, "le": "+Inf"}, s.duration_count))
+        samples.append(("_count", s.labels, s.duration_count))
+        samples.append(("_sum", s.labels, s.duration_sum))
+    family("dndc_run_duration_seconds", "histogram", "DNDC run wall time.", samples)
+    if os.path.exists(QUEUE_FILE):
+        try:
+            jobs = load_queue()["jobs"]
+            family("dndc_queue_jobs", "gauge", "Calibration queue jobs by state.",
+                   [("", {"state": state}, sum(1 for j in jobs if j["state"] == state))
+                    for state in ("queued", "running", "done", "failed", "cancelled")])
+        except ValueError:
+            pass  # damaged queue file: `queue list` reports it
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def write_metrics_textfile(path=None):
+    """Write the Prometheus-format metrics to path (default: the exporter's textfile), atomically."""
+    path = path or _metrics_exporter["textfile"]
+    if not path:
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(render_metrics(openmetrics=False))
+        os.replace(tmp, path)
+    except OSError as e:
+        log_message(f"  ⚠ Metrics textfile {path}: {e}", logging.DEBUG)
+
+def start_metrics_exporter(settings):
+    """Serve /metrics on settings["metrics_port"] and/or keep settings["metrics_textfile"]
+    up to date every metrics_interval seconds. Once per process; both are optional."""
+    port = settings.get("metrics_port")
+    if port and _metrics_exporter["server"] is None:
+
+        class _Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                openmetrics = "application/openmetrics-text" in (self.headers.get("Accept") or "")
+                data = render_metrics(openmetrics).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        try:
+            host = settings.get("metrics_host") or "127.0.0.1"
+            server = ThreadingHTTPServer((host, int(port)), _Handler)
+        except OSError as e:
+            log_message(f"  ⚠ Metrics exporter not started (port {port}: {e})")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+            _metrics_exporter["server"] = server
+            address = host if _is_loopback(host) else socket.gethostname()
+            log_message(f"  Metrics on http://{address}:{server.server_address[1]}/metrics")
+    textfile = settings.get("metrics_textfile")
+    if textfile and _metrics_exporter["textfile"] is None:
+        _metrics_exporter["textfile"] = textfile
+        interval = max(1.0, float(settings.get("metrics_interval") or 15))
+
+        def _write_loop():
+            while True:
+                write_metrics_textfile(textfile)
+                time.sleep(interval)
+        threading.Thread(target=_write_loop, daemon=True, name="metrics-textfile").start()
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)(?:\s+\S+)?$')
+_LABEL_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"\s*(?:,|$)')
+
+def parse_metrics_text(text):
+    """[(name, labels, value)] from OpenMetrics / Prometheus text; ValueError on a malformed line."""
+    samples = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip() or line.startswith("#"):
+            continue
+        m = _SAMPLE_RE.match(line)
+        if not m:
+            raise ValueError(f"line {number}: not a sample: {line!r}")
+        labels, rest = {}, m.group(2) or ""
+        while rest:
+            lm = _LABEL_RE.match(rest)
+            if not lm:
+                raise ValueError(f"line {number}: bad labels: {line!r}")
+            labels[lm.group(1)] = re.sub(r'\\(.)', lambda x: "\n" if x.group(1) == "n" else x.group(1),
+                                         lm.group(2))
+            rest = rest[lm.end():]
+        try:
+            value = float(m.group(3))
+        except ValueError:
+            raise ValueError(f"line {number}: bad value: {line!r}") from None
+        samples.append((m.group(1), labels, value))
+    return samples
+
+
+# =====================================================================
+#  EARLY STOPPING
+# =====================================================================
+def format_duration(seconds):
+    seconds = int(max(0, seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def _next_time_of_day(hhmm, now=None):
+    """Epoch seconds of the next occurrence of 'HH:MM' (today or tomorrow)."""
+    now = now or datetime.now()
+    hour, minute = (int(x) for x in str(hhmm).split(":"))
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return target.timestamp()
+
+def expected_improvement(res, n_samples=2000, random_state=0):
+    """Best expected improvement over a random sample of the space, from the last fitted GP."""
+    from skopt.acquisition import gaussian_ei
+    if not getattr(res, "models", None):
+        return None
+    y = np.asarray(res.func_vals, dtype=float)
+    y = y[np.isfinite(y)]
+    if y.size == 0:
+        return None
+    X = res.space.transform(res.space.rvs(n_samples, random_state=random_state))
+    return float(np.max(gaussian_ei(X, res.models[-1], y_opt=float(y.min()))))
+
+def ard_length_scales(res):
+    """Per-parameter length scales of the last fitted GP (in the normalized 0-1 space), or
+    None when the kernel has no one-per-parameter scale (e.g. with categorical parameters)."""
+    if not getattr(res, "models", None):
+        return None
+    kernel = getattr(res.models[-1], "kernel_", None)
+    n = len(res.space.dimensions)
+    if kernel is None or res.space.transformed_n_dims != n:
+        return None
+    for name, value in kernel.get_params().items():
+        if name.endswith("length_scale") and np.ndim(value) == 1 and len(value) == n:
+            return np.asarray(value, dtype=float)
+    return None
+
+def insensitive_dimensions(length_scales, threshold, keep=2):
+    """Indices whose length scale exceeds threshold (the objective hardly changes over the
+    whole range), flattest first, leaving at least `keep` dimensions active."""
+    flat = [i for i in np.argsort(-length_scales) if length_scales[i] > threshold]
+    return [int(i) for i in flat[:max(0, len(length_scales) - keep)]]
+
+class RunBudget:
+    """Stopping rules and ETA for one optimization run (see the early stopping settings)."""
+
+    def __init__(self, settings, total_iterations):
+        self.started = time.time()
+        self.total = total_iterations
+        self.tol = settings.get("converge_tol")
+        self.patience = max(1, int(settings.get("converge_patience") or 10))
+        self.ei_threshold = settings.get("ei_threshold")
+        self.cpu_budget = settings.get("cpu_hours_budget")
+        self.cancel_event = settings.get("cancel_event")
+        self.end_time = None
+        if settings.get("time_budget_hours"):
+            self.end_time = self.started + float(settings["time_budget_hours"]) * 3600
+        if settings.get("deadline"):
+            deadline = _next_time_of_day(settings["deadline"])
+            self.end_time = deadline if self.end_time is None else min(self.end_time, deadline)
+        self.cpu_seconds = 0.0
+        self.best_history = []
+        self._lock = threading.Lock()
+        self._last_tick = self.started
+        self._intervals = deque(maxlen=10)
+
+    def describe(self):
+        rules = []
+        if self.tol:
+            rules.append(f"Δbest < {self.tol:g}×RMSE over {self.patience} it.")
+        if self.ei_threshold:
+            rules.append(f"EI < {self.ei_threshold:g}×RMSE")
+        if self.end_time:
+            rules.append(f"finish by {datetime.fromtimestamp(self.end_time):%a %H:%M}")
+        if self.cpu_budget:
+            rules.append(f"{self.cpu_budget:g} CPU-h")
+        return ", ".join(rules)
+
+    def observe(self, result, best_rmse):
+        """Account for a finished run (wall-clock interval, DNDC time, best so far)."""
+        with self._lock:
+            now = time.time()
+            self._intervals.append(now - self._last_tick)
+            self._last_tick = now
+            if not result.get("Cached"):
+                self.cpu_seconds += float(result.get("Elapsed") or 0.0)
+            self.best_history.append(best_rmse)
+
+    def exhausted(self):
+        """Reason string once the wall-clock or CPU budget is used up, else None."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return "job cancelled"
+        if self.end_time is not None and time.time() >= self.end_time:
+            return "wall-clock budget reached"
+        if self.cpu_budget and self.cpu_seconds >= float(self.cpu_budget) * 3600:
+            return f"CPU budget reached ({format_duration(self.cpu_seconds)} of DNDC time)"
+        return None
+
+    def converged(self, res=None):
+        """Reason string when the run has stopped making progress, else None."""
+        hist = self.best_history
+        if self.tol and len(hist) > self.patience and np.isfinite(hist[-1 - self.patience]):
+            gain = hist[-1 - self.patience] - hist[-1]
+            if gain <= float(self.tol) * abs(hist[-1]):
+                return f"best RMSE improved by only {gain:.4g} in {self.patience} iterations"
+        if self.ei_threshold and res is not None and hist and np.isfinite(hist[-1]):
+            ei = expected_improvement(res)
+            if ei is not None and ei < float(self.ei_threshold) * abs(hist[-1]):
+                return f"expected improvement {ei:.4g} below threshold"
+        return None
+
+    def eta(self, done):
+        """Seconds until the run ends: measured pace × remaining runs, capped by the budget."""
+        with self._lock:
+            pace = float(np.mean(self._intervals)) if self._intervals else None
+        left = None if pace is None else pace * max(0, self.total - done)
+        if self.end_time is not None:
+            until_end = max(0.0, self.end_time - time.time())
+            left = until_end if left is None else min(left, until_end)
+        return left
+
+
+# =====================================================================
+#  OPTIMIZATION CORE
+# =====================================================================
+def objective_function(params, ctx, pending):
+    """gp_minimize objective: evaluate one candidate and park the full result for the callback.
+    Always returns a finite value once any run has succeeded: failures, infeasible and
+    predicted-to-crash candidates all get the penalty, so the GP stays well-posed."""
+    iteration = ctx["next_iteration"]()
+    model = ctx.get("failure_model")
+    p_fail = model.p_fail(params) if model is not None else 0.0
+    if p_fail >= float(ctx.get("failure_skip_probability", 0.8)):
+        result = {"Iteration": iteration, "Parameters": list(params), "Metrics": None,
+                  "Merged_Data": pd.DataFrame(), "Elapsed": 0.0, "Error": "predicted failure",
+                  "Infeasible": True, "Violations": [f"nearby runs crashed (p={p_fail:.2f})"]}
+    else:
+        result = run_with_retries(params, ctx, iteration, ctx["gp_slots"])
+    pending["result"] = result
+    if result["Metrics"] is None:
+        return ctx["penalty"]() if "penalty" in ctx else np.inf
+    return result["Metrics"]['RMSE']
+
+
+def bayesian_optimization(param_ranges, param_ranges_df, lines, target_var, depth,
+                          paths, batch_file, dnd_file, observed_csv,
+                          save_dnd_backups, save_iter_results, settings=None):
+    from skopt import gp_minimize
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+
+    log_message(f"\n{'━'*50}")
+    log_message(f"  Bayesian Optimization: {target_var}{f' @ {depth}' if depth else ''}")
+    log_message(f"{'━'*50}")
+
+    all_results = []
+    best_rmse = np.inf
+    best_params = None
+    best_merged = None
+    best_metrics = None
+    best_iteration = 0
+    iteration_counter = 0
+    record_lock = threading.Lock()
+
+    try:
+        total_iterations = int(settings["iterations"])
+    except (TypeError, ValueError):
+        total_iterations = 10
+    try:
+        workers = max(1, int(settings["workers"]))
+    except (TypeError, ValueError):
+        workers = 1
+
+    results_dir = paths["results_dir"]
+    os.makedirs(results_dir, exist_ok=True)
+
+    dnd_backup_dir = os.path.join(results_dir, "dnd_backups")
+    if save_dnd_backups:
+        os.makedirs(dnd_backup_dir, exist_ok=True)
+
+    ctx = make_eval_context(param_ranges_df, lines, target_var, depth, paths, batch_file, dnd_file,
+                            observed_csv, save_dnd_backups, save_iter_results, settings)
+    ctx["next_iteration"] = lambda: iteration_counter + 1
+
+    def _penalty():
+        """Finite stand-in for failed, infeasible or skipped candidates: worse than any run so far."""
+        with record_lock:
+            finite = [r["Metrics"]['RMSE'] for r in all_results if np.isfinite(r["Metrics"]['RMSE'])]
+        return 1.5 * max(finite) if finite else np.inf
+    ctx["penalty"] = _penalty
+    # Slots the serial GP loop can move a retried run to
+    ctx["gp_slots"] = ctx.get("slot_pool")
+    if ctx["gp_slots"] is None:
+        ctx["gp_slots"] = queue.Queue()
+        for s in range(workers):
+            ctx["gp_slots"].put(s)
+    budget = RunBudget(settings, total_iterations)
+    ctx["budget"] = budget
+    if budget.describe():
+        log_message(f"  Early stopping: {budget.describe()}")
+
+    def _record(result):
+        """Store a finished evaluation, track the best and report progress."""
+        nonlocal best_rmse, best_params, best_merged, best_metrics, best_iteration
+        metrics = result.get("Metrics")
+        it = result["Iteration"]
+        with record_lock:
+            if metrics is None:
+                if it == 0:
+                    log_message("    ⚠ Baseline produced no valid metrics")
+                elif result.get("Infeasible"):
+                    log_message(f"\n  ⊘ Iteration {it}/{total_iterations} infeasible, not simulated: "
+                                f"{'; '.join(result.get('Violations', []))}")
+                elif result.get("Error") == "no matched output":
+                    log_message(f"\n  ✗ Iteration {it}/{total_iterations} failed: {result['Error']}")
+                return
+            all_results.append(result)
+            is_new_best = metrics['RMSE'] < best_rmse
+            if is_new_best:
+                best_rmse = metrics['RMSE']
+                best_params = result["Parameters"]
+                best_merged = result["Merged_Data"]
+                best_metrics = metrics
+                best_iteration = it
+            if it == 0:
+                log_message(f"\n  ⓪ Baseline (original parameters)")
+            else:
+                marker = "★" if is_new_best else "·"
+                log_message(f"\n  {marker} Iteration {it}/{total_iterations}")
+            log_message(f"    R²={metrics['R2']:.4f}  RMSE={metrics['RMSE']:.2f}  "
+                       f"nRMSE={metrics['nRMSE']:.1f}%  MAE={metrics['MAE']:.2f}")
+
+    # ── Baseline (iteration 0) + space-filling initial design, one parallel batch ──
+    n_design = min(max(0, int(settings.get("initial_points") or 0)), total_iterations)
+    design = build_initial_design(param_ranges, settings.get("initial_design"), n_design)
+    seeds = warm_start_points(param_ranges, param_ranges_df, lines, target_var, depth, settings)
+    if seeds:
+        # The transferred sets take the place of space-filling points
+        design = (seeds + design)[:max(n_design, len(seeds))]
+        log_message(f"  Warm start: {len(seeds)} point(s) from the calibration catalog")
+    original_params = read_current_values(lines, param_ranges_df)
+    log_message(f"\n  ⓪ Baseline + {len(design)}-point {settings.get('initial_design')} design "
+                f"on {min(workers, len(design) + 1)} worker(s)"
+                f"{' with multi-fidelity screening' if settings.get('multi_fidelity') else ''}...")
+
+    done = [0]
+    def _on_design_result(result):
+        if result["Iteration"] == 0:
+            result["Parameters"] = original_params
+        _record(result)
+        with record_lock:
+            done[0] += 1 if result["Iteration"] > 0 else 0
+            n_done = done[0]
+            pct = (n_done / total_iterations) * 100
+        if result.get("Error") != "stopped":
+            budget.observe(result, best_rmse)
+        set_progress(pct, budget.eta(n_done))
+
+    if settings.get("multi_fidelity") and design:
+        ctx["windowed_reads"] = False  # fidelity budgets need the baseline's full year range
+        try:
+            batch = evaluate_batch([None], ctx, 1, first_iteration=0, on_result=_on_design_result)
+        finally:
+            ctx["windowed_reads"] = True
+        batch += multi_fidelity_design(param_ranges, ctx, settings, len(design), workers, batch[0],
+                                       first_iteration=1, on_result=_on_design_result)
+        design = [r["Parameters"] for r in batch[1:]]
+    else:
+        batch = evaluate_batch([None] + design, ctx, workers, first_iteration=0,
+                               on_result=_on_design_result)
+    iteration_counter = len(design)
+
+    # Prior data for the surrogate: every finite design point (and the baseline if in bounds)
+    x0, y0 = [], []
+    for result in batch:
+        metrics = result.get("Metrics")
+        if (result.get("Infeasible") or result.get("Failure") == "deterministic") \
+                and result["Iteration"] != 0 and np.isfinite(_penalty()):
+            x0.append(list(result["Parameters"]))
+            y0.append(_penalty())
+            continue
+        if metrics is None or not np.isfinite(metrics['RMSE']):
+            continue
+        if result["Iteration"] == 0 and not _in_bounds(result["Parameters"], param_ranges):
+            continue
+        x0.append(list(result["Parameters"]))
+        y0.append(float(metrics['RMSE']))
+
+    pending = {}
+    # Adaptive dimension reduction: indices still searched, and the frozen ones' values
+    reduction = {"active": list(range(len(param_ranges))), "values": {}, "request": None}
+    frozen = {}   # parameter name -> iteration it was frozen after
+    freeze_every = int(settings.get("freeze_after") or 0) if settings.get("freeze_insensitive") else 0
+    freeze_keep = max(1, int(settings.get("freeze_keep") or 1))
+
+    def _full(point):
+        """Reduced-space point → full parameter list (frozen parameters at their values)."""
+        values = dict(reduction["values"])
+        values.update(zip(reduction["active"], point))
+        return [values[i] for i in range(len(param_ranges))]
+
+    def _check_relevance(res):
+        """Ask to freeze the parameters the GP finds flat; True if some were found."""
+        scales = ard_length_scales(res)
+        if scales is None or best_params is None:
+            return False
+        active = reduction["active"]
+        flat = insensitive_dimensions(scales, float(settings.get("freeze_length_scale") or 10.0),
+                                      freeze_keep)
+        names = param_ranges_df['parameter_name'].astype(str).tolist()
+        log_message("    Relevance (ARD length scale): " + ", ".join(
+            f"{names[i]}={ls:.3g}" for i, ls in zip(active, scales)), logging.DEBUG)
+        if not flat:
+            return False
+        reduction["request"] = [active[j] for j in flat]
+        held = ", ".join(f"{names[active[j]]}="
+                         f"{format_parameter_value(best_params[active[j]], param_ranges_df.iloc[active[j]])}"
+                         f" (length scale {scales[j]:.3g})" for j in flat)
+        log_message(f"\n  ⊟ Freezing at the best values after iteration {iteration_counter}: {held}")
+        log_message(f"    Searching {len(active) - len(flat)} of {len(param_ranges)} parameter(s) from now on")
+        return True
+
+    def callback(res):
+        nonlocal iteration_counter
+        result = pending.pop("result", None)
+        if result is None:
+            return  # Prior data was just told to the optimizer; nothing new ran
+
+        iteration_counter += 1
+        try:
+            _record(result)
+            budget.observe(result, best_rmse)
+            eta = budget.eta(iteration_counter)
+            set_progress((iteration_counter / total_iterations) * 100, eta)
+            if eta is not None and iteration_counter < total_iterations:
+                log_message(f"    ETA {format_duration(eta)} "
+                            f"(≈ {datetime.fromtimestamp(time.time() + eta):%H:%M})")
+        except Exception as e:
+            log_message(f"  ✗ Iteration {iteration_counter} error: {e}")
+
+        if run_stopped(ctx):
+            raise CalibrationStopped("Stopped by user.")
+
+        reason = budget.exhausted() or budget.converged(res)
+        if reason:
+            log_message(f"\n  ⏹ Stopping early after {iteration_counter} iterations: {reason}")
+            return True  # tells gp_minimize to stop
+
+        searched = iteration_counter - len(design)
+        if freeze_every and searched % freeze_every == 0 and len(reduction["active"]) > freeze_keep \
+                and iteration_counter < total_iterations and _check_relevance(res):
+            return True  # restarts the optimizer in the reduced space
+
+    remaining = total_iterations - len(design)
+    try:
+        if run_stopped(ctx):
+            raise CalibrationStopped("Stopped by user.")
+        early = budget.exhausted()
+        if early and remaining > 0:
+            log_message(f"\n  ⏹ Skipping the optimizer: {early}")
+            remaining = 0
+        while remaining > 0:
+            active = reduction["active"]
+            if x0:
+                prior = {"x0": [[x[i] for i in active] for x in x0], "y0": y0, "n_initial_points": 0}
+            else:
+                prior = {"n_initial_points": min(10, remaining)}
+            reduction["request"] = None
+            res = gp_minimize(
+                lambda p: objective_function(_full(p), ctx, pending),
+                [param_ranges[i] for i in active],
+                n_calls=remaining,
+                callback=callback,
+                random_state=42,
+                n_jobs=1,
+                **prior
+            )
+            if not reduction["request"]:
+                break
+            # Everything run so far becomes prior data for the reduced search
+            told = len(prior.get("x0", []))
+            x0 = x0 + [_full(p) for p in res.x_iters[told:]]
+            y0 = y0 + [float(v) for v in res.func_vals[told:]]
+            names = param_ranges_df['parameter_name'].astype(str).tolist()
+            for i in reduction["request"]:
+                reduction["values"][i] = best_params[i]
+                frozen[names[i]] = iteration_counter
+            reduction["active"] = [i for i in active if i not in reduction["request"]]
+            remaining = total_iterations - iteration_counter
+        log_message("\n  ✓ Optimization complete.")
+    except CalibrationStopped as e:
+        log_message(f"\n  ⏹ {str(e).rstrip('.')}. Saving results...")
+    finally:
+        close_eval_context(ctx)
+
+    all_results.sort(key=lambda r: r["Iteration"])
+    return all_results, best_params, best_merged, best_metrics, best_iteration, frozen
+
+
+# =====================================================================
+#  RESULTS SAVING
+# =====================================================================
+def save_results(all_results, best_params, best_metrics, best_merged, best_iteration,
+                 param_ranges_df, target_var, depth, results_dir, frozen=None):
+    """Write <target>_calibration_results.xlsx. frozen: {parameter name: iteration after
+    which adaptive dimension reduction held it at its best value}."""
+    from openpyxl import Workbook
+    from openpyxl.chart import BarChart, LineChart, Reference
+    from openpyxl.styles import PatternFill
+    if not all_results:
+        log_message("No results to save.")
+        return
+
+    os.makedirs(results_dir, exist_ok=True)
+
+    if target_depths(target_var) and depth:
+        output_file = os.path.join(results_dir, f"{target_var.lower()}_{depth}_results.xlsx")
+    else:
+        output_file = os.path.join(results_dir, f"{target_var.lower()}_calibration_results.xlsx")
+
+    wb = Workbook()
+
+    # All Iterations
+    ws1 = wb.active
+    ws1.title = "All Iterations"
+    headers = ["Iteration"] + param_ranges_df['parameter_name'].tolist() + \
+              ["R2", "LR_R2", "RMSE", "nRMSE(%)", "MAE", "MBE"]
+    ws1.append(headers)
+
+    best_fill = PatternFill(start_color='90EE90', end_color='90EE90', fill_type='solid')
+    for result in all_results:
+        row = [result["Iteration"]] + list(result["Parameters"]) + [
+            result["Metrics"]["R2"], result["Metrics"]["LR_R2"],
+            result["Metrics"]["RMSE"], result["Metrics"]["nRMSE"],
+            result["Metrics"]["MAE"], result["Metrics"]["MBE"]
+        ]
+        ws1.append(row)
+        if result["Iteration"] == best_iteration:
+            for cell in ws1[ws1.max_row]:
+                cell.fill = best_fill
+
+    # Best Iteration
+    ws2 = wb.create_sheet("Best Iteration")
+    ws2.append(["Best Iter #"] + param_ranges_df['parameter_name'].tolist() +
+               ["R2", "LR_R2", "RMSE", "nRMSE(%)", "MAE", "MBE"])
+    if best_params is not None and best_metrics:
+        ws2.append([best_iteration, *best_params,
+                    best_metrics['R2'], best_metrics['LR_R2'],
+                    best_metrics['RMSE'], best_metrics['nRMSE'],
+                    best_metrics['MAE'], best_metrics['MBE']])
+    if frozen:
+        frozen_fill = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
+        ws2.append(["Frozen after iter"] + [frozen.get(name, "") for name in
+                                            param_ranges_df['parameter_name'].astype(str)])
+        for col, name in enumerate(param_ranges_df['parameter_name'].astype(str), start=2):
+            if name in frozen:
+                for row in range(1, ws2.max_row + 1):
+                    ws2.cell(row=row, column=col).fill = frozen_fill
+
+    # Data Comparison
+    ws3 = wb.create_sheet("Data Comparison")
+    if best_merged is not None and not best_merged.empty:
+        has_day = 'Day' in best_merged.columns
+        if has_day:
+            ws3.append(["Year", "Day", "Observed", "Modeled"])
+            for _, r in best_merged.iterrows():
+                ws3.append([r['Year'], r['Day'], r[f"{target_var}_OBS"], r[f"{target_var}_MOD"]])
+        else:
+            ws3.append(["Year", "Observed", "Modeled"])
+            for _, r in best_merged.iterrows():
+                ws3.append([r['Year'], r[f"{target_var}_OBS"], r[f"{target_var}_MOD"]])
+
+        ChartClass = LineChart if has_day else BarChart
+        chart = ChartClass()
+        chart.title = f"{target_var}{f' @ {depth}' if depth else ''} — Best Calibration"
+        chart.style = 2
+        chart.width = 28
+        chart.height = 14
+        data_col_start = 3 if has_day else 2
+        data = Reference(ws3, min_col=data_col_start, max_col=data_col_start + 1,
+                         min_row=1, max_row=len(best_merged) + 1)
+        cats = Reference(ws3, min_col=1, min_row=2, max_row=len(best_merged) + 1)
+        chart.add_data(data, titles_from_data=True)
+        chart.set_categories(cats)
+        if len(chart.series) >= 2:
+            chart.series[0].graphicalProperties.solidFill = "4DC4E3"
+            chart.series[1].graphicalProperties.solidFill = "FF6F61"
+        # Legend outside plot area — bottom, no overlap
+        from openpyxl.chart.layout import Layout, ManualLayout
+        from openpyxl.chart.legend import Legend
+        chart.legend = Legend()
+        chart.legend.position = 'b'
+        ws3.add_chart(chart, "F2")
+
+    # Iteration Data — modeled values from each iteration side by side
+    ws4 = wb.create_sheet("Iteration Data")
+    if all_results:
+        # Determine structure from first result's Merged_Data
+        sample_merged = all_results[0].get("Merged_Data")
+        if sample_merged is not None and not sample_merged.empty:
+            has_day = 'Day' in sample_merged.columns
+            mod_col = f"{target_var}_MOD"
+
+            # Header row
+            if has_day:
+                header = ["Year", "Day"] + [f"Iteration {r['Iteration']}" for r in all_results]
+            else:
+                header = ["Year"] + [f"Iteration {r['Iteration']}" for r in all_results]
+            ws4.append(header)
+
+            # Build a dict of iteration data keyed by (Year,) or (Year, Day)
+            # Use the merged data from each iteration
+            all_keys = []
+            iter_data = {}
+            for result in all_results:
+                md = result.get("Merged_Data")
+                if md is None or md.empty:
+                    continue
+                it = result["Iteration"]
+                iter_data[it] = {}
+                for _, row in md.iterrows():
+                    if has_day:
+                        key = (int(row['Year']), int(row['Day']))
+                    else:
+                        key = (int(row['Year']),)
+                    if key not in all_keys:
+                        all_keys.append(key)
+                    iter_data[it][key] = row[mod_col]
+
+            # Sort keys
+            all_keys.sort()
+
+            # Write rows
+            for key in all_keys:
+                if has_day:
+                    row = [key[0], key[1]]
+                else:
+                    row = [key[0]]
+                for result in all_results:
+                    it = result["Iteration"]
+                    row.append(iter_data.get(it, {}).get(key, ""))
+                ws4.append(row)
+
+    # Save with graceful handling if file is locked/open
+    for attempt in range(10):
+        try:
+            wb.save(output_file)
+            log_message(f"  ✓ Results saved: {output_file}")
+            break
+        except PermissionError:
+            if attempt == 0:
+                log_message(f"  ⚠ Cannot write to {os.path.basename(output_file)} — file may be open in Excel.")
+            # Try incremented filename
+            base, ext = os.path.splitext(output_file)
+            # Strip any existing _N suffix before adding new one
+            import re
+            base_clean = re.sub(r'_\d+$', '', base)
+            output_file = f"{base_clean}_{attempt + 1}{ext}"
+            if attempt == 9:
+                log_message(f"  ✗ Could not save results after 10 attempts. Close Excel and re-run.")
+            else:
+                continue
+
+
+# =====================================================================
+#  CALIBRATION CATALOG
+#  Every finished calibration is indexed in one SQLite file (by default
+#  next to DNDC; point "catalog_file" at a shared drive for a team):
+#  site descriptors read from the .dnd, parameter ranges and best values,
+#  and all scored runs. A new calibration can seed its initial design with
+#  the best sets of the most similar earlier calibrations ("warm_start").
+# =====================================================================
+CATALOG_FILE = os.path.join(ROOT_FOLDER, "calibration_catalog.sqlite")
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calibrations (
+    id INTEGER PRIMARY KEY, finished REAL, site TEXT, target TEXT, depth TEXT,
+    dnd_path TEXT, dnd_hash TEXT, param_csv_hash TEXT, observed_hash TEXT,
+    rmse REAL, r2 REAL, best_iteration INTEGER, n_runs INTEGER, descriptors TEXT);
+CREATE TABLE IF NOT EXISTS parameters (
+    calibration_id INTEGER REFERENCES calibrations(id) ON DELETE CASCADE,
+    position INTEGER, name TEXT, line_number INTEGER, low, high, best);
+CREATE TABLE IF NOT EXISTS runs (
+    calibration_id INTEGER REFERENCES calibrations(id) ON DELETE CASCADE,
+    iteration INTEGER, rmse REAL, params TEXT);
+CREATE INDEX IF NOT EXISTS calibrations_target ON calibrations(target, depth);
+CREATE INDEX IF NOT EXISTS parameters_calibration ON parameters(calibration_id);
+CREATE INDEX IF NOT EXISTS runs_calibration ON runs(calibration_id);
+"""
+
+def open_catalog(path=None):
+    """sqlite3 connection to the catalog (created on first use); rows behave like dicts."""
+    import sqlite3
+    con = sqlite3.connect(path or CATALOG_FILE, timeout=30)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA foreign_keys = ON")
+    con.executescript(CATALOG_SCHEMA)
+    return con
+
+def site_descriptors(lines, keys=None, skip_lines=()):
+    """{key: value} of the .dnd's "Name number" lines (optionally only the given keys),
+    except skip_lines (the calibrated parameters: their values are results, not site facts).
+    A key repeated further down (e.g. one block per crop) becomes Name#2, Name#3, ..."""
+    wanted = {k.lower() for k in keys} if keys else None
+    seen, descriptors = {}, {}
+    for i, line in enumerate(lines):
+        if i in skip_lines:
+            continue
+        parts = line.strip().split()
+        if len(parts) < 2 or (wanted is not None and parts[0].lower() not in wanted):
+            continue
+        try:
+            value = float(parts[1])
+        except ValueError:
+            continue
+        seen[parts[0]] = seen.get(parts[0], 0) + 1
+        name = parts[0] if seen[parts[0]] == 1 else f"{parts[0]}#{seen[parts[0]]}"
+        descriptors[name] = value
+    return descriptors
+
+def descriptor_distance(a, b):
+    """Mean relative difference over the descriptors both sites have (None if they share none)."""
+    shared = [k for k in a if k in b]
+    if not shared:
+        return None
+    return float(np.mean([abs(a[k] - b[k]) / max(abs(a[k]), abs(b[k]), 1e-9) for k in shared]))
+
+def record_calibration(site, target_var, depth, lines, dnd_file, param_csv, observed_csv,
+                       param_ranges_df, all_results, best_params, best_metrics, best_iteration,
+                       settings=None):
+    """Add one finished calibration to the catalog. Returns its id (None if it could not be stored)."""
+    settings = settings or {}
+    names = param_ranges_df['parameter_name'].astype(str).tolist()
+    descriptors = site_descriptors(lines, settings.get("catalog_descriptors"),
+                                   set(param_ranges_df['line_number'].astype(int)))
+
+    def _plain(v):
+        return v.item() if hasattr(v, "item") else v
+    try:
+        con = open_catalog(settings.get("catalog_file"))
+        try:
+            with con:
+                cur = con.execute(
+                    "INSERT INTO calibrations (finished, site, target, depth, dnd_path, dnd_hash, "
+                    "param_csv_hash, observed_hash, rmse, r2, best_iteration, n_runs, descriptors) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), site, target_var, depth or "", os.path.abspath(dnd_file),
+                     hashlib.sha1("".join(lines).encode("utf-8")).hexdigest(),
+                     _file_digest(param_csv), _file_digest(observed_csv),
+                     float(best_metrics['RMSE']), float(best_metrics.get('R2', np.nan)), best_iteration,
+                     len(all_results), json.dumps(descriptors)))
+                cal_id = cur.lastrowid
+                con.executemany(
+                    "INSERT INTO parameters VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(cal_id, i, names[i], int(row['line_number']), _plain(row['min']), _plain(row['max']),
+                      _plain(best_params[i]))
+                     for i, (_, row) in enumerate(param_ranges_df.iterrows())])
+                con.executemany(
+                    "INSERT INTO runs VALUES (?, ?, ?, ?)",
+                    [(cal_id, r["Iteration"], float(r["Metrics"]['RMSE']),
+                      json.dumps([_plain(v) for v in r["Parameters"]]))
+                     for r in all_results if np.isfinite(r["Metrics"]['RMSE'])])
+        finally:
+            con.close()
+    except Exception as e:
+        log_message(f"  ⚠ Calibration not added to the catalog: {e}")
+        return None
+    log_message(f"  ✓ Added to the calibration catalog (#{cal_id})", logging.DEBUG)
+    return cal_id
+
+def similar_calibrations(lines, target_var, depth, param_ranges_df, k=5, settings=None):
+    """Up to k earlier calibrations of target_var sharing at least one parameter, most similar
+    site first: [{"id", "site", "rmse", "finished", "distance", "best": {name: value}}]."""
+    settings = settings or {}
+    path = settings.get("catalog_file") or CATALOG_FILE
+    if not os.path.exists(path):
+        return []
+    param_names = set(param_ranges_df['parameter_name'].astype(str))
+    mine = site_descriptors(lines, settings.get("catalog_descriptors"),
+                            set(param_ranges_df['line_number'].astype(int)))
+    con = open_catalog(path)
+    try:
+        rows = con.execute("SELECT * FROM calibrations WHERE target = ? AND depth = ?",
+                           (target_var, depth or "")).fetchall()
+        found = []
+        for row in rows:
+            best = {p["name"]: p["best"] for p in con.execute(
+                "SELECT name, best FROM parameters WHERE calibration_id = ? ORDER BY position", (row["id"],))}
+            if not set(best) & param_names:
+                continue
+            distance = descriptor_distance(mine, json.loads(row["descriptors"] or "{}"))
+            found.append({"id": row["id"], "site": row["site"], "rmse": row["rmse"],
+                          "finished": row["finished"], "distance": distance, "best": best})
+    finally:
+        con.close()
+    # Unknown distance (no shared descriptors) ranks last; ties go to the newer calibration
+    found.sort(key=lambda c: (c["distance"] is None, c["distance"] or 0.0, -c["finished"]))
+    return found[:k]
+
+def _fit_to_dimension(value, dim, fallback):
+    """value moved into dim (clipped / rounded), or fallback if it cannot be."""
+    from skopt.space import Integer, Categorical
+    if isinstance(dim, Categorical):
+        return value if value in dim.categories else fallback
+    try:
+        value = float(np.clip(float(value), dim.low, dim.high))
+    except (TypeError, ValueError):
+        return fallback
+    return int(round(value)) if isinstance(dim, Integer) else value
+
+def warm_start_points(param_ranges, param_ranges_df, lines, target_var, depth, settings):
+    """Best parameter sets of the warm_start most similar catalogued calibrations, mapped onto
+    this parameter CSV by name (parameters they did not calibrate keep the .dnd's values)."""
+    k = int(settings.get("warm_start") or 0)
+    if k <= 0:
+        return []
+    names = param_ranges_df['parameter_name'].astype(str).tolist()
+    try:
+        similar = similar_calibrations(lines, target_var, depth, param_ranges_df, k, settings)
+    except Exception as e:
+        log_message(f"  ⚠ Calibration catalog unavailable: {e}")
+        return []
+    current = read_current_values(lines, param_ranges_df)
+    center = _box_center(param_ranges)
+    points = []
+    for cal in similar:
+        point = []
+        for name, dim, now, mid in zip(names, param_ranges, current, center):
+            fallback = now if now in dim else mid
+            point.append(_fit_to_dimension(cal["best"][name], dim, fallback) if name in cal["best"]
+                         else fallback)
+        if point not in points:
+            points.append(point)
+        distance = "n/a" if cal["distance"] is None else f"{cal['distance']:.2f}"
+        log_message(f"    ↳ warm start from #{cal['id']} {cal['site']} "
+                    f"(RMSE={cal['rmse']:.4g}, site distance {distance})")
+    return points
+
+
+# =====================================================================
+#  UNCERTAINTY QUANTIFICATION  (GLUE / DREAM-style MCMC)
+#  Both samplers run on the same parallel, cached evaluation pipeline;
+#  "Iterations" is the DNDC run budget.
+# =====================================================================
+UQ_METHODS = ["GLUE", "DREAM"]
+
+def weighted_quantile(values, quantiles, weights=None):
+    """Quantiles of values under (optional) sample weights."""
+    values = np.asarray(values, dtype=float)
+    weights = np.ones_like(values) if weights is None else np.asarray(weights, dtype=float)
+    ok = np.isfinite(values)
+    values, weights = values[ok], weights[ok]
+    if values.size == 0:
+        return np.full(len(quantiles), np.nan)
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cdf = (np.cumsum(weights) - 0.5 * weights) / np.sum(weights)
+    return np.interp(quantiles, cdf, values)
+
+def _log_likelihood(result):
+    """Gaussian log-likelihood with the error variance integrated out: -n/2·log(SSE/n)."""
+    metrics = result.get("Metrics")
+    if metrics is None or not np.isfinite(metrics['RMSE']):
+        return -np.inf
+    n = max(1, len(result["Merged_Data"]))
+    return -0.5 * n * np.log(max(metrics['RMSE'] ** 2, 1e-300))
+
+def glue_sample(param_ranges, ctx, settings, workers, on_result=None):
+    """GLUE: LHS over the prior box; runs with NSE (R²) >= glue_threshold are behavioural
+    and weighted by how far they clear the threshold. Returns (results, weights)."""
+    n_samples = int(settings["iterations"])
+    threshold = float(settings.get("glue_threshold", 0.5))
+    design = build_initial_design(param_ranges, "LHS", n_samples, settings.get("random_state", 42))
+    log_message(f"\n  GLUE: {n_samples} LHS samples on {workers} worker(s), behavioural NSE ≥ {threshold}")
+    results = evaluate_batch(design, ctx, workers, first_iteration=1, on_result=on_result)
+
+    behavioural = [r for r in results if r.get("Metrics") and r["Metrics"]['R2'] >= threshold]
+    log_message(f"  {len(behavioural)}/{len(results)} behavioural runs")
+    if not behavioural:
+        return [], []
+    weights = np.array([r["Metrics"]['R2'] - threshold for r in behavioural], dtype=float)
+    weights = weights / weights.sum() if weights.sum() > 0 else np.full(len(behavioural), 1.0 / len(behavioural))
+    return behavioural, list(weights)
+
+def _reflect(x, lo, hi):
+    """Fold a proposal back into [lo, hi]."""
+    span = hi - lo
+    y = np.mod(x - lo, 2 * span)
+    return lo + np.where(y > span, 2 * span - y, y)
+
+def gelman_rubin(chains):
+    """R-hat per parameter for an array shaped (n_chains, n_steps, n_params)."""
+    chains = np.asarray(chains, dtype=float)
+    n = chains.shape[1]
+    if n < 2:
+        return np.full(chains.shape[2], np.nan)
+    w = chains.var(axis=1, ddof=1).mean(axis=0)
+    b = n * chains.mean(axis=1).var(axis=0, ddof=1)
+    var_hat = (n - 1) / n * w + b / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(var_hat / w)
+
+def dream_sample(param_ranges, ctx, settings, workers, on_result=None):
+    """Multi-chain DREAM-style MCMC (differential evolution proposals, randomized
+    subspace crossover, uniform prior on the parameter box). Each generation's
+    proposals are evaluated as one parallel batch. Returns (posterior results, weights)."""
+    from skopt.space import Space
+    rng = np.random.default_rng(settings.get("random_state", 42))
+    # Chains move in the normalized space, so log-uniform priors stay uniform there
+    space = Space(param_ranges)
+    space.set_transformer("normalize")
+    lo, hi = np.zeros(space.n_dims), np.ones(space.n_dims)
+    d = space.n_dims
+    n_chains = max(3, int(settings.get("dream_chains") or max(3, workers)))
+    n_gen = max(2, int(np.ceil(int(settings["iterations"]) / n_chains)))
+    log_message(f"\n  DREAM: {n_chains} chains × {n_gen} generations on {workers} worker(s)")
+
+    design = build_initial_design(param_ranges, "LHS", n_chains, settings.get("random_state", 42))
+    X = np.array(space.transform(design), dtype=float)
+    current = evaluate_batch(design, ctx, workers, first_iteration=1, on_result=on_result)
+    logp = np.array([_log_likelihood(r) for r in current])
+    states, accepted = [list(current)], 0
+    next_iteration = 1 + n_chains
+
+    for g in range(1, n_gen):
+        if run_stopped(ctx):
+            break
+        proposals = []
+        for i in range(n_chains):
+            others = [j for j in range(n_chains) if j != i]
+            delta = 1 if n_chains < 5 else int(rng.integers(1, 3))
+            picks = rng.choice(others, size=2 * delta, replace=False)
+            diff = X[picks[:delta]].sum(axis=0) - X[picks[delta:]].sum(axis=0)
+            mask = rng.random(d) < rng.choice([1 / 3, 2 / 3, 1.0])
+            if not mask.any():
+                mask[rng.integers(d)] = True
+            gamma = 1.0 if g % 5 == 0 else 2.38 / np.sqrt(2 * delta * mask.sum())
+            z = X[i] + (1 + rng.uniform(-0.05, 0.05, d)) * gamma * diff + rng.normal(0, 1e-6, d) * (hi - lo)
+            proposals.append(list(_reflect(np.where(mask, z, X[i]), lo, hi)))
+
+        batch = evaluate_batch(space.inverse_transform(np.array(proposals)), ctx, workers,
+                               first_iteration=next_iteration, on_result=on_result)
+        next_iteration += n_chains
+        for i, result in enumerate(batch):
+            lp = _log_likelihood(result)
+            if np.log(rng.random()) < lp - logp[i]:
+                X[i], logp[i], current[i] = proposals[i], lp, result
+                accepted += 1
+        states.append(list(current))
+
+    burn = len(states) // 2
+    posterior_states = states[burn:]
+    chains = np.array([[r["Parameters"] for r in gen] for gen in posterior_states]).transpose(1, 0, 2)
+    rhat = gelman_rubin(chains)
+    n_props = max(1, (len(states) - 1) * n_chains)
+    log_message(f"  Acceptance rate: {accepted / n_props:.1%}  ·  burn-in: {burn} generations")
+    log_message("  R-hat: " + ", ".join(f"{v:.2f}" for v in rhat) + "  (≤1.2 suggests convergence)")
+    posterior = [r for gen in posterior_states for r in gen if r.get("Metrics")]
+    weights = [1.0 / len(posterior)] * len(posterior) if posterior else []
+    return posterior, weights
+
+def summarize_uncertainty(samples, weights, param_names, target_var, quantiles=(0.025, 0.5, 0.975)):
+    """Posterior table, per-parameter credible intervals and prediction bands."""
+    rows = []
+    for r, w in zip(samples, weights):
+        row = {"Iteration": r["Iteration"], "Weight": w}
+        row.update(zip(param_names, r["Parameters"]))
+        row.update({"RMSE": r["Metrics"]['RMSE'], "R2": r["Metrics"]['R2']})
+        rows.append(row)
+    samples_df = pd.DataFrame(rows)
+
+    intervals = []
+    for name in param_names:
+        lo_q, med, hi_q = weighted_quantile(samples_df[name], quantiles, samples_df["Weight"])
+        mean = np.average(samples_df[name], weights=samples_df["Weight"])
+        intervals.append({"Parameter": name, "Mean": mean, "Lower": lo_q, "Median": med, "Upper": hi_q})
+    intervals_df = pd.DataFrame(intervals)
+
+    mod_col, obs_col = f"{target_var}_MOD", f"{target_var}_OBS"
+    keys = ['Year', 'Day'] if 'Day' in samples[0]["Merged_Data"].columns else ['Year']
+    frames = []
+    for i, (r, w) in enumerate(zip(samples, weights)):
+        md = r["Merged_Data"][keys + [obs_col, mod_col]].copy()
+        md["_w"] = w
+        frames.append(md)
+    long_df = pd.concat(frames, ignore_index=True)
+    band_rows = []
+    for key, grp in long_df.groupby(keys, sort=True):
+        key = key if isinstance(key, tuple) else (key,)
+        lo_q, med, hi_q = weighted_quantile(grp[mod_col], quantiles, grp["_w"])
+        band_rows.append(dict(zip(keys, key), Observed=grp[obs_col].iloc[0],
+                              Lower=lo_q, Median=med, Upper=hi_q))
+    bands_df = pd.DataFrame(band_rows)
+    if not bands_df.empty:
+        inside = (bands_df["Observed"] >= bands_df["Lower"]) & (bands_df["Observed"] <= bands_df["Upper"])
+        bands_df.attrs["coverage"] = float(inside.mean())
+    return samples_df, intervals_df, bands_df
+
+def save_uq_results(method, samples_df, intervals_df, bands_df, target_var, depth, results_dir):
+    from openpyxl import Workbook
+    from openpyxl.chart import BarChart, LineChart, Reference
+    os.makedirs(results_dir, exist_ok=True)
+    label = f"{target_var.lower()}{f'_{depth}' if depth else ''}"
+    output_file = os.path.join(results_dir, f"{label}_uncertainty_{method.lower()}.xlsx")
+
+    wb = Workbook()
+    ws1 = wb.active
+    ws1.title = "Credible Intervals"
+    ws1.append(["Parameter", "Mean", "2.5%", "Median", "97.5%"])
+    for _, r in intervals_df.iterrows():
+        ws1.append([r["Parameter"], r["Mean"], r["Lower"], r["Median"], r["Upper"]])
+
+    ws2 = wb.create_sheet("Posterior Samples")
+    ws2.append(list(samples_df.columns))
+    for row in samples_df.itertuples(index=False):
+        ws2.append(list(row))
+
+    ws3 = wb.create_sheet("Prediction Bands")
+    if not bands_df.empty:
+        cols = list(bands_df.columns)
+        ws3.append(cols[:-4] + ["Observed", "2.5%", "Median", "97.5%"])
+        for row in bands_df.itertuples(index=False):
+            ws3.append(list(row))
+        coverage = bands_df.attrs.get("coverage")
+        has_day = 'Day' in cols
+        chart = (LineChart if has_day else BarChart)()
+        chart.title = f"{target_var}{f' @ {depth}' if depth else ''} — 95% prediction band ({method})"
+        chart.style = 2
+        chart.width = 28
+        chart.height = 14
+        first = 3 if has_day else 2
+        data = Reference(ws3, min_col=first, max_col=first + 3, min_row=1, max_row=len(bands_df) + 1)
+        cats = Reference(ws3, min_col=1, min_row=2, max_row=len(bands_df) + 1)
+        chart.add_data(data, titles_from_data=True)
+        chart.set_categories(cats)
+        ws3.add_chart(chart, "H2")
+        if coverage is not None:
+            ws1.append([])
+            ws1.append(["Observations inside 95% band", coverage])
+
+    try:
+        wb.save(output_file)
+        log_message(f"  ✓ Uncertainty results saved: {output_file}")
+    except PermissionError:
+        log_message(f"  ✗ Cannot write {os.path.basename(output_file)} — close it in Excel and re-run.")
+
+def run_uncertainty(method, param_ranges, param_ranges_df, lines, target_var, depth,
+                    paths, batch_file, dnd_file, observed_csv,
+                    save_dnd_backups, save_iter_results, settings=None):
+    """Sample parameter uncertainty with GLUE or DREAM and write the UQ workbook."""
+    from skopt.space import Categorical
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    workers = max(1, int(settings.get("workers") or 1))
+    total = max(1, int(settings["iterations"]))
+    log_message(f"\n{'━'*50}")
+    log_message(f"  Uncertainty ({method}): {target_var}{f' @ {depth}' if depth else ''}")
+    log_message(f"{'━'*50}")
+
+    if any(isinstance(d, Categorical) for d in param_ranges):
+        log_message(f"✗ {method} needs numeric parameters; remove the categorical ones.")
+        return
+    os.makedirs(paths["results_dir"], exist_ok=True)
+    if save_dnd_backups:
+        os.makedirs(os.path.join(paths["results_dir"], "dnd_backups"), exist_ok=True)
+    ctx = make_eval_context(param_ranges_df, lines, target_var, depth, paths, batch_file, dnd_file,
+                            observed_csv, save_dnd_backups, save_iter_results, settings)
+
+    done = [0]
+    lock = threading.Lock()
+    def _on_result(result):
+        with lock:
+            done[0] += 1
+            n = done[0]
+        if n % max(1, workers) == 0 or n == total:
+            set_progress(min(100, n / total * 100))
+
+    sampler = glue_sample if method == "GLUE" else dream_sample
+    try:
+        samples, weights = sampler(param_ranges, ctx, settings, workers, _on_result)
+    finally:
+        close_eval_context(ctx)
+    if run_stopped(ctx):
+        log_message("\n  ⏹ Stopped by user. Summarizing samples so far...")
+    if not samples:
+        log_message("⚠ No usable samples — widen the parameter ranges or lower the GLUE threshold.")
+        return None
+
+    param_names = param_ranges_df['parameter_name'].tolist()
+    samples_df, intervals_df, bands_df = summarize_uncertainty(samples, weights, param_names, target_var)
+    for _, r in intervals_df.iterrows():
+        log_message(f"    {r['Parameter']}: {r['Median']:.4g}  [{r['Lower']:.4g}, {r['Upper']:.4g}]")
+    if "coverage" in bands_df.attrs:
+        log_message(f"    Observations inside 95% band: {bands_df.attrs['coverage']:.0%}")
+    save_uq_results(method, samples_df, intervals_df, bands_df, target_var, depth, paths["results_dir"])
+    return samples_df, intervals_df, bands_df
+
+
+# =====================================================================
+#  OFFLINE RE-SCORING
+#  Re-evaluate saved iteration_outputs/iter_NNNN folders against any
+#  target / depth / observed file without running DNDC again.
+# =====================================================================
+def _rescore_iteration(iter_dir, target_var, observed_csv, depth):
+    """Process-pool worker: parse one saved iteration and score it."""
+    iteration = int(os.path.basename(iter_dir).split("_")[1])
+    modeled_df, observed_df = read_target_data(target_var, get_modeled_paths(iter_dir),
+                                               observed_csv, depth)
+    metrics, merged_df = match_and_evaluate(modeled_df, observed_df, target_var)
+    return iteration, metrics, merged_df
+
+def find_saved_iterations(results_dir):
+    """Sorted iter_NNNN folders under results_dir/iteration_outputs."""
+    iter_root = os.path.join(results_dir, "iteration_outputs")
+    if not os.path.isdir(iter_root):
+        return []
+    return sorted(os.path.join(iter_root, d) for d in os.listdir(iter_root)
+                  if re.fullmatch(r"iter_\d+", d) and os.path.isdir(os.path.join(iter_root, d)))
+
+def _saved_parameters(results_dir, iteration, param_ranges_df):
+    """Parameter values of a saved iteration, recovered from its .dnd backup."""
+    if param_ranges_df.empty:
+        return []
+    name = "iter_0000_baseline.dnd" if iteration == 0 else f"iter_{iteration:04d}.dnd"
+    backup = os.path.join(results_dir, "dnd_backups", name)
+    if not os.path.exists(backup):
+        return [np.nan] * len(param_ranges_df)
+    return read_current_values(read_dnd_file(backup), param_ranges_df)
+
+def rescore_results(results_dir, target_var, observed_csv, depth=None,
+                    param_csv=None, workers=None, output_dir=None):
+    """Score every saved iteration in a process pool and write a fresh ranking + report.
+    Returns the all_results-style list, best first."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    iter_dirs = find_saved_iterations(results_dir)
+    if not iter_dirs:
+        log_message(f"✗ No saved iterations under {results_dir}")
+        return []
+    if not check_file_exists(observed_csv):
+        return []
+
+    param_ranges_df = read_param_ranges(param_csv) if param_csv else pd.DataFrame()
+    if param_ranges_df.empty:
+        param_ranges_df = pd.DataFrame(columns=["parameter_name", "min", "max", "line_number"])
+
+    log_message(f"  Re-scoring {len(iter_dirs)} saved iterations: "
+                f"{target_var}{f' @ {depth}' if depth else ''} vs {os.path.basename(observed_csv)}")
+    started = time.time()
+    n = len(iter_dirs)
+    with ProcessPoolExecutor(max_workers=workers or None, initializer=register_output_schemas,
+                             initargs=(output_schema_settings(),)) as pool:
+        scored = list(pool.map(_rescore_iteration, iter_dirs, [target_var] * n,
+                               [observed_csv] * n, [depth] * n))
+
+    all_results = []
+    for iteration, metrics, merged_df in scored:
+        if metrics is None:
+            log_message(f"  ⚠ iter_{iteration:04d}: no matching data")
+            continue
+        all_results.append({
+            "Iteration": iteration,
+            "Parameters": _saved_parameters(results_dir, iteration, param_ranges_df),
+            "Metrics": metrics, "Merged_Data": merged_df,
+        })
+    log_message(f"  ✓ Scored {len(all_results)}/{n} iterations in {time.time() - started:.1f}s")
+    if not all_results:
+        return []
+
+    ranked = sorted(all_results, key=lambda r: r["Metrics"]['RMSE'])
+    best = ranked[0]
+    output_dir = output_dir or os.path.join(results_dir, "rescored")
+    os.makedirs(output_dir, exist_ok=True)
+
+    label = f"{target_var.lower()}{f'_{depth}' if depth else ''}"
+    ranking_csv = os.path.join(output_dir, f"{label}_ranking.csv")
+    rows = []
+    for rank, r in enumerate(ranked, start=1):
+        row = {"Rank": rank, "Iteration": r["Iteration"]}
+        row.update(zip(param_ranges_df['parameter_name'], r["Parameters"]))
+        row.update(r["Metrics"])
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(ranking_csv, index=False)
+    log_message(f"  ✓ Ranking saved: {ranking_csv}")
+
+    save_results(all_results, best["Parameters"], best["Metrics"], best["Merged_Data"],
+                 best["Iteration"], param_ranges_df, target_var, depth, output_dir)
+
+    for rank, r in enumerate(ranked[:5], start=1):
+        m = r["Metrics"]
+        log_message(f"    #{rank}  iter_{r['Iteration']:04d}  RMSE={m['RMSE']:.4f}  "
+                    f"R²={m['R2']:.4f}  nRMSE={m['nRMSE']:.1f}%")
+    return ranked
+
+
+# =====================================================================
+#  CROSS-VALIDATION
+#  Split the observed years into calibration / validation folds and check
+#  how the top-K candidates do on years they were not selected on.
+# =====================================================================
+CV_SCHEMES = ["kfold", "rolling"]
+
+def year_folds(years, scheme="kfold", n_folds=5):
+    """[(calibration_years, validation_years)] over the sorted observed years.
+    kfold: contiguous blocks of years (blocked k-fold).
+    rolling: rolling origin — calibrate on all years before each of the last n_folds years."""
+    years = sorted(set(int(y) for y in years))
+    if len(years) < 2:
+        return []
+    n_folds = max(1, min(int(n_folds), len(years) - (1 if scheme == "rolling" else 0)))
+    if scheme == "rolling":
+        return [(years[:i], [years[i]]) for i in range(len(years) - n_folds, len(years))]
+    if n_folds < 2:
+        n_folds = 2
+    blocks = [list(b) for b in np.array_split(years, min(n_folds, len(years)))]
+    return [([y for y in years if y not in b], [int(y) for y in b]) for b in blocks]
+
+def _fold_metrics(merged, target_var, years):
+    part = merged[merged["Year"].isin(years)]
+    if len(part) < 2:
+        return None
+    return calculate_metrics(part[f"{target_var}_OBS"], part[f"{target_var}_MOD"])
+
+def cross_validate(candidates, target_var, scheme="kfold", n_folds=5, top_k=None):
+    """Fold-by-fold scores of candidates (all_results-style dicts with Merged_Data).
+    Each fold ranks every candidate by RMSE on its calibration years only and scores its
+    top_k on the held-out years, so validation years never decide what gets validated.
+    Returns (fold_rows, candidate_rows); candidate_rows hold the candidates some fold
+    picked, ranked by mean validation RMSE over the folds that picked them."""
+    candidates = [c for c in candidates if c.get("Merged_Data") is not None and not c["Merged_Data"].empty]
+    if not candidates:
+        return [], []
+    years = pd.concat([c["Merged_Data"]["Year"] for c in candidates]).unique()
+    folds = year_folds(years, scheme, n_folds)
+    fold_rows = []
+    val_rmse, picked_by = {}, {}
+    for f, (cal_years, val_years) in enumerate(folds, start=1):
+        ranked = []
+        for c in candidates:
+            cal = _fold_metrics(c["Merged_Data"], target_var, cal_years)
+            if cal is not None and np.isfinite(cal["RMSE"]):
+                ranked.append((cal["RMSE"], c, cal))
+        ranked.sort(key=lambda t: t[0])
+        scored = []
+        for _, c, cal in ranked[:top_k or len(ranked)]:
+            val = _fold_metrics(c["Merged_Data"], target_var, val_years)
+            if val is None:
+                continue
+            val_rmse.setdefault(c["Iteration"], []).append(val["RMSE"])
+            picked_by[c["Iteration"]] = c
+            scored.append((c["Iteration"], cal, val))
+        if not scored:
+            continue
+        # The candidate this fold's calibration years would have picked
+        it, cal, val = scored[0]
+        fold_rows.append({
+            "Fold": f, "Calibration_Years": f"{min(cal_years)}-{max(cal_years)}" if cal_years else "",
+            "Validation_Years": ",".join(str(y) for y in val_years), "Selected_Iteration": it,
+            "Cal_RMSE": cal["RMSE"], "Val_RMSE": val["RMSE"], "Val_R2": val["R2"],
+            "Val_nRMSE": val["nRMSE"], "Val_MBE": val["MBE"],
+        })
+    candidate_rows = []
+    for c in picked_by.values():
+        scores = val_rmse[c["Iteration"]]
+        candidate_rows.append({
+            "Iteration": c["Iteration"], "Parameters": c["Parameters"],
+            "In_Sample_RMSE": c["Metrics"]["RMSE"] if c.get("Metrics") else np.nan,
+            "Mean_Val_RMSE": float(np.mean(scores)) if scores else np.nan,
+            "SD_Val_RMSE": float(np.std(scores)) if len(scores) > 1 else np.nan,
+            "Folds": len(scores),
+        })
+    candidate_rows.sort(key=lambda r: (np.isnan(r["Mean_Val_RMSE"]), r["Mean_Val_RMSE"]))
+    for rank, row in enumerate(candidate_rows, start=1):
+        row["Robust_Rank"] = rank
+    return fold_rows, candidate_rows
+
+def save_validation(fold_rows, candidate_rows, param_ranges_df, target_var, depth, results_dir, scheme):
+    """Write <target>_validation_<scheme>.xlsx with Folds and Candidates sheets."""
+    if not candidate_rows:
+        log_message("⚠ Nothing to validate (no candidates with matched data).")
+        return None
+    label = f"{target_var.lower()}{f'_{depth}' if depth else ''}"
+    output_file = os.path.join(results_dir, f"{label}_validation_{scheme}.xlsx")
+    names = param_ranges_df['parameter_name'].tolist()
+    cand = []
+    for row in candidate_rows:
+        row = dict(row)
+        params = row.pop("Parameters") or []
+        row.update(zip(names, params))
+        cand.append(row)
+    cand_df = pd.DataFrame(cand)
+    cand_df = cand_df[["Robust_Rank", "Iteration"] + names +
+                      ["In_Sample_RMSE", "Mean_Val_RMSE", "SD_Val_RMSE", "Folds"]]
+    try:
+        with pd.ExcelWriter(output_file) as writer:
+            pd.DataFrame(fold_rows).to_excel(writer, sheet_name="Folds", index=False)
+            cand_df.to_excel(writer, sheet_name="Candidates", index=False)
+    except PermissionError:
+        output_file = output_file[:-5] + ".csv"
+        cand_df.to_csv(output_file, index=False)
+        log_message("  ⚠ Validation workbook is open in Excel; candidate table written as CSV.")
+    log_message(f"  ✓ Validation saved: {output_file}")
+    if fold_rows:
+        val = [r["Val_RMSE"] for r in fold_rows]
+        log_message(f"    Out-of-sample RMSE over {len(fold_rows)} fold(s): "
+                    f"{np.mean(val):.4f} ± {np.std(val):.4f}")
+    best = candidate_rows[0]
+    log_message(f"    Most robust: iteration {best['Iteration']}  "
+                f"mean validation RMSE={best['Mean_Val_RMSE']:.4f}  (in-sample {best['In_Sample_RMSE']:.4f})")
+    return output_file
+
+def validate_top_candidates(all_results, ctx, target_var, depth, param_ranges_df, results_dir,
+                            scheme="kfold", n_folds=5, top_k=10, workers=1):
+    """Cross-validate the results, scoring each fold's top_k by its calibration years
+    (see cross_validate). Results without matched data are re-simulated in parallel with
+    ctx (the validate command, which starts from a workbook). After a calibration ctx is
+    None: every successful run already holds the Merged_Data a re-run of the same inputs
+    would produce, and failed runs have nothing to validate."""
+    pool = [r for r in all_results if r.get("Metrics")]
+    missing = [r for r in pool if r.get("Merged_Data") is None or r["Merged_Data"].empty]
+    if missing and ctx is not None:
+        log_message(f"  Re-simulating {len(missing)} candidate(s) on {workers} worker(s)...")
+        rerun = evaluate_batch([r["Parameters"] for r in missing], ctx, workers, first_iteration=None)
+        for r, new in zip(missing, rerun):
+            r["Merged_Data"] = new.get("Merged_Data", pd.DataFrame())
+            r["Metrics"] = new.get("Metrics") or r.get("Metrics")
+    log_message(f"\n  Cross-validation ({scheme}, {n_folds} folds): per fold, the top {top_k} of "
+                f"{len(pool)} runs by calibration-year RMSE")
+    fold_rows, candidate_rows = cross_validate(pool, target_var, scheme, n_folds, top_k)
+    return save_validation(fold_rows, candidate_rows, param_ranges_df, target_var, depth,
+                           results_dir, scheme)
+
+
+# =====================================================================
+#  SCENARIO RUNS
+#  Apply calibrated parameter sets (best or top-K) to other .dnd / batch
+#  files — climate, management or site scenarios — and run them in parallel.
+# =====================================================================
+# Annual key outputs: OUTPUT_TARGETS entry -> how to reduce its daily rows
+SCENARIO_OUTPUTS = {"Yield": None, "ET": "sum", "NEE": "sum", "N2O": "sum"}
+
+def load_parameter_sets(results_xlsx, param_ranges_df, top_k=1):
+    """(label, values) for the top_k iterations (by RMSE) of a calibration workbook (all if top_k is 0)."""
+    df = pd.read_excel(results_xlsx, sheet_name="All Iterations")
+    names = param_ranges_df['parameter_name'].tolist()
+    missing = [n for n in names if n not in df.columns]
+    if missing:
+        raise ValueError(f"{os.path.basename(results_xlsx)} has no column(s): {', '.join(missing)}")
+    df = df.dropna(subset=["RMSE"]).sort_values("RMSE")
+    if top_k:
+        df = df.head(max(1, int(top_k)))
+    return [(f"iter_{int(row['Iteration']):04d}", coerce_parameter_values([row[n] for n in names], param_ranges_df))
+            for _, row in df.iterrows()]
+
+def resolve_scenario(entry, template_batch=None):
+    """(name, batch_file, dnd_file) for a scenario given as a .dnd or a DNDC batch file."""
+    if entry.lower().endswith(".dnd"):
+        if not template_batch:
+            raise ValueError(f"{entry}: a template batch file is needed for .dnd scenarios")
+        return os.path.splitext(os.path.basename(entry))[0], template_batch, entry
+    _, dnd = batch_dnd_ref(entry)
+    if not os.path.isabs(dnd):
+        dnd = os.path.join(os.path.dirname(os.path.abspath(entry)), dnd)
+    return os.path.splitext(os.path.basename(entry))[0], entry, dnd
+
+def summarize_scenario_outputs(dndc_dir):
+    """One row per simulated year with the SCENARIO_OUTPUTS of a finished run."""
+    paths = get_modeled_paths(dndc_dir)
+    by_file = {}
+    for target in SCENARIO_OUTPUTS:
+        by_file.setdefault(target_field(target)[0], []).append((target, None))
+    series = {}
+    for name, wanted in by_file.items():
+        if not os.path.exists(paths[name]):
+            continue
+        try:
+            series.update(read_targets(wanted, paths))  # one pass per file
+        except Exception as e:
+            log_message(f"  ⚠ {name}: {e}", logging.DEBUG)
+    summary = None
+    for (label, _), df in series.items():
+        df = df.rename(columns={f"{label}_MOD": label})
+        df = df.groupby("Year", as_index=False)[label].agg(SCENARIO_OUTPUTS[label] or "last")
+        summary = df if summary is None else summary.merge(df, on="Year", how="outer")
+    return summary if summary is not None else pd.DataFrame(columns=["Year"])
+
+def _run_scenario(job, root_folder, param_ranges_df, keep_outputs=False):
+    """Thread-pool worker: render one scenario × parameter set and run DNDC."""
+    scenario, batch_file, dnd_file, label, params, run_dir = job
+    if stop_calibration_flag:
+        raise CalibrationStopped("Stopped by user.")
+    output_dir = os.path.join(run_dir, "output")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir, exist_ok=True)
+    lines = read_dnd_file(dnd_file)
+    if params is not None:
+        lines = update_parameters(lines, params, param_ranges_df)
+    run_dnd = os.path.join(run_dir, os.path.basename(dnd_file))
+    run_batch = os.path.join(run_dir, os.path.basename(batch_file))
+    write_dnd_file(run_dnd, lines)
+    render_batch_file(batch_file, run_dnd, run_batch)
+    started = time.time()
+    run_dndc(output_dir, root_folder, run_batch)
+    dndc_dir = detect_dndc_output_folder(os.path.join(output_dir, "Record", "Batch"))
+    if not dndc_dir:
+        raise RuntimeError("DNDC output folder not found")
+    summary = summarize_scenario_outputs(dndc_dir)
+    if not keep_outputs:
+        prune_run_outputs(output_dir, keep={target_field(t)[0] for t in SCENARIO_OUTPUTS})
+    summary.insert(0, "Parameter_Set", label)
+    summary.insert(0, "Scenario", scenario)
+    log_message(f"  ✓ {scenario} × {label}  ({time.time() - started:.1f}s)")
+    return summary
+
+def run_scenarios(param_sets, param_ranges_df, scenarios, root_folder, output_root,
+                  template_batch=None, workers=None, include_baseline=False, keep_outputs=False):
+    """Run every scenario with every (label, values) parameter set and write
+    scenario_summary.csv / .xlsx to output_root. Returns the summary table.
+    Each run keeps only the output files the summary reads unless keep_outputs."""
+    set_log_root(root_folder)
+    jobs = []
+    sets = ([("baseline", None)] if include_baseline else []) + list(param_sets)
+    seen = {}
+    for entry in scenarios:
+        name, batch_file, dnd_file = resolve_scenario(entry, template_batch)
+        # Same-named files from different folders must not share run folders or summary rows
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            unique = f"{name}_{seen[name]}"
+            while unique in seen:
+                seen[name] += 1
+                unique = f"{name}_{seen[name]}"
+            seen[unique] = 1
+            log_message(f"  ⚠ Scenario name {name} repeats; {entry} runs as {unique}")
+            name = unique
+        for label, params in sets:
+            run_dir = os.path.join(output_root, name, label)
+            os.makedirs(run_dir, exist_ok=True)
+            jobs.append((name, batch_file, dnd_file, label, params, run_dir))
+    if not jobs:
+        log_message("✗ Nothing to run.")
+        return pd.DataFrame()
+
+    workers = max(1, min(int(workers or DEFAULT_SETTINGS["workers"]), len(jobs)))
+    log_message(f"  Running {len(scenarios)} scenario(s) × {len(sets)} parameter set(s) "
+                f"on {workers} worker(s)...")
+    tables = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_run_scenario, job, root_folder, param_ranges_df, keep_outputs): job for job in jobs}
+        for i, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            try:
+                tables.append(future.result())
+            except CalibrationStopped:
+                continue
+            except Exception as e:
+                log_message(f"  ✗ {job[0]} × {job[3]} failed: {e}")
+            set_progress(i / len(jobs) * 100)
+
+    summary = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    if not summary.empty:
+        summary = summary.sort_values(["Scenario", "Parameter_Set", "Year"], ignore_index=True)
+        csv_path = os.path.join(output_root, "scenario_summary.csv")
+        summary.to_csv(csv_path, index=False)
+        try:
+            summary.to_excel(os.path.join(output_root, "scenario_summary.xlsx"),
+                             sheet_name="Scenario Summary", index=False)
+        except PermissionError:
+            log_message("  ⚠ scenario_summary.xlsx is open in Excel; CSV written only.")
+        log_message(f"  ✓ Scenario summary saved: {csv_path}")
+    return summary
+
+
+# =====================================================================
+#  CALIBRATION WORKFLOW
+# =====================================================================
+def read_calibration_form():
+    """Validated calibration spec from the form (the shape queued jobs use), or None.
+    "settings" holds only the form's overrides of the settings file."""
+    rf = root_folder_entry.get().strip()
+    bf = batch_file_entry.get().strip()
+    df = dnd_file_entry.get().strip()
+    oc = observed_csv_entry.get().strip()
+    pc = param_csv_entry.get().strip()
+    sn = site_name_entry.get().strip()
+
+    if not all([rf, bf, df, oc, pc]):
+        log_message("✗ Please fill all required fields.")
+        return None
+
+    if not sn:
+        sn = auto_detect_site_name(bf)
+        site_name_entry.delete(0, tk.END)
+        site_name_entry.insert(0, sn)
+        log_message(f"  Auto-detected site: {sn}")
+
+    try:
+        n_iter = int(iterations_entry.get())
+        if n_iter < 1:
+            raise ValueError
+    except ValueError:
+        log_message("✗ Iterations must be a positive integer.")
+        return None
+
+    for path, label in [(bf, "Batch"), (df, ".dnd"), (oc, "Observed CSV"), (pc, "Param CSV")]:
+        if not os.path.exists(path):
+            log_message(f"✗ {label} not found: {path}")
+            return None
+
+    if not os.path.exists(os.path.join(rf, "DNDC95.exe")):
+        log_message(f"✗ DNDC95.exe not found in: {rf}")
+        return None
+
+    target_var = target_var_combo.get()
+    depth = depth_combo.get() if target_depths(target_var) else None
+    if target_depths(target_var) and not depth:
+        log_message(f"✗ Select a depth for {target_var}.")
+        return None
+
+    save_dnd = save_dnd_toggle.get()
+    save_iter = save_checkpoint_toggle.get()
+
+    try:
+        n_design = int(design_size_entry.get())
+        n_workers = int(workers_entry.get())
+        if n_design < 0 or n_workers < 1:
+            raise ValueError
+    except ValueError:
+        log_message("✗ Design size must be >= 0 and Workers >= 1.")
+        return None
+    broker_port = broker_port_entry.get().strip()
+    if broker_port and not broker_port.isdigit():
+        log_message("✗ Broker port must be a number (leave blank to run DNDC locally).")
+        return None
+    time_budget = time_budget_entry.get().strip()
+    try:
+        time_budget = float(time_budget) if time_budget else None
+        if time_budget is not None and time_budget <= 0:
+            raise ValueError
+    except ValueError:
+        log_message("✗ Time budget must be a positive number of hours (leave blank for none).")
+        return None
+    settings = {"time_budget_hours": time_budget} if time_budget is not None else {}
+    settings.update({
+        "iterations": n_iter,
+        "workers": n_workers,
+        "initial_design": design_combo.get(),
+        "initial_points": n_design,
+        "multi_fidelity": multi_fidelity_toggle.get(),
+        "mode": mode_combo.get() or "Calibrate",
+        "broker_port": int(broker_port) if broker_port else None,
+    })
+
+    return {"target": target_var, "depth": depth, "root": rf, "site": sn, "batch": bf, "dnd": df,
+            "observed": oc, "param_csv": pc, "save_dnd": save_dnd, "save_iter": save_iter,
+            "settings": settings}
+
+def start_calibration():
+    global calibration_thread, stop_calibration_flag
+    stop_calibration_flag = False
+
+    if calibration_thread and calibration_thread.is_alive():
+        log_message("⚠ A calibration is already running.")
+        return
+
+    form = read_calibration_form()
+    if form is None:
+        return
+    target_var, depth = form["target"], form["depth"]
+    save_dnd, save_iter = form["save_dnd"], form["save_iter"]
+    settings = {**load_user_settings(), **form["settings"]}
+
+    log_message(f"\n{'═'*50}")
+    log_message(f"  CALIBRATION START")
+    log_message(f"  Target: {target_var}{f' @ {depth}' if depth else ''}  |  Mode: {settings['mode']}")
+    log_message(f"  Site: {form['site']}  |  Iterations: {settings['iterations']}")
+    log_message(f"  Initial design: {settings['initial_design']} × {settings['initial_points']}  |  Workers: {settings['workers']}"
+                f"  |  Multi-fidelity: {'on' if settings['multi_fidelity'] else 'off'}")
+    log_message(f"  DND backups: {'on' if save_dnd else 'off'}  |  Save iteration results: {'on' if save_iter else 'off'}")
+    log_message(f"{'═'*50}")
+
+    progress_bar.set_value(0)
+    progress_label.config(text="0%")
+
+    calibration_thread = threading.Thread(
+        target=calibrate_variable,
+        args=(target_var, depth, form["root"], form["site"], form["batch"], form["dnd"],
+              form["observed"], form["param_csv"], save_dnd, save_iter, settings),
+        daemon=True
+    )
+    calibration_thread.start()
+
+
+def calibrate_variable(target_var, depth, root_folder, site_name,
+                       batch_file, dnd_file, observed_csv, param_csv,
+                       save_dnd_backups, save_iter_results, settings=None):
+    """Run one calibration (or UQ) end to end. Returns {"rmse", "best_iteration", "best_params"}
+    for a calibration, {"mode"} for UQ, or None if nothing usable came out.
+    Stop (stop_calibration_flag) is reset by whoever starts the work, never here: queued
+    jobs share the process, and a job's own stop is settings["cancel_event"]."""
+    outcome = None
+
+    paths = get_output_paths(root_folder, site_name)
+    os.makedirs(paths["results_dir"], exist_ok=True)
+
+    backup_path = dnd_file + ".backup"
+    shutil.copy(dnd_file, backup_path)
+    log_message(f"  ✓ .dnd backed up")
+
+    try:
+        lines = read_dnd_file(dnd_file)
+        if not lines:
+            log_message("✗ .dnd file empty or unreadable.")
+            return
+
+        if settings and (settings.get("output_schemas") or settings.get("output_targets")):
+            register_output_schemas(settings)
+
+        param_ranges_df = read_param_ranges(param_csv)
+        if param_ranges_df.empty:
+            log_message("✗ Parameter CSV invalid.")
+            return
+
+        param_ranges = build_search_space(param_ranges_df)
+        log_message("  Search space: " + "; ".join(describe_dimension(d) for d in param_ranges))
+        observed_csv = prepare_observations(target_var, observed_csv, paths["obs_cache_dir"], settings)
+
+        mode = (settings or {}).get("mode", "Calibrate")
+        if mode in UQ_METHODS:
+            run_uncertainty(mode, param_ranges, param_ranges_df, lines, target_var, depth,
+                            paths, batch_file, dnd_file, observed_csv,
+                            save_dnd_backups, save_iter_results, settings)
+            return {"mode": mode}
+
+        results = bayesian_optimization(
+            param_ranges, param_ranges_df, lines, target_var, depth,
+            paths, batch_file, dnd_file, observed_csv,
+            save_dnd_backups, save_iter_results, settings
+        )
+
+        all_results, best_params, best_merged, best_metrics, best_iter, frozen = results
+
+        if best_params and best_metrics:
+            save_results(all_results, best_params, best_metrics, best_merged, best_iter,
+                        param_ranges_df, target_var, depth, paths["results_dir"], frozen)
+            log_message(f"\n  ✓ Best: Iteration #{best_iter}  RMSE={best_metrics['RMSE']:.4f}")
+            outcome = {"rmse": float(best_metrics['RMSE']), "best_iteration": best_iter,
+                       "best_params": [v.item() if hasattr(v, "item") else v for v in best_params]}
+            if (settings or {}).get("catalog", True):
+                record_calibration(site_name, target_var, depth, lines, dnd_file, param_csv, observed_csv,
+                                   param_ranges_df, all_results, best_params, best_metrics, best_iter,
+                                   settings)
+            scheme = (settings or {}).get("validation")
+            if scheme in CV_SCHEMES:
+                validate_top_candidates(all_results, None, target_var, depth, param_ranges_df,
+                                        paths["results_dir"], scheme,
+                                        settings.get("validation_folds", 5),
+                                        settings.get("validation_top_k", 10))
+        else:
+            log_message("⚠ No valid results found.")
+
+    except Exception as e:
+        log_message(f"✗ Calibration error: {e}")
+        show_error(str(e))
+    finally:
+        shutil.copy(backup_path, dnd_file)
+        log_message("  ✓ .dnd restored from backup")
+    return outcome
+
+
+def cancel_running_work():
+    """Set the stop flag, kill every DNDC child and cancel queued remote jobs."""
+    global stop_calibration_flag
+    stop_calibration_flag = True
+    with _active_brokers_lock:
+        brokers = list(_active_brokers)
+    for broker in brokers:
+        broker.cancel_all("Stopped by user.")
+    return terminate_active_processes()
+
+def stop_calibration():
+    if calibration_thread and calibration_thread.is_alive():
+        def _confirm():
+            if messagebox.askyesno("Stop", "Stop calibration? Results saved up to current iteration."):
+                killed = cancel_running_work()
+                log_message(f"  ⏹ Stopping — {killed} DNDC run(s) terminated, saving results...")
+        root.after(0, _confirm)
+    else:
+        log_message("No active calibration.")
+
+
+# =====================================================================
+#  CALIBRATION PIPELINES
+#  Stages calibrated one after another on the same site (e.g. phenology
+#  against Yield, then soil water against moisture, then carbon against
+#  NEE). Each stage starts from the .dnd with every earlier stage's best
+#  values baked in; runs also cache the later stages' targets, so the
+#  overlap (each stage's baseline is the previous stage's best) skips DNDC.
+# =====================================================================
+PIPELINE_REQUIRED = ("batch", "dnd", "stages")
+STAGE_REQUIRED = ("target", "param_csv", "observed")
+STAGE_SPEC_KEYS = ("target", "depth", "param_csv", "observed", "iterations", "settings")
+
+def load_pipeline(path):
+    """Pipeline spec from a JSON file: job keys shared by all stages (root, site, batch, dnd,
+    save_dnd, save_iter, settings) and "stages": [{name, target, depth, param_csv, observed,
+    iterations, settings}]. Relative paths count from the spec's folder. ValueError if incomplete."""
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+
+    def _resolve(p):
+        return p if not p or os.path.isabs(p) else os.path.join(base, p)
+
+    missing = [k for k in PIPELINE_REQUIRED if not spec.get(k)]
+    if missing:
+        raise ValueError(f"Pipeline is missing {', '.join(missing)}")
+    spec.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    spec["batch"], spec["dnd"] = _resolve(spec["batch"]), _resolve(spec["dnd"])
+    for i, stage in enumerate(spec["stages"], start=1):
+        missing = [k for k in STAGE_REQUIRED if not stage.get(k)]
+        if missing:
+            raise ValueError(f"Stage {i} is missing {', '.join(missing)}")
+        if stage["target"] not in TARGET_VARIABLES:
+            raise ValueError(f"Stage {i}: unknown target '{stage['target']}'")
+        if target_depths(stage["target"]) and not stage.get("depth"):
+            raise ValueError(f"Stage {i}: {stage['target']} needs a depth")
+        stage["param_csv"], stage["observed"] = _resolve(stage["param_csv"]), _resolve(stage["observed"])
+        stage.setdefault("name", stage["target"] + (f"_{stage['depth']}" if stage.get("depth") else ""))
+    return spec
+
+def _stage_dir(pipeline_dir, index, stage):
+    safe = re.sub(r'[^\w.-]', '_', stage['name'])
+    return os.path.join(pipeline_dir, f"{index + 1:02d}_{safe}")
+
+def run_pipeline(spec, resume=False):
+    """Calibrate spec's stages in order (see load_pipeline). Each stage's best values are
+    written into the .dnd the next stage starts from; the result is
+    calibration_results/<site>/pipelines/<name>/<dnd>. resume=True skips the stages
+    pipeline_state.json records as finished with an unchanged stage spec.
+    Returns the per-stage outcomes; fewer than the stages if one failed or was stopped."""
+    if spec.get("settings", {}).get("output_schemas") or spec.get("settings", {}).get("output_targets"):
+        register_output_schemas(spec["settings"])
+    root_folder = spec.get("root") or ROOT_FOLDER
+    site = spec.get("site") or auto_detect_site_name(spec["batch"])
+    paths = get_output_paths(root_folder, site)
+    pipeline_dir = os.path.join(paths["results_dir"], "pipelines", re.sub(r'[^\w.-]', '_', spec["name"]))
+    os.makedirs(pipeline_dir, exist_ok=True)
+    state_path = os.path.join(pipeline_dir, "pipeline_state.json")
+    state = {"stages": []}
+    if resume and os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+    stages = spec["stages"]
+    base_settings = {**load_user_settings(), **(spec.get("settings") or {})}
+    stage_settings = [{**base_settings, **(s.get("settings") or {})} for s in stages]
+    observed = [prepare_observations(s["target"], s["observed"], paths["obs_cache_dir"], stage_settings[i])
+                for i, s in enumerate(stages)]
+    dnd_name = os.path.basename(spec["dnd"])
+    lines = read_dnd_file(spec["dnd"])
+    if not lines:
+        log_message("✗ .dnd file empty or unreadable.")
+        return []
+    try:
+        batch_dnd_ref(spec["batch"], spec["dnd"])
+    except (OSError, ValueError) as e:
+        log_message(f"✗ {e}")
+        return []
+
+    log_message(f"\n  ▶ Pipeline {spec['name']}: " + " → ".join(s["name"] for s in stages))
+    outcomes = []
+    for i, stage in enumerate(stages):
+        stage_dir = _stage_dir(pipeline_dir, i, stage)
+        stage_dnd = os.path.join(stage_dir, dnd_name)
+        best_dnd = os.path.join(stage_dir, "best_" + dnd_name)
+        stage_spec = {k: stage.get(k) for k in STAGE_SPEC_KEYS}
+        done = state["stages"][i] if i < len(state["stages"]) else None
+        if done and done.get("spec") == stage_spec and os.path.exists(best_dnd) and \
+                read_dnd_file(stage_dnd) == lines:
+            log_message(f"\n  ⏭ Stage {i + 1} {stage['name']}: done (RMSE={done['outcome']['rmse']:.4f})")
+            outcomes.append(done["outcome"])
+            lines = read_dnd_file(best_dnd)
+            continue
+        del state["stages"][i:]  # later stages start from a different .dnd now
+
+        os.makedirs(stage_dir, exist_ok=True)
+        write_dnd_file(stage_dnd, lines)
+        # The site's batch runs the site's .dnd; each stage runs its own copy
+        stage_batch = os.path.join(stage_dir, os.path.basename(spec["batch"]))
+        render_batch_file(spec["batch"], stage_dnd, stage_batch, source_dnd=spec["dnd"])
+        settings = dict(stage_settings[i])
+        if stage.get("iterations"):
+            settings["iterations"] = int(stage["iterations"])
+        if spec.get("share_cache", True):
+            settings["cache_also"] = [(s["target"], s.get("depth"), observed[j])
+                                      for j, s in enumerate(stages) if j > i]
+        at = f" at {stage['depth']}" if stage.get("depth") else ""
+        log_message(f"\n  ▶ Stage {i + 1}/{len(stages)} {stage['name']}: {stage['target']}{at}")
+        outcome = calibrate_variable(stage["target"], stage.get("depth"), root_folder, site,
+                                     stage_batch, stage_dnd, observed[i], stage["param_csv"],
+                                     spec.get("save_dnd", False), spec.get("save_iter", False), settings)
+        if stop_calibration_flag or not outcome or "best_params" not in outcome:
+            log_message(f"  ✗ Pipeline stopped at stage {i + 1} {stage['name']}")
+            break
+        lines = update_parameters(lines, outcome["best_params"], read_param_ranges(stage["param_csv"]))
+        write_dnd_file(best_dnd, lines)
+        outcomes.append(outcome)
+        state["stages"].append({"name": stage["name"], "spec": stage_spec, "outcome": outcome,
+                                "finished": time.time()})
+        with open(state_path, 'w') as f:
+            json.dump(state, f, indent=1)
+
+    if len(outcomes) == len(stages):
+        final_dnd = os.path.join(pipeline_dir, dnd_name)
+        write_dnd_file(final_dnd, lines)
+        log_message(f"\n  ✓ Pipeline {spec['name']} complete → {final_dnd}")
+        for stage, outcome in zip(stages, outcomes):
+            log_message(f"    {stage['name']}: RMSE={outcome['rmse']:.4f} (iteration #{outcome['best_iteration']})")
+    return outcomes
+
+
+# =====================================================================
+#  CALIBRATION QUEUE
+#  Calibration specs (site, target, files, settings) wait in a JSON queue
+#  next to DNDC. One runner per machine (python caln.py queue run, or the
+#  Queue button) works through it, running several jobs at once over a
+#  shared pool of DNDC slots handed out by priority and fair share.
+# =====================================================================
+QUEUE_FILE = os.path.join(ROOT_FOLDER, "calibration_queue.json")
+JOB_REQUIRED = ("target", "batch", "dnd", "observed", "param_csv")
+RUNNER_STALE_SECONDS = 60
+
+def load_queue(path=QUEUE_FILE):
+    """{"jobs": [...], "runner": {...}} as stored; an empty queue if there is no file yet."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    except ValueError as e:
+        raise ValueError(f"{os.path.basename(path)} is damaged: {e}") from e
+    data.setdefault("jobs", [])
+    data.setdefault("runner", {})
+    return data
+
+def update_queue(change, path=QUEUE_FILE):
+    """Apply change(data) under the queue lock, save atomically and return change's result."""
+    with portalocker.Lock(path + ".lock", mode='a', timeout=30):
+        data = load_queue(path)
+        result = change(data)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, path)
+    return result
+
+def submit_job(spec, path=QUEUE_FILE):
+    """Queue a calibration spec (keys as in read_calibration_form, plus optional
+    "priority" — higher runs first — and "weight" for fair share). Returns the job id."""
+    missing = [k for k in JOB_REQUIRED if not spec.get(k)]
+    if missing:
+        raise ValueError(f"Job is missing {', '.join(missing)}")
+    if spec["target"] not in TARGET_VARIABLES:
+        raise ValueError(f"Unknown target '{spec['target']}'")
+    if target_depths(spec["target"]) and not spec.get("depth"):
+        raise ValueError(f"{spec['target']} needs a depth")
+    job = {"root": ROOT_FOLDER, "site": "", "depth": None, "save_dnd": False, "save_iter": False,
+           "settings": {}, "priority": 0, "weight": 1.0, **spec}
+    job["site"] = job["site"] or auto_detect_site_name(job["batch"])
+    job["priority"], job["weight"] = int(job["priority"]), max(0.01, float(job["weight"]))
+
+    def _add(data):
+        job["id"] = max((j["id"] for j in data["jobs"]), default=0) + 1
+        job.update(state="queued", submitted=time.time())
+        data["jobs"].append(job)
+        return job["id"]
+    return update_queue(_add, path)
+
+def _find_job(data, job_id):
+    job = next((j for j in data["jobs"] if j["id"] == job_id), None)
+    if job is None:
+        raise ValueError(f"No job #{job_id}")
+    return job
+
+def cancel_job(job_id, path=QUEUE_FILE):
+    """Cancel a queued job, or ask the runner to stop a running one. Returns the new state."""
+    def _cancel(data):
+        job = _find_job(data, job_id)
+        if job["state"] == "queued":
+            job["state"] = "cancelled"
+        elif job["state"] == "running":
+            job["cancel"] = True
+            return "cancelling"
+        return job["state"]
+    return update_queue(_cancel, path)
+
+def set_job_priority(job_id, priority, path=QUEUE_FILE):
+    def _set(data):
+        _find_job(data, job_id)["priority"] = int(priority)
+    update_queue(_set, path)
+
+def _job_label(job, with_id=True):
+    depth = f" @ {job['depth']}" if job.get("depth") else ""
+    label = f"{job.get('site') or '?'} {job['target']}{depth}"
+    return f"#{job['id']} {label}" if with_id else label
+
+def _runner_alive(data):
+    runner = data.get("runner") or {}
+    return bool(runner) and time.time() - runner.get("heartbeat", 0) < RUNNER_STALE_SECONDS
+
+def queue_summary(data):
+    """One line for the status bar: running / queued jobs and busy slots."""
+    counts = {}
+    for job in data["jobs"]:
+        counts[job["state"]] = counts.get(job["state"], 0) + 1
+    if not counts.get("running") and not counts.get("queued"):
+        return "Queue: idle"
+    text = f"Queue: {counts.get('running', 0)} running · {counts.get('queued', 0)} queued"
+    if _runner_alive(data):
+        runner = data["runner"]
+        text += f" · {runner.get('busy', 0)}/{runner.get('slots', 0)} slots"
+    else:
+        text += " · no runner"
+    return text
+
+def format_queue(data, show_all=False):
+    """Table of the queue for the CLI (finished jobs only with show_all)."""
+    lines = [queue_summary(data)]
+    if _runner_alive(data):
+        runner = data["runner"]
+        lines.append(f"Runner: pid {runner.get('pid')} on {runner.get('host')}, "
+                     f"{runner.get('busy', 0)}/{runner.get('slots', 0)} DNDC slots busy")
+    jobs = [j for j in data["jobs"] if show_all or j["state"] in ("queued", "running")]
+    if not jobs:
+        return lines
+    lines.append(f"{'ID':>4} {'Pri':>4} {'State':<11} {'Job':<36} {'Slots':>5} {'Result':<24}")
+    for job in sorted(jobs, key=lambda j: (j["state"] != "running", -j.get("priority", 0), j["id"])):
+        state = "cancelling" if job.get("cancel") and job["state"] == "running" else job["state"]
+        if job.get("result", {}).get("rmse") is not None:
+            result = f"RMSE={job['result']['rmse']:.4g} (#{job['result']['best_iteration']})"
+        elif job.get("started") and job["state"] == "running":
+            result = f"running {format_duration(time.time() - job['started'])}"
+        else:
+            result = job.get("error", "")
+        lines.append(f"{job['id']:>4} {job.get('priority', 0):>4} {state:<11} "
+                     f"{_job_label(job, False)[:36]:<36} {job.get('slots', 0) or '':>5} {result[:40]}")
+    return lines
+
+
+class SlotScheduler:
+    """Machine-wide pool of DNDC run slots shared by the jobs of one queue runner.
+    A free slot goes to the waiting job with the highest priority; among equal
+    priorities, to the one holding the fewest slots per unit of weight (fair share)."""
+
+    def __init__(self, n_slots):
+        self.n_slots = n_slots
+        self._free = list(range(n_slots))
+        self._cond = threading.Condition()
+        self._jobs = {}      # job id -> {"priority", "weight", "held": set(), "waiting": [tickets]}
+        self._tickets = itertools.count()
+
+    def slots_for(self, job_id, priority=0, weight=1.0, cancel_event=None):
+        """Queue-like handle (get/put) the job's evaluation code takes slots from."""
+        with self._cond:
+            self._jobs[job_id] = {"priority": priority, "weight": weight, "held": set(), "waiting": []}
+        return _JobSlots(self, job_id, cancel_event)
+
+    def unregister(self, job_id):
+        with self._cond:
+            job = self._jobs.pop(job_id, None)
+            if job:
+                self._free.extend(job["held"])
+                self._free.sort()
+            self._cond.notify_all()
+
+    def _next_job(self):
+        waiting = [(jid, j) for jid, j in self._jobs.items() if j["waiting"]]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda item: (-item[1]["priority"],
+                                              len(item[1]["held"]) / item[1]["weight"],
+                                              item[1]["waiting"][0]))[0]
+
+    def acquire(self, job_id, cancel_event=None):
+        with self._cond:
+            job = self._jobs[job_id]
+            ticket = next(self._tickets)
+            job["waiting"].append(ticket)
+            try:
+                while not (self._free and self._next_job() == job_id):
+                    if stop_calibration_flag or (cancel_event is not None and cancel_event.is_set()):
+                        raise CalibrationStopped("Job stopped.")
+                    self._cond.wait(1.0)
+                slot = self._free.pop(0)
+                job["held"].add(slot)
+                return slot
+            finally:
+                job["waiting"].remove(ticket)
+                self._cond.notify_all()
+
+    def release(self, job_id, slot):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or slot not in job["held"]:
+                return  # already handed back
+            job["held"].discard(slot)
+            self._free.append(slot)
+            self._free.sort()
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """{job id: slots held}."""
+        with self._cond:
+            return {jid: len(j["held"]) for jid, j in self._jobs.items()}
+
+class _JobSlots:
+    """The get()/put() face of SlotScheduler that evaluate_batch expects from a slot queue."""
+
+    def __init__(self, scheduler, job_id, cancel_event=None):
+        self.scheduler, self.job_id, self.cancel_event = scheduler, job_id, cancel_event
+
+    def get(self):
+        return self.scheduler.acquire(self.job_id, self.cancel_event)
+
+    def put(self, slot):
+        self.scheduler.release(self.job_id, slot)
+
+
+def _run_queued_job(job, scheduler, cancel_event, path, scratch=None):
+    """Runner thread: one queued calibration on the shared slots (and shared scratch
+    space, if any), then record how it ended."""
+    _log_context.source = f"job {job['id']}"
+    settings = {**load_user_settings(), **(job.get("settings") or {})}
+    settings["workers"] = max(1, min(int(settings.get("workers") or 1), scheduler.n_slots))
+    settings["slot_pool"] = scheduler.slots_for(job["id"], job.get("priority", 0),
+                                                job.get("weight", 1.0), cancel_event)
+    settings["cancel_event"] = cancel_event
+    settings["queue_job"] = job["id"]
+    if scratch is not None:
+        settings["scratch_space"] = scratch  # scratch_max_mb caps the machine, not each job
+    log_message(f"\n  ▶ Job {_job_label(job)} started")
+    outcome, error = None, None
+    try:
+        outcome = calibrate_variable(job["target"], job.get("depth"), job["root"], job["site"],
+                                     job["batch"], job["dnd"], job["observed"], job["param_csv"],
+                                     job.get("save_dnd", False), job.get("save_iter", False), settings)
+    except Exception as e:
+        error = str(e)
+    finally:
+        scheduler.unregister(job["id"])
+
+    def _finish(data):
+        entry = _find_job(data, job["id"])
+        if cancel_event.is_set():
+            entry["state"] = "cancelled"
+        elif stop_calibration_flag:
+            entry["state"] = "queued"  # runner interrupted: run it again next time
+        else:
+            entry["state"] = "done" if outcome else "failed"
+        entry.pop("cancel", None)
+        entry["slots"] = 0
+        entry["finished"] = time.time()
+        if outcome:
+            entry["result"] = outcome
+        if entry["state"] == "failed":
+            entry["error"] = error or "no usable result (see the log)"
+        if data["runner"]:
+            data["runner"]["busy"] = sum(scheduler.snapshot().values())
+        return entry["state"]
+    state = update_queue(_finish, path)
+    log_message(f"  ■ Job {_job_label(job)}: {state}")
+    _log_context.source = None
+
+def _lock_runner(path):
+    """Open file holding the machine's queue-runner lock, or None if another runner has it."""
+    lock_file = open(path + ".runner", 'w')
+    try:
+        portalocker.lock(lock_file, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        return lock_file
+    except (portalocker.exceptions.LockException, OSError):
+        lock_file.close()
+        return None
+
+def queue_runner_active(path=QUEUE_FILE):
+    lock_file = _lock_runner(path)
+    if lock_file is None:
+        return True
+    portalocker.unlock(lock_file)
+    lock_file.close()
+    return False
+
+def run_queue(path=QUEUE_FILE, machine_slots=None, max_jobs=None, poll=5.0, keep_running=False):
+    """Work through the queue until it is empty (or forever with keep_running).
+    Returns the number of jobs started, or None if another runner is active."""
+    global stop_calibration_flag
+    lock_file = _lock_runner(path)
+    if lock_file is None:
+        log_message("✗ A queue runner is already active on this machine.")
+        return None
+    settings = load_user_settings()
+    machine_slots = max(1, int(machine_slots or settings.get("machine_slots") or os.cpu_count() or 1))
+    max_jobs = max(1, int(max_jobs or settings.get("queue_max_jobs") or machine_slots))
+    start_metrics_exporter(settings)
+    scheduler = SlotScheduler(machine_slots)
+    scratch = make_scratch_space(settings)
+    active = {}   # job id -> (thread, cancel event)
+    started = 0
+
+    def _requeue_orphans(data):
+        for job in data["jobs"]:
+            if job["state"] == "running" and job["id"] not in active:
+                job["state"], job["slots"] = "queued", 0
+                job.pop("cancel", None)
+
+    def _tick(data):
+        """Forward cancel requests, pick jobs to start and publish the slot status."""
+        running_dnds = set()
+        for job in data["jobs"]:
+            if job["id"] in active:
+                running_dnds.add(os.path.normcase(os.path.abspath(job["dnd"])))
+                if job.get("cancel"):
+                    active[job["id"]][1].set()
+        to_start = []
+        queued = sorted((j for j in data["jobs"] if j["state"] == "queued"),
+                        key=lambda j: (-j.get("priority", 0), j["submitted"]))
+        for job in queued:
+            if len(active) + len(to_start) >= max_jobs or stop_calibration_flag:
+                break
+            dnd = os.path.normcase(os.path.abspath(job["dnd"]))
+            if dnd in running_dnds:
+                continue  # calibrations back up and restore their .dnd; one job per file at a time
+            running_dnds.add(dnd)
+            job.update(state="running", started=time.time())
+            job.pop("error", None)
+            to_start.append(dict(job))
+        held = scheduler.snapshot()
+        for job in data["jobs"]:
+            if job["state"] == "running":
+                job["slots"] = held.get(job["id"], 0)
+        data["runner"] = {"pid": os.getpid(), "host": socket.gethostname(), "slots": machine_slots,
+                          "busy": sum(held.values()), "heartbeat": time.time()}
+        return to_start, len(queued) - len(to_start)
+
+    update_queue(_requeue_orphans, path)
+    log_message(f"  Queue runner: {machine_slots} DNDC slot(s), up to {max_jobs} job(s) at once")
+    try:
+        while True:
+            to_start, waiting = update_queue(_tick, path)
+            for job in to_start:
+                event = threading.Event()
+                thread = threading.Thread(target=_run_queued_job,
+                                          args=(job, scheduler, event, path, scratch),
+                                          daemon=True, name=f"job-{job['id']}")
+                active[job["id"]] = (thread, event)
+                thread.start()
+                started += 1
+            for job_id, (thread, _) in list(active.items()):
+                if not thread.is_alive():
+                    del active[job_id]
+            if not active and not waiting and not keep_running:
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        log_message("  ⏹ Queue runner stopping — unfinished jobs go back to the queue")
+        cancel_running_work()
+        for thread, _ in active.values():
+            thread.join(timeout=120)
+    finally:
+        active.clear()
+        update_queue(_requeue_orphans, path)
+        update_queue(lambda data: data.update(runner={}), path)
+        portalocker.unlock(lock_file)
+        lock_file.close()
+        stop_calibration_flag = False
+    log_message(f"  ✓ Queue runner finished ({started} job(s) run)")
+    return started
+
+def start_queue_runner(path=QUEUE_FILE):
+    """Start `caln.py queue run` as a background process unless one is already active."""
+    if queue_runner_active(path):
+        return False
+    cmd = [sys.executable] if getattr(sys, "frozen", False) else [sys.executable, os.path.abspath(__file__)]
+    cmd += ["queue", "run", "--queue", path]
+    kwargs = {"stdin": subprocess.DEVNULL, "stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP | 0x00000008  # DETACHED_PROCESS
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(cmd, **kwargs)
+    return True
+
+def queue_calibration():
+    """Queue button: add the form as a job and make sure a runner is working on the queue."""
+    form = read_calibration_form()
+    if form is None:
+        return
+    try:
+        job_id = submit_job(form)
+    except (ValueError, OSError, portalocker.exceptions.LockException) as e:
+        log_message(f"✗ Could not queue the job: {e}")
+        return
+    log_message(f"  ✓ Queued job {_job_label({**form, 'id': job_id})}")
+    if start_queue_runner():
+        log_message("  Queue runner started in the background")
+    refresh_queue_status()
+
+def refresh_queue_status(schedule=False):
+    """Show the queue summary in the status bar (every QUEUE_REFRESH_MS with schedule=True)."""
+    try:
+        text = queue_summary(load_queue()) if os.path.exists(QUEUE_FILE) else ""
+    except (OSError, ValueError):
+        text = "Queue: unreadable"
+    queue_label.config(text=text)
+    if schedule:
+        root.after(QUEUE_REFRESH_MS, lambda: refresh_queue_status(True))
+
+QUEUE_REFRESH_MS = 5000
+
+
+# =====================================================================
+#  UI EVENT HANDLERS
+# =====================================================================
+def on_target_var_change(event):
+    tv = target_var_combo.get()
+    if target_depths(tv):
+        depth_label.pack(side=tk.LEFT, padx=(0, S(8)), after=target_var_combo)
+        depth_combo.pack(side=tk.LEFT, padx=(0, S(20)), after=depth_label)
+        depth_combo['values'] = target_depths(tv)
+        depth_combo.current(0)
+    else:
+        depth_label.pack_forget()
+        depth_combo.pack_forget()
+
+def browse_file(entry_widget, file_type, title):
+    f = filedialog.askopenfilename(filetypes=[(f"{file_type[1:].upper()} files", file_type)], title=title)
+    if f:
+        if isinstance(entry_widget, ModernEntry):
+            entry_widget.delete(0, tk.END)
+            entry_widget.insert(0, f)
+        else:
+            entry_widget.delete(0, tk.END)
+            entry_widget.insert(0, f)
+
+def browse_directory(entry_widget, title):
+    d = filedialog.askdirectory(title=title)
+    if d:
+        if isinstance(entry_widget, ModernEntry):
+            entry_widget.delete(0, tk.END)
+            entry_widget.insert(0, d)
+        else:
+            entry_widget.delete(0, tk.END)
+            entry_widget.insert(0, d)
+
+def download_observed_template():
+    try:
+        save_dir = filedialog.askdirectory(title="Save Template To")
+        if not save_dir:
+            return
+        tv = target_var_combo.get()
+        if not target_is_daily(tv):
+            t = "Description: Observed yield\nUnits: kgC/ha/y\nYear,Value\n1,5000\n2,5200\n3,5100\n"
+        else:
+            t = "Description: Observed daily data\nUnits: see variable\nYear,Day,Value\n1,1,5.0\n1,2,5.2\n"
+        fname = f"observed_{tv.lower()}_template.csv"
+        with open(os.path.join(save_dir, fname), "w") as f:
+            f.write(t)
+        log_message(f"  ✓ Template saved: {fname}")
+    except Exception as e:
+        log_message(f"✗ Template error: {e}")
+
+def download_param_template():
+    try:
+        save_dir = filedialog.askdirectory(title="Save Template To")
+        if not save_dir:
+            return
+        with open(os.path.join(save_dir, "parameter_template.csv"), "w") as f:
+            f.write("parameter_name,min,max,line_number\nparam1,0.1,1.0,10\nparam2,0.5,2.0,15\n")
+        log_message("  ✓ Param template saved")
+    except Exception as e:
+        log_message(f"✗ Template error: {e}")
+
+def open_results_directory():
+    try:
+        rf = root_folder_entry.get().strip()
+        sn = site_name_entry.get().strip()
+        if rf and sn:
+            d = os.path.join(rf, "calibration_results", sn)
+            if os.path.exists(d):
+                os.startfile(d)
+                return
+        if rf:
+            os.startfile(rf)
+    except Exception as e:
+        log_message(f"✗ Could not open results: {e}")
+
+def exit_application():
+    global calibration_thread, stop_calibration_flag
+    if calibration_thread and calibration_thread.is_alive():
+        if not messagebox.askyesno("Exit", "Calibration running. Exit anyway?"):
+            return
+        cancel_running_work()
+        # DNDC is already dead, so this only waits for results to be written
+        calibration_thread.join(timeout=10)
+    terminate_active_processes()
+    root.destroy()
+
+def is_already_running():
+    lock_path = os.path.join(ROOT_FOLDER, "dnccalibration.lock")
+    lock_file = None
+    try:
+        lock_file = open(lock_path, 'w')
+        portalocker.lock(lock_file, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        return False
+    except (portalocker.exceptions.LockException, OSError):
+        if lock_file:
+            lock_file.close()
+        return True
+
+
+# ── Short aliases used by UI builder ──
+_browse_file = browse_file
+_browse_dir = browse_directory
+_dl_obs_template = download_observed_template
+_dl_param_template = download_param_template
+_open_results = open_results_directory
+_exit = exit_application
+
+
+# =====================================================================
+#  BUILD THE UI
+# =====================================================================
+
+def create_ui():
+    global root, log_display, batch_file_entry, dnd_file_entry, observed_csv_entry
+    global param_csv_entry, iterations_entry, progress_bar, progress_label
+    global target_var_combo, depth_combo, depth_label, mode_combo
+    global root_folder_entry, site_name_entry
+    global save_dnd_toggle, save_checkpoint_toggle
+    global design_combo, design_size_entry, workers_entry, multi_fidelity_toggle
+    global broker_port_entry, time_budget_entry, queue_label
+
+    _detect_dpi_scale()  # before the first tk window exists
+    root = tk.Tk()
+    root.title("DNDC Calibration Studio")
+    root.geometry(f"{S(1100)}x{S(820)}")
+    root.minsize(S(800), S(600))
+    root.resizable(True, True)
+    root.config(bg=COLORS["bg_primary"])
+
+    # Keyboard shortcuts
+    root.bind("<Control-plus>", lambda e: zoom_in())
+    root.bind("<Control-equal>", lambda e: zoom_in())
+    root.bind("<Control-minus>", lambda e: zoom_out())
+    root.bind("<Control-0>", lambda e: reset_zoom())
+    root.bind("<F1>", lambda e: start_calibration())
+    root.bind("<Escape>", lambda e: exit_application())
+    root.bind("<Control-t>", lambda e: toggle_theme())
+
+    # TTK style
+    sty = ttk.Style(); sty.theme_use('clam')
+    sty.configure("Modern.TCombobox",
+                  fieldbackground=COLORS["bg_input"], background=COLORS["bg_tertiary"],
+                  foreground=COLORS["text_primary"], arrowcolor=COLORS["text_secondary"],
+                  bordercolor=COLORS["border_input"], padding=(S(8), S(5)))
+    sty.map("Modern.TCombobox",
+            fieldbackground=[("readonly", COLORS["bg_input"])],
+            foreground=[("readonly", COLORS["text_primary"])])
+
+    # ── NO outer scroll — fixed layout, only log scrolls ──
+    main = tk.Frame(root, bg=COLORS["bg_primary"])
+    main.pack(fill=tk.BOTH, expand=True)
+
+    pad = S(28)
+
+    # ══════════ HEADER BAR ══════════
+    hbar = tk.Frame(main, bg=COLORS["bg_primary"])
+    hbar.pack(fill=tk.X, padx=pad, pady=(S(18), S(8)))
+
+    # Left: title
+    _labeled(hbar, "DNDC", "heading_xl",
+             bg=COLORS["bg_primary"], fg=COLORS["accent"]).pack(side=tk.LEFT)
+    _labeled(hbar, "  Calibration Studio", "heading_xl",
+             bg=COLORS["bg_primary"], fg=COLORS["text_primary"]).pack(side=tk.LEFT)
+
+    # Right side: theme toggle + zoom hint
+    right_bar = tk.Frame(hbar, bg=COLORS["bg_primary"])
+    right_bar.pack(side=tk.RIGHT)
+    _labeled(right_bar, "Ctrl +/-  Zoom", "body_sm",
+             bg=COLORS["bg_primary"], fg=COLORS["text_tertiary"]).pack(side=tk.RIGHT)
+    # Theme toggle button
+    theme_btn = ModernButton(right_bar, "◐ Theme", toggle_theme,
+                             style="ghost", width=100, height=30)
+    theme_btn.pack(side=tk.RIGHT, padx=(0, S(16))); _register(theme_btn)
+
+    # Divider
+    tk.Frame(main, bg=COLORS["border"], height=1).pack(fill=tk.X, padx=pad, pady=(S(4), S(10)))
+
+    # ══════════ PROJECT CONFIG ══════════
+    c1 = ModernCard(main, title="Project Configuration", icon="⚙")
+    c1.pack(fill=tk.X, padx=pad, pady=(0, S(8)))
+    g1 = tk.Frame(c1, bg=COLORS["bg_secondary"])
+    g1.pack(fill=tk.X, padx=S(20), pady=(S(2), S(14)))
+
+    # DNDC Root hardcoded — no UI row needed
+    class _RootStub:
+        def get(self): return ROOT_FOLDER
+        def strip(self): return ROOT_FOLDER
+    root_folder_entry = _RootStub()
+
+    _labeled(g1, "Site Name", "label",
+             bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(12)))
+    site_name_entry = ModernEntry(g1, width=25, placeholder="e.g. F14-2024WEST")
+    site_name_entry.pack(side=tk.LEFT)
+    _labeled(g1, "auto-detected from batch file if blank", "body_sm",
+             bg=COLORS["bg_secondary"], fg=COLORS["text_tertiary"]).pack(side=tk.LEFT, padx=(S(16), 0))
+
+    # ══════════ CALIBRATION SETTINGS ══════════
+    c2 = ModernCard(main, title="Calibration Settings", icon="◎")
+    c2.pack(fill=tk.X, padx=pad, pady=(0, S(8)))
+    g2 = tk.Frame(c2, bg=COLORS["bg_secondary"])
+    g2.pack(fill=tk.X, padx=S(20), pady=(S(2), S(14)))
+
+    # Row 0: Target + Depth only
+    r0 = tk.Frame(g2, bg=COLORS["bg_secondary"])
+    r0.pack(fill=tk.X, pady=(0, S(4)))
+
+    _labeled(r0, "Target", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    target_var_combo = ModernCombobox(r0, values=TARGET_VARIABLES,
+                                     width=14, state="readonly", font=F("body"))
+    target_var_combo.pack(side=tk.LEFT, padx=(0, S(20)))
+    target_var_combo.current(0)
+    target_var_combo.bind("<<ComboboxSelected>>", on_target_var_change)
+
+    depth_label = _labeled(r0, "Depth", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"])
+    depth_label.pack(side=tk.LEFT, padx=(0, S(8)))
+    depth_combo = ModernCombobox(r0, width=8, state="readonly", font=F("body"))
+    depth_combo.pack(side=tk.LEFT, padx=(0, S(20)))
+
+    _labeled(r0, "Mode", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    mode_combo = ModernCombobox(r0, values=["Calibrate"] + UQ_METHODS, width=10, state="readonly", font=F("body"))
+    mode_combo.pack(side=tk.LEFT, padx=(0, S(20)))
+    mode_combo.set("Calibrate")
+    depth_label.pack_forget()
+    depth_combo.pack_forget()
+
+    # File rows: grid for alignment — NO weight=1 on entry col, use fixed width
+    file_grid = tk.Frame(g2, bg=COLORS["bg_secondary"])
+    file_grid.pack(fill=tk.X, pady=(0, S(4)))
+
+    file_defs = [
+        ("Batch File",    "*.txt", "Select Batch File",   None),
+        (".dnd File",     "*.dnd", "Select .dnd File",    None),
+        ("Observed CSV",  "*.csv", "Select Observed CSV",  "obs"),
+        ("Parameter CSV", "*.csv", "Select Parameter CSV", "param"),
+    ]
+
+    entries = []
+    for i, (label_text, ftype, title, tmpl) in enumerate(file_defs):
+        _labeled(file_grid, label_text, "label",
+                 bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).grid(
+            row=i, column=0, sticky="e", pady=S(3), padx=(0, S(10)))
+
+        e = ModernEntry(file_grid, width=55)
+        e.grid(row=i, column=1, pady=S(3), padx=(0, S(8)), sticky="w")
+        entries.append(e)
+
+        bb = ModernButton(file_grid, "Browse",
+                          lambda ew=e, ft=ftype, t=title: _browse_file(ew, ft, t),
+                          style="ghost", width=90, height=30)
+        bb.grid(row=i, column=2, pady=S(3), padx=(0, S(4))); _register(bb)
+
+        if tmpl == "obs":
+            tb = ModernButton(file_grid, "↓ Template", _dl_obs_template,
+                              style="outline", width=110, height=30)
+            tb.grid(row=i, column=3, pady=S(3)); _register(tb)
+        elif tmpl == "param":
+            tb = ModernButton(file_grid, "↓ Template", _dl_param_template,
+                              style="outline", width=110, height=30)
+            tb.grid(row=i, column=3, pady=S(3)); _register(tb)
+
+    batch_file_entry, dnd_file_entry, observed_csv_entry, param_csv_entry = entries
+
+    # Options row: Iterations + toggles — BELOW file rows
+    opts = tk.Frame(g2, bg=COLORS["bg_secondary"])
+    opts.pack(fill=tk.X, pady=(S(6), 0))
+
+    _labeled(opts, "Iterations", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    iterations_entry = ModernEntry(opts, width=6)
+    iterations_entry.pack(side=tk.LEFT)
+    iterations_entry.insert(0, "10")
+
+    _labeled(opts, "Time budget (h)", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(S(20), S(8)))
+    time_budget_entry = ModernEntry(opts, width=6, placeholder="none")
+    time_budget_entry.pack(side=tk.LEFT)
+
+    _spacer = tk.Frame(opts, bg=COLORS["bg_secondary"], width=S(30))
+    _spacer.pack(side=tk.LEFT)
+    save_dnd_var = tk.BooleanVar(value=False)
+    save_cp_var = tk.BooleanVar(value=True)
+    t1 = ModernToggle(opts, text="Save .dnd backups", variable=save_dnd_var)
+    t1.frame.pack(side=tk.LEFT, padx=(0, S(20))); _register(t1)
+    save_dnd_toggle = t1
+    t2 = ModernToggle(opts, text="Save iteration results", variable=save_cp_var)
+    t2.frame.pack(side=tk.LEFT); _register(t2)
+    save_checkpoint_toggle = t2
+
+    # Initial design row: space-filling points evaluated as one parallel batch
+    opts2 = tk.Frame(g2, bg=COLORS["bg_secondary"])
+    opts2.pack(fill=tk.X, pady=(S(6), 0))
+
+    _labeled(opts2, "Initial design", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    design_combo = ModernCombobox(opts2, values=INITIAL_DESIGNS, width=8, state="readonly", font=F("body"))
+    design_combo.pack(side=tk.LEFT, padx=(0, S(20)))
+    design_combo.set(DEFAULT_SETTINGS["initial_design"])
+
+    _labeled(opts2, "Design size", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    design_size_entry = ModernEntry(opts2, width=6)
+    design_size_entry.pack(side=tk.LEFT, padx=(0, S(20)))
+    design_size_entry.insert(0, str(DEFAULT_SETTINGS["initial_points"]))
+
+    _labeled(opts2, "Workers", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(0, S(8)))
+    workers_entry = ModernEntry(opts2, width=4)
+    workers_entry.pack(side=tk.LEFT)
+    workers_entry.insert(0, str(DEFAULT_SETTINGS["workers"]))
+
+    _labeled(opts2, "Broker port", "label", bg=COLORS["bg_secondary"], fg=COLORS["text_secondary"]).pack(side=tk.LEFT, padx=(S(20), S(8)))
+    broker_port_entry = ModernEntry(opts2, width=6, placeholder="local")
+    broker_port_entry.pack(side=tk.LEFT)
+
+    _spacer2 = tk.Frame(opts2, bg=COLORS["bg_secondary"], width=S(30))
+    _spacer2.pack(side=tk.LEFT)
+    mf_var = tk.BooleanVar(value=DEFAULT_SETTINGS["multi_fidelity"])
+    t3 = ModernToggle(opts2, text="Multi-fidelity screening", variable=mf_var)
+    t3.frame.pack(side=tk.LEFT); _register(t3)
+    multi_fidelity_toggle = t3
+
+    # ══════════ OUTPUT LOG (this is the only scrollable part) ══════════
+    c3 = ModernCard(main, title="Output Log", icon="▸")
+    c3.pack(fill=tk.BOTH, expand=True, padx=pad, pady=(0, S(8)))
+    lc = tk.Frame(c3, bg=COLORS["bg_secondary"])
+    lc.pack(fill=tk.BOTH, expand=True, padx=S(20), pady=(S(2), S(14)))
+
+    log_display = tk.Text(lc, height=10,
+                          bg=COLORS["bg_log"], fg=COLORS["text_secondary"],
+                          insertbackground=COLORS["accent"],
+                          font=F("mono"), wrap=tk.WORD,
+                          relief="flat", bd=0,
+                          highlightbackground=COLORS["border_input"],
+                          highlightthickness=1,
+                          padx=S(12), pady=S(8))
+    ls = tk.Scrollbar(lc, orient="vertical", command=log_display.yview)
+    log_display.configure(yscrollcommand=ls.set)
+    log_display.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+    ls.pack(side=tk.RIGHT, fill=tk.Y)
+    root.after(LOG_DRAIN_MS, _drain_log_queue)
+
+    # ══════════ BOTTOM BAR: Progress + Actions ══════════
+    bottom = tk.Frame(main, bg=COLORS["bg_primary"])
+    bottom.pack(fill=tk.X, padx=pad, pady=(S(4), S(16)))
+
+    # Progress
+    prow = tk.Frame(bottom, bg=COLORS["bg_primary"])
+    prow.pack(fill=tk.X, pady=(0, S(10)))
+    progress_label = _labeled(prow, "0%", "heading_sm",
+                              bg=COLORS["bg_primary"], fg=COLORS["accent"])
+    progress_label.pack(side=tk.RIGHT, padx=(S(10), 0))
+    progress_bar = ModernProgressBar(prow, height=6)
+    progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+    _register(progress_bar)
+
+    # Buttons
+    brow = tk.Frame(bottom, bg=COLORS["bg_primary"])
+    brow.pack(fill=tk.X)
+    for text, cmd, sty, w, ico in [
+        ("Start Calibration", start_calibration, "success", 220, "▶"),
+        ("Stop",              stop_calibration,  "danger",  80,  "■"),
+        ("Queue",             queue_calibration, "secondary", 100, "⏱"),
+        ("Results",           _open_results,     "secondary", 110, "📂"),
+    ]:
+        b = ModernButton(brow, text, cmd, style=sty, width=w, height=40, icon=ico)
+        b.pack(side=tk.LEFT, padx=(0, S(10))); _register(b)
+
+    b_exit = ModernButton(brow, "Exit", _exit, style="ghost", width=80, height=40)
+    b_exit.pack(side=tk.RIGHT); _register(b_exit)
+    queue_label = _labeled(brow, "", "body_sm", bg=COLORS["bg_primary"], fg=COLORS["text_secondary"])
+    queue_label.pack(side=tk.RIGHT, padx=(0, S(14)))
+
+    # ── Welcome ──
+    log_message("  DNDC Calibration Studio")
+    log_message(f"  DPI: {base_dpi_scale:.2f}x ({int(base_dpi_scale * 96)} DPI)")
+    log_message(f"  {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    log_message("")
+    log_message("  Ctrl++/Ctrl+-  Zoom  ·  Ctrl+0 Reset")
+    log_message("  Ctrl+T  Toggle light/dark theme")
+    log_message("  F1: Start  ·  Esc: Exit")
+    log_message("  Output: <root>/calibration_results/<site>/")
+    log_message("")
+
+    # Ready state: the window is already up; load the calibration libraries behind it
+    progress_label.config(text="Loading…")
+
+    def _warm_up():
+        try:
+            preload_heavy_modules()
+        except Exception as e:
+            log_message(f"✗ Could not load calibration libraries: {e}")
+            return
+        root.after(0, lambda: progress_label.cget("text") == "Loading…" and progress_label.config(text="Ready"))
+
+    root.after(100, lambda: threading.Thread(target=_warm_up, daemon=True).start())
+    refresh_queue_status(schedule=True)
+    root.mainloop()
+
+
+# =====================================================================
+#  COMMAND LINE  (python caln.py <command> ...; no arguments opens the UI)
+# =====================================================================
+def _cli_rescore(args):
+    ranked = rescore_results(args.results_dir, args.target, args.observed, args.depth,
+                             args.param_csv, args.workers, args.output)
+    return 0 if ranked else 1
+
+def _cli_worker(args):
+    try:
+        run_remote_worker(args.broker, args.root, args.id, max_jobs=args.max_jobs,
+                          token=_cli_broker_token(args))
+    except KeyboardInterrupt:
+        log_message("  Worker stopped.")
+    finally:
+        terminate_active_processes()
+    return 0
+
+def _cli_ingest(args):
+    settings = load_user_settings()
+    for key, value in (("flux_value_column", args.column), ("flux_scale", args.scale),
+                       ("flux_aggregate", args.aggregate), ("flux_min_coverage", args.min_coverage)):
+        if value is not None:
+            settings[key] = value
+    cache_dir = args.cache_dir or os.path.join(ROOT_FOLDER, "calibration_results", "obs_cache")
+    daily_csv = prepare_observations(args.target, args.source, cache_dir, settings)
+    print(daily_csv)
+    return 0
+
+def _cli_columnar(args):
+    from concurrent.futures import ProcessPoolExecutor
+    iter_dirs = find_saved_iterations(args.results_dir)
+    if not iter_dirs:
+        log_message(f"✗ No saved iterations under {args.results_dir}")
+        return 1
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers or None, initializer=register_output_schemas,
+                             initargs=(output_schema_settings(),)) as pool:
+        converted = sum(pool.map(convert_outputs_to_columnar, iter_dirs))
+    log_message(f"  ✓ {converted} output file(s) in {len(iter_dirs)} iterations converted "
+                f"in {time.time() - started:.1f}s")
+    return 0
+
+def _parse_setting(text):
+    """KEY=VALUE from the command line; VALUE is read as JSON when it parses."""
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+QUEUE_CSV_COLUMNS = ["site", "target", "depth", "batch", "dnd", "observed", "param_csv",
+                     "iterations", "workers", "priority", "weight", "root"]
+
+def _queue_specs_from_csv(csv_path):
+    """Job specs from a CSV with QUEUE_CSV_COLUMNS headers (target, batch, dnd, observed,
+    param_csv required); other columns become settings overrides."""
+    rows = pd.read_csv(csv_path, dtype=str).fillna("")
+    specs = []
+    for _, row in rows.iterrows():
+        spec, settings = {}, {}
+        for col, value in row.items():
+            col = str(col).strip()
+            value = str(value).strip()
+            if not value:
+                continue
+            if col in ("iterations", "workers"):
+                settings[col] = int(float(value))
+            elif col in QUEUE_CSV_COLUMNS:
+                spec[col] = value
+            else:
+                settings[col] = _parse_setting(f"{col}={value}")[1]
+        spec["settings"] = settings
+        specs.append(spec)
+    return specs
+
+def _cli_catalog(args):
+    settings = load_user_settings()
+    if args.catalog:
+        settings["catalog_file"] = args.catalog
+    path = settings.get("catalog_file") or CATALOG_FILE
+    if not os.path.exists(path):
+        print(f"✗ No catalog at {path}")
+        return 1
+    if args.catalog_command == "similar":
+        param_ranges_df = read_param_ranges(args.param_csv)
+        lines = read_dnd_file(args.dnd)
+        if param_ranges_df.empty or not lines:
+            return 1
+        found = similar_calibrations(lines, args.target, args.depth, param_ranges_df, args.k, settings)
+        for cal in found:
+            distance = "   n/a" if cal["distance"] is None else f"{cal['distance']:6.3f}"
+            best = ", ".join(f"{n}={v:.4g}" if isinstance(v, float) else f"{n}={v}"
+                             for n, v in cal["best"].items())
+            print(f"#{cal['id']:<5} {distance}  {cal['site']:<20} RMSE={cal['rmse']:.4g}  {best}")
+        if not found:
+            print(f"no earlier {args.target} calibrations with these parameters")
+        return 0
+    con = open_catalog(path)
+    try:
+        if args.catalog_command == "show":
+            row = con.execute("SELECT * FROM calibrations WHERE id = ?", (args.id,)).fetchone()
+            if row is None:
+                print(f"✗ No calibration #{args.id}")
+                return 1
+            print(f"#{row['id']} {row['site']} {row['target']}{' @ ' + row['depth'] if row['depth'] else ''}"
+                  f"  RMSE={row['rmse']:.4g}  R²={row['r2']:.3f}  iteration #{row['best_iteration']}"
+                  f" of {row['n_runs']}  ({datetime.fromtimestamp(row['finished']):%Y-%m-%d %H:%M})")
+            print(f"  .dnd {row['dnd_path']}")
+            for p in con.execute("SELECT * FROM parameters WHERE calibration_id = ? ORDER BY position",
+                                 (args.id,)):
+                print(f"  {p['name']:<24} {p['best']!s:<14} [{p['low']}, {p['high']}]  line {p['line_number']}")
+            return 0
+        query, params = "SELECT * FROM calibrations", []
+        filters = [(col, val) for col, val in (("site", args.site), ("target", args.target)) if val]
+        if filters:
+            query += " WHERE " + " AND ".join(f"{col} = ?" for col, _ in filters)
+            params = [val for _, val in filters]
+        for row in con.execute(query + " ORDER BY finished DESC LIMIT ?", params + [args.limit]):
+            print(f"#{row['id']:<5} {datetime.fromtimestamp(row['finished']):%Y-%m-%d %H:%M}  {row['site']:<20} "
+                  f"{row['target']}{'@' + row['depth'] if row['depth'] else '':<12} RMSE={row['rmse']:.4g}  "
+                  f"({row['n_runs']} runs)")
+        return 0
+    finally:
+        con.close()
+
+def _cli_pipeline(args):
+    try:
+        spec = load_pipeline(args.spec)
+    except (OSError, ValueError) as e:
+        print(f"✗ {args.spec}: {e}")
+        return 1
+    outcomes = run_pipeline(spec, resume=args.resume)
+    return 0 if len(outcomes) == len(spec["stages"]) else 1
+
+def _cli_queue(args):
+    if args.queue_command == "run":
+        started = run_queue(args.queue, args.slots, args.max_jobs, keep_running=args.keep_running)
+        return 1 if started is None else 0
+    if args.queue_command == "add":
+        if args.from_csv:
+            specs = _queue_specs_from_csv(args.from_csv)
+        else:
+            settings = dict(args.set or [])
+            for key in ("iterations", "workers", "mode"):
+                if getattr(args, key) is not None:
+                    settings[key] = getattr(args, key)
+            specs = [{"target": args.target, "depth": args.depth, "site": args.site, "root": args.root,
+                      "batch": args.batch, "dnd": args.dnd, "observed": args.observed,
+                      "param_csv": args.param_csv, "save_dnd": args.save_dnd, "save_iter": args.save_iter,
+                      "priority": args.priority, "weight": args.weight, "settings": settings}]
+        for spec in specs:
+            spec = {k: v for k, v in spec.items() if v is not None}
+            try:
+                print(f"queued job #{submit_job(spec, args.queue)}")
+            except ValueError as e:
+                print(f"✗ {e}")
+                return 1
+        if args.start and start_queue_runner(args.queue):
+            print("queue runner started")
+        return 0
+    try:
+        if args.queue_command == "cancel":
+            for job_id in args.ids:
+                print(f"#{job_id}: {cancel_job(job_id, args.queue)}")
+            return 0
+        if args.queue_command == "priority":
+            set_job_priority(args.id, args.priority, args.queue)
+            return 0
+    except ValueError as e:
+        print(f"✗ {e}")
+        return 1
+    print("\n".join(format_queue(load_queue(args.queue), show_all=args.all)))
+    return 0
+
+def measure_import_time(repeats=3):
+    """Import caln in fresh interpreters with -X importtime; keep the fastest run.
+    Returns (total seconds, {module: cumulative seconds})."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(max(1, repeats)):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import caln"],
+                              cwd=here, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+        modules = {}
+        for line in proc.stderr.splitlines():
+            parts = line.split("|")
+            if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            modules[parts[2].strip()] = int(parts[1]) / 1e6
+        total = modules.get("caln", sum(modules.values()))
+        if best is None or total < best[0]:
+            best = (total, modules)
+    return best
+
+def _cli_metrics(args):
+    source = args.source or f"localhost:{load_user_settings().get('metrics_port') or 9101}"
+    try:
+        if os.path.exists(source):
+            with open(source, 'r', encoding='utf-8') as f:
+                text = f.read()
+        else:
+            url = source if "://" in source else f"http://{source}/metrics"
+            req = urllib.request.Request(url, headers={"Accept": OPENMETRICS_TYPE})
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                text = resp.read().decode("utf-8")
+            if "openmetrics" in (resp.headers.get("Content-Type") or "") and \
+                    not text.rstrip().endswith("# EOF"):
+                raise ValueError("OpenMetrics reply without the final '# EOF'")
+        samples = parse_metrics_text(text)
+    except (OSError, ValueError) as e:
+        print(f"✗ {source}: {e}")
+        return 1
+    runs = OrderedDict()
+    for name, labels, value in samples:
+        key = tuple((k, v) for k, v in labels.items() if k not in ("kind", "result", "le", "state"))
+        runs.setdefault(key, {})[name if "kind" not in labels and "result" not in labels
+                                 else f"{name}:{labels.get('kind') or labels.get('result')}"] = value
+    for key, m in runs.items():
+        if not key:
+            continue
+        hits, misses = m.get("dndc_cache_lookups_total:hit", 0), m.get("dndc_cache_lookups_total:miss", 0)
+        runs_done = m.get("dndc_run_duration_seconds_count", 0)
+        mean = m.get("dndc_run_duration_seconds_sum", 0) / runs_done if runs_done else 0.0
+        state = "running" if m.get("dndc_calibration_active") else "finished"
+        print(f"{' '.join(f'{k}={v}' for k, v in key)}  [{state}]")
+        print(f"    iterations {m.get('dndc_iterations_total', 0):.0f}  best RMSE {m.get('dndc_best_rmse', float('nan')):.4g}"
+              f"  in flight {m.get('dndc_evaluations_in_flight', 0):.0f}"
+              f"  waiting {m.get('dndc_evaluations_waiting', 0):.0f}")
+        print(f"    DNDC runs {runs_done:.0f} (mean {mean:.1f}s)  cache hits {hits:.0f}/{hits + misses:.0f}"
+              f"  failures {m.get('dndc_run_failures_total:transient', 0):.0f} transient,"
+              f" {m.get('dndc_run_failures_total:deterministic', 0):.0f} deterministic")
+    queue_jobs = {labels["state"]: value for name, labels, value in samples if name == "dndc_queue_jobs"}
+    if queue_jobs:
+        print("queue: " + ", ".join(f"{n:.0f} {state}" for state, n in queue_jobs.items()))
+    print(f"✓ {len(samples)} sample(s) from {source}")
+    return 0
+
+def _cli_importtime(args):
+    if getattr(sys, "frozen", False):
+        print("importtime needs the source version (python caln.py importtime)")
+        return 1
+    total, modules = measure_import_time(args.repeats)
+    print(f"import caln: {total * 1000:.0f} ms (budget {args.budget * 1000:.0f} ms)")
+    for name, secs in sorted(modules.items(), key=lambda kv: -kv[1])[1:args.top + 1]:
+        print(f"  {secs * 1000:8.1f} ms  {name}")
+    eager = sorted({m for m in modules if m.split(".")[0] in HEAVY_MODULES and "." not in m})
+    if eager:
+        print(f"✗ Imported eagerly: {', '.join(eager)} — import them inside the functions that use them")
+    if total > args.budget:
+        print("✗ Import time over budget")
+    return 1 if eager or total > args.budget else 0
+
+def _cli_scenarios(args):
+    param_ranges_df = read_param_ranges(args.param_csv)
+    if param_ranges_df.empty:
+        return 1
+    param_sets = load_parameter_sets(args.results, param_ranges_df, args.top_k)
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.results)), "scenarios")
+    summary = run_scenarios(param_sets, param_ranges_df, args.scenarios, args.root, output,
+                            template_batch=args.batch, workers=args.workers,
+                            include_baseline=args.baseline, keep_outputs=args.keep_outputs)
+    return 0 if not summary.empty else 1
+
+def _cli_validate(args):
+    param_ranges_df = read_param_ranges(args.param_csv)
+    if param_ranges_df.empty:
+        return 1
+    lines = read_dnd_file(args.dnd)
+    paths = get_output_paths(args.root, args.site or auto_detect_site_name(args.batch))
+    observed_csv = prepare_observations(args.target, args.observed, paths["obs_cache_dir"])
+    settings = {**load_user_settings(), "workers": args.workers or DEFAULT_SETTINGS["workers"]}
+    candidates = [{"Iteration": int(label.split("_")[1]), "Parameters": values, "Metrics": {"RMSE": np.nan}}
+                  for label, values in load_parameter_sets(args.results, param_ranges_df, args.pool)]
+    ctx = make_eval_context(param_ranges_df, lines, args.target, args.depth, paths, args.batch,
+                            args.dnd, observed_csv, False, False, settings)
+    try:
+        output = validate_top_candidates(candidates, ctx, args.target, args.depth, param_ranges_df,
+                                         os.path.dirname(os.path.abspath(args.results)),
+                                         args.scheme, args.folds, args.top_k, settings["workers"])
+    finally:
+        close_eval_context(ctx)
+    return 0 if output else 1
+
+def _cli_broker_token(args):
+    return (args.token or os.environ.get("DNDC_BROKER_TOKEN")
+            or load_user_settings().get("broker_token"))
+
+def _cli_broker_stats(args):
+    req = urllib.request.Request(args.broker.rstrip("/") + "/stats",
+                                 headers=_broker_headers(_cli_broker_token(args)))
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        print(json.dumps(json.loads(resp.read()), indent=2))
+    return 0
+
+def build_cli():
+    parser = argparse.ArgumentParser(prog="caln.py",
+                                     description="DNDC Calibration Studio — headless commands. "
+                                                 "Run without arguments to open the UI.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("rescore", help="Re-score saved iterations against new observations")
+    p.add_argument("results_dir", help="calibration_results/<site> folder with iteration_outputs/")
+    p.add_argument("--target", required=True, choices=TARGET_VARIABLES)
+    p.add_argument("--observed", required=True, help="Observed CSV (Year[,Day],Value)")
+    p.add_argument("--depth", help="Soil depth for SoilTemp/SoilMoisture, e.g. 10cm")
+    p.add_argument("--param-csv", help="Parameter CSV, to report values from dnd_backups/")
+    p.add_argument("--workers", type=int, help="Parser processes (default: all cores)")
+    p.add_argument("--output", help="Output folder (default: <results_dir>/rescored)")
+    p.set_defaults(func=_cli_rescore)
+
+    p = sub.add_parser("worker", help="Run DNDC jobs for a calibration broker on another machine")
+    p.add_argument("--broker", required=True, help="Broker URL, e.g. http://calib-pc:8765")
+    p.add_argument("--root", default=ROOT_FOLDER, help="Folder containing DNDC95.exe (default: C:\\DNDC)")
+    p.add_argument("--id", help="Worker name shown in throughput stats (default: host-pid)")
+    p.add_argument("--max-jobs", type=int, help="Exit after this many jobs")
+    p.add_argument("--token", help="Broker token (default: $DNDC_BROKER_TOKEN or broker_token setting)")
+    p.set_defaults(func=_cli_worker)
+
+    p = sub.add_parser("columnar", help="Add memory-mappable columnar copies to saved iteration outputs")
+    p.add_argument("results_dir", help="calibration_results/<site> folder with iteration_outputs/")
+    p.add_argument("--workers", type=int, help="Converter processes (default: all cores)")
+    p.set_defaults(func=_cli_columnar)
+
+    p = sub.add_parser("queue", help="Queue calibrations and run them unattended on shared DNDC slots")
+    p.add_argument("--queue", default=QUEUE_FILE, help="Queue file (default: <root>\\calibration_queue.json)")
+    p.set_defaults(func=_cli_queue, queue_command="list", all=False)
+    qsub = p.add_subparsers(dest="queue_command")
+    q = qsub.add_parser("list", help="Show queued and running jobs")
+    q.add_argument("--all", action="store_true", help="Include finished, failed and cancelled jobs")
+    q = qsub.add_parser("add", help="Add a calibration job (or many with --from-csv)")
+    q.add_argument("--from-csv", help="CSV with one job per row: " + ", ".join(QUEUE_CSV_COLUMNS))
+    q.add_argument("--target", choices=TARGET_VARIABLES)
+    q.add_argument("--depth", help="Soil depth for SoilTemp/SoilMoisture, e.g. 10cm")
+    q.add_argument("--site", help="Site name (default: from the batch file)")
+    q.add_argument("--root", default=ROOT_FOLDER, help="Folder containing DNDC95.exe (default: C:\\DNDC)")
+    q.add_argument("--batch")
+    q.add_argument("--dnd")
+    q.add_argument("--observed")
+    q.add_argument("--param-csv")
+    q.add_argument("--iterations", type=int)
+    q.add_argument("--workers", type=int, help="Most DNDC slots this job may use at once")
+    q.add_argument("--mode", choices=["Calibrate"] + UQ_METHODS)
+    q.add_argument("--priority", type=int, default=0, help="Higher runs first and gets slots first")
+    q.add_argument("--weight", type=float, default=1.0, help="Fair-share weight among equal priorities")
+    q.add_argument("--set", action="append", type=_parse_setting, metavar="KEY=VALUE",
+                   help="Override a calibration setting for this job (repeatable)")
+    q.add_argument("--save-dnd", action="store_true")
+    q.add_argument("--save-iter", action="store_true")
+    q.add_argument("--start", action="store_true", help="Start a background runner if none is active")
+    q = qsub.add_parser("cancel", help="Cancel queued jobs or stop running ones")
+    q.add_argument("ids", nargs="+", type=int)
+    q = qsub.add_parser("priority", help="Change a job's priority")
+    q.add_argument("id", type=int)
+    q.add_argument("priority", type=int)
+    q = qsub.add_parser("run", help="Work through the queue in this process")
+    q.add_argument("--slots", type=int, help="DNDC runs at once over all jobs (default: CPU count)")
+    q.add_argument("--max-jobs", type=int, help="Calibrations at once (default: --slots)")
+    q.add_argument("--keep-running", action="store_true", help="Wait for new jobs instead of exiting when empty")
+
+    p = sub.add_parser("importtime", help="Check how long importing caln.py takes (startup regression check)")
+    p.add_argument("--budget", type=float, default=0.5, help="Fail above this many seconds (default 0.5)")
+    p.add_argument("--repeats", type=int, default=3, help="Fresh interpreters to try; the fastest counts")
+    p.add_argument("--top", type=int, default=10, help="Slowest imported modules to list")
+    p.set_defaults(func=_cli_importtime)
+
+    p = sub.add_parser("metrics", help="Scrape the metrics exporter (or read its textfile) and summarize it")
+    p.add_argument("source", nargs="?",
+                   help="URL, host:port or .prom file (default: localhost:<metrics_port>)")
+    p.set_defaults(func=_cli_metrics)
+
+    p = sub.add_parser("catalog", help="Search the catalog of past calibrations")
+    p.add_argument("--catalog", help="Catalog file (default: catalog_file setting)")
+    csub = p.add_subparsers(dest="catalog_command", required=True)
+    c = csub.add_parser("list", help="Most recent calibrations")
+    c.add_argument("--site")
+    c.add_argument("--target", choices=TARGET_VARIABLES)
+    c.add_argument("--limit", type=int, default=30)
+    c = csub.add_parser("show", help="Parameters of one calibration")
+    c.add_argument("id", type=int)
+    c = csub.add_parser("similar", help="Earlier calibrations most similar to a site (the warm-start candidates)")
+    c.add_argument("--dnd", required=True)
+    c.add_argument("--param-csv", required=True)
+    c.add_argument("--target", required=True, choices=TARGET_VARIABLES)
+    c.add_argument("--depth")
+    c.add_argument("-k", type=int, default=5)
+    p.set_defaults(func=_cli_catalog)
+
+    p = sub.add_parser("pipeline", help="Calibrate stages in sequence, each from the previous stage's best .dnd")
+    p.add_argument("spec", help="Pipeline JSON file (see READ ME)")
+    p.add_argument("--resume", action="store_true",
+                   help="Skip stages already finished with the same stage spec")
+    p.set_defaults(func=_cli_pipeline)
+
+    p = sub.add_parser("scenarios", help="Run scenario .dnd/batch files with calibrated parameters")
+    p.add_argument("scenarios", nargs="+", help="Scenario .dnd files and/or DNDC batch files")
+    p.add_argument("--results", required=True, help="Calibration workbook (*_calibration_results.xlsx)")
+    p.add_argument("--param-csv", required=True, help="Parameter CSV used for the calibration")
+    p.add_argument("--batch", help="Template batch file for .dnd scenarios")
+    p.add_argument("--top-k", type=int, default=1, help="Run the K best parameter sets (default 1)")
+    p.add_argument("--baseline", action="store_true", help="Also run each scenario unmodified")
+    p.add_argument("--root", default=ROOT_FOLDER, help="Folder containing DNDC95.exe (default: C:\\DNDC)")
+    p.add_argument("--workers", type=int, help=f"Parallel DNDC runs (default {DEFAULT_SETTINGS['workers']})")
+    p.add_argument("--output", help="Output folder (default: scenarios/ next to the workbook)")
+    p.add_argument("--keep-outputs", action="store_true",
+                   help="Keep every DNDC output file (default: only the files the summary reads)")
+    p.set_defaults(func=_cli_scenarios)
+
+    p = sub.add_parser("validate", help="Year-split cross-validation of the top-K calibrated parameter sets")
+    p.add_argument("--results", required=True, help="Calibration workbook (*_calibration_results.xlsx)")
+    p.add_argument("--param-csv", required=True)
+    p.add_argument("--batch", required=True)
+    p.add_argument("--dnd", required=True)
+    p.add_argument("--observed", required=True)
+    p.add_argument("--target", required=True, choices=TARGET_VARIABLES)
+    p.add_argument("--depth", help="Soil depth for SoilTemp/SoilMoisture, e.g. 10cm")
+    p.add_argument("--scheme", choices=CV_SCHEMES, default="kfold")
+    p.add_argument("--folds", type=int, default=5)
+    p.add_argument("--top-k", type=int, default=10, help="Candidates scored per fold")
+    p.add_argument("--pool", type=int, default=0,
+                   help="Iterations re-simulated and ranked per fold (default: all; sim_cache makes "
+                        "repeats cheap). Ranking a full-period top list would leak validation years")
+    p.add_argument("--site", help="Site name (default: from the batch file)")
+    p.add_argument("--root", default=ROOT_FOLDER, help="Folder containing DNDC95.exe (default: C:\\DNDC)")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(func=_cli_validate)
+
+    p = sub.add_parser("ingest", help="Aggregate a half-hourly flux-tower file to daily observations")
+    p.add_argument("source", help="Half-hourly CSV with TIMESTAMP_START/END or Year,DoY,Hour columns")
+    p.add_argument("--target", required=True, choices=[t for t in TARGET_VARIABLES if target_is_daily(t)])
+    p.add_argument("--column", help="Value column (default: first match in FLUX_PRESETS)")
+    p.add_argument("--scale", type=float, help="Multiplier turning one record into the daily unit")
+    p.add_argument("--aggregate", choices=["sum", "mean"])
+    p.add_argument("--min-coverage", type=float, help="Fraction of valid records a day needs (default 0.8)")
+    p.add_argument("--cache-dir", help="Cache folder (default: <root>/calibration_results/obs_cache)")
+    p.set_defaults(func=_cli_ingest)
+
+    p = sub.add_parser("broker-stats", help="Show per-worker throughput of a running broker")
+    p.add_argument("broker", help="Broker URL, e.g. http://calib-pc:8765")
+    p.add_argument("--token", help="Broker token (default: $DNDC_BROKER_TOKEN or broker_token setting)")
+    p.set_defaults(func=_cli_broker_stats)
+    return parser
+
+def run_cli(argv):
+    args = build_cli().parse_args(argv)
+    return args.func(args)
+
+
+# =====================================================================
+#  ENTRY POINT
+# =====================================================================
+if __name__ == "__main__":
+    try:
+        register_output_schemas(load_user_settings())
+    except ValueError as e:
+        print(f"Output schema error in {SETTINGS_FILE}: {e}")
+        sys.exit(2)
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    if is_already_running():
+        try:
+            r = tk.Tk(); r.withdraw()
+            messagebox.showerror("Error", "Another instance running."); r.destroy()
+        except: print("Another instance running.")
+        sys.exit(1)
     create_ui()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os
+import socket
+import stat
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import caln  # noqa: E402
+
+# Stand-in for DNDC95.exe: reads the batch's .dnd and writes a Multi_year_summary.csv
+# whose yield depends on param_a / param_b, so calibrations have something to fit.
+FAKE_DNDC = textwrap.dedent('''\
+    #!{python}
+    import os, sys, time
+    a = sys.argv
+    out, batch = a[a.index("-output") + 1], a[a.index("-s") + 1]
+    time.sleep(float(os.environ.get("FAKE_DNDC_SLEEP", "0.05")))
+    with open(batch) as f:
+        dnd = next(l.strip().strip('"') for l in f if l.strip().strip('"').lower().endswith(".dnd"))
+    values = {{}}
+    with open(dnd) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                try:
+                    values[parts[0]] = float(parts[1])
+                except ValueError:
+                    pass
+    years = int(values.get("Simulated_years", 5))
+    pa, pb = values.get("param_a", 1.0), values.get("param_b", 2.0)
+    folder = os.path.join(out, "Record", "Batch", os.path.splitext(os.path.basename(dnd))[0])
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "Multi_year_summary.csv"), "w") as f:
+        f.write("h\\nh\\nh\\nh\\nh\\n")
+        for y in range(1, years + 1):
+            f.write(f"{{y}},x,{{2000 * pa - 300 * (pb - 2) ** 2 + 50 * y}},0\\n")
+''')
+
+
+@pytest.fixture
+def dndc_site(tmp_path, monkeypatch):
+    """A DNDC root with the stand-in DNDC95.exe and one site (batch, .dnd, parameters,
+    yield observations). Returns a dict of their paths."""
+    if os.name == "nt":
+        pytest.skip("the stand-in DNDC95.exe is a Python script")
+    root = tmp_path / "root"
+    site = tmp_path / "site"
+    root.mkdir()
+    site.mkdir()
+    exe = root / "DNDC95.exe"
+    exe.write_text(FAKE_DNDC.format(python=sys.executable))
+    exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    dnd = site / "site1.dnd"
+    dnd.write_text("Site_name site1\nSimulated_years 5\nparam_a 1.0\nparam_b 2.0\nparam_c 0.5\n")
+    batch = site / "batch.txt"
+    batch.write_text(f"1\n{dnd}\n")
+    params = site / "params.csv"
+    params.write_text("parameter_name,min,max,line_number\n"
+                      "param_a,0.5,2.0,2\nparam_b,1.0,3.0,3\n")
+    observed = site / "obs_yield.csv"
+    observed.write_text("Description\nUnits\n" + "".join(
+        f"{y},{2000 * 1.3 - 300 * 0.25 + 50 * y}\n" for y in range(1, 6)))
+    monkeypatch.setattr(caln, "load_user_settings",
+                        lambda path=None: {**caln.DEFAULT_SETTINGS, "catalog": False})
+    monkeypatch.setattr(caln, "stop_calibration_flag", False)
+    return {"root": str(root), "site": str(site), "dnd": str(dnd), "batch": str(batch),
+            "params": str(params), "observed": str(observed)}
+
+
+@pytest.fixture
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+import urllib.request
+
+import caln
+
+
+def _calibrate(site, settings):
+    return caln.calibrate_variable("Yield", None, site["root"], "site1", site["batch"], site["dnd"],
+                                   site["observed"], site["params"], False, False,
+                                   {"iterations": 6, "workers": 2, "initial_points": 3,
+                                    "catalog": False, **settings})
+
+
+def _lease_and_die(url, leased):
+    """A worker that takes one job and is then killed: it never heartbeats or replies."""
+    while True:
+        req = urllib.request.Request(url + "/lease", data=json.dumps({"worker": "killed", "wait": 1}).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                if resp.read():
+                    leased.set()
+                    return
+        except OSError:
+            time.sleep(0.1)
+
+
+def test_workers_finish_a_calibration_and_requeue_a_killed_workers_job(dndc_site, free_port):
+    url = f"http://127.0.0.1:{free_port}"
+    leased = threading.Event()
+    threading.Thread(target=_lease_and_die, args=(url, leased), daemon=True).start()
+
+    def _start_workers():
+        leased.wait(30)  # the killed worker holds a job before the others connect
+        for name in ("w1", "w2"):
+            threading.Thread(target=caln.run_remote_worker, args=(url, dndc_site["root"], name),
+                             kwargs={"poll_wait": 1, "heartbeat_interval": 0.5, "retry_interval": 0.2},
+                             daemon=True).start()
+    threading.Thread(target=_start_workers, daemon=True).start()
+
+    stats = {}
+    original_close = caln.JobBroker.close
+
+    def _close(broker):
+        stats.update(broker.stats())
+        original_close(broker)
+    caln.JobBroker.close = _close
+    try:
+        outcome = _calibrate(dndc_site, {"broker_port": free_port, "broker_lease_timeout": 2,
+                                         "broker_lease_wait": 0})
+    finally:
+        caln.JobBroker.close = original_close
+
+    assert leased.is_set()
+    assert outcome and outcome["best_iteration"] > 0
+    workers = stats["workers"]
+    assert workers["killed"]["lost"] == 1 and workers["killed"]["jobs"] == 0
+    assert workers["w1"]["jobs"] + workers["w2"]["jobs"] >= 6
+
+
+def test_jobs_no_worker_leases_run_locally(dndc_site, free_port):
+    started = time.time()
+    outcome = _calibrate(dndc_site, {"broker_port": free_port, "broker_lease_wait": 1})
+    assert outcome and outcome["best_iteration"] > 0
+    assert time.time() - started < 120
+
+
+def test_remote_wait_ends_at_the_time_budget(dndc_site, free_port):
+    started = time.time()
+    _calibrate(dndc_site, {"broker_port": free_port, "broker_lease_wait": 0,
+                           "time_budget_hours": 2 / 3600})
+    assert time.time() - started < 30
+
+
+def test_broker_rejects_requests_without_the_token(free_port):
+    broker = caln.JobBroker("127.0.0.1", free_port, token="secret")
+    try:
+        req = urllib.request.Request(f"http://127.0.0.1:{free_port}/stats")
+        try:
+            urllib.request.urlopen(req, timeout=5)
+            status = 200
+        except urllib.error.HTTPError as e:
+            status = e.code
+        assert status == 401
+        req.add_header(caln.BROKER_TOKEN_HEADER, "secret")
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            assert resp.status == 200
+    finally:
+        broker.close()
+
+
+def test_worker_runs_in_capped_scratch_and_falls_back_to_disk(dndc_site, free_port, tmp_path, monkeypatch):
+    scratch_root = tmp_path / "scratch"
+    scratch_root.mkdir()
+    monkeypatch.setattr(caln, "load_user_settings", lambda path=None: {
+        **caln.DEFAULT_SETTINGS, "catalog": False, "scratch_dir": str(scratch_root),
+        "scratch_max_mb": 1e-6})  # one run's files already exceed the cap
+    seen = set()
+
+    def _watch():
+        while not done.is_set():
+            for folder, _, _ in caln.os.walk(scratch_root):
+                seen.add(folder)
+            time.sleep(0.02)
+    done = threading.Event()
+    threading.Thread(target=_watch, daemon=True).start()
+    url = f"http://127.0.0.1:{free_port}"
+    worker = threading.Thread(target=caln.run_remote_worker, args=(url, dndc_site["root"], "w1"),
+                              kwargs={"poll_wait": 1, "heartbeat_interval": 0.5, "retry_interval": 0.2,
+                                      "max_jobs": 3}, daemon=True)
+    worker.start()
+    # The worker quits after 3 jobs; the rest run locally
+    outcome = _calibrate(dndc_site, {"broker_port": free_port, "broker_lease_wait": 3,
+                                     "iterations": 4, "workers": 1})
+    worker.join(30)
+    done.set()
+
+    assert outcome and not worker.is_alive()
+    assert any(caln.os.path.basename(f) == "slot_00" for f in seen)  # first run used scratch
+    disk = caln.os.path.join(dndc_site["root"], "output_files", "remote", "w1", "site1.dnd")
+    assert caln.os.path.isfile(disk)  # later runs did not fit and went to disk
+    assert not any(files for _, _, files in caln.os.walk(scratch_root))  # released on exit
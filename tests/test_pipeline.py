@@ -0,0 +1,50 @@
+import json
+import os
+
+import caln
+
+
+def _write_spec(site, tmp_path):
+    params_b = os.path.join(site["site"], "params_b.csv")
+    with open(params_b, "w") as f:
+        f.write("parameter_name,min,max,line_number\nparam_b,1.0,3.0,3\n")
+    params_a = os.path.join(site["site"], "params_a.csv")
+    with open(params_a, "w") as f:
+        f.write("parameter_name,min,max,line_number\nparam_a,0.5,2.0,2\n")
+    spec = {"name": "two_stage", "root": site["root"], "site": "site1",
+            "batch": site["batch"], "dnd": site["dnd"],
+            "settings": {"workers": 2, "initial_points": 3, "catalog": False},
+            "stages": [
+                {"name": "yield_a", "target": "Yield", "param_csv": params_a,
+                 "observed": site["observed"], "iterations": 5},
+                {"name": "yield_b", "target": "Yield", "param_csv": params_b,
+                 "observed": site["observed"], "iterations": 5},
+            ]}
+    path = tmp_path / "pipeline.json"
+    path.write_text(json.dumps(spec))
+    return str(path)
+
+
+def test_two_stage_pipeline_runs_end_to_end(dndc_site, tmp_path):
+    spec = caln.load_pipeline(_write_spec(dndc_site, tmp_path))
+    with open(dndc_site["dnd"]) as f:
+        original = f.read()
+
+    outcomes = caln.run_pipeline(spec)
+
+    assert len(outcomes) == 2
+    pipeline_dir = os.path.join(dndc_site["root"], "calibration_results", "site1", "pipelines", "two_stage")
+    final = caln.read_dnd_file(os.path.join(pipeline_dir, "site1.dnd"))
+    values = caln.read_current_values(final, caln.read_param_ranges(dndc_site["params"]))
+    expected = [outcomes[0]["best_params"][0], outcomes[1]["best_params"][0]]
+    assert all(abs(v - e) < 1e-5 for v, e in zip(values, expected))
+    # Each stage ran its own copy of the .dnd through its own batch; the site's files are untouched
+    for stage in ("01_yield_a", "02_yield_b"):
+        stage_dir = os.path.join(pipeline_dir, stage)
+        _, ref = caln.batch_dnd_ref(os.path.join(stage_dir, "batch.txt"))
+        assert ref == os.path.join(stage_dir, "site1.dnd")
+    with open(dndc_site["dnd"]) as f:
+        assert f.read() == original
+
+    resumed = caln.run_pipeline(spec, resume=True)
+    assert [o["rmse"] for o in resumed] == [o["rmse"] for o in outcomes]
@@ -0,0 +1,26 @@
+import pandas as pd
+
+import caln
+
+
+def _candidate(iteration, errors):
+    years = sorted(errors)
+    merged = pd.DataFrame({"Year": years, "Yield_OBS": [100.0] * len(years),
+                           "Yield_MOD": [100.0 + errors[y] for y in years]})
+    rmse = (sum(e * e for e in errors.values()) / len(errors)) ** 0.5
+    return {"Iteration": iteration, "Parameters": [iteration], "Metrics": {"RMSE": rmse},
+            "Merged_Data": merged}
+
+
+def test_folds_pick_candidates_on_calibration_years_only():
+    # 1 fits years 1-3 closely; 2 is far better overall only because it nails years 4-6
+    leaky = _candidate(2, {1: 30, 2: -30, 3: 30, 4: 0, 5: 0, 6: 0})
+    honest = _candidate(1, {1: 5, 2: -6, 3: 5, 4: 40, 5: -40, 6: 40})
+    assert leaky["Metrics"]["RMSE"] < honest["Metrics"]["RMSE"]
+
+    folds, candidates = caln.cross_validate([leaky, honest], "Yield", "kfold", n_folds=2, top_k=1)
+
+    fold = next(f for f in folds if f["Validation_Years"] == "4,5,6")
+    assert fold["Selected_Iteration"] == 1
+    assert fold["Val_RMSE"] > 39
+    assert {c["Iteration"] for c in candidates} == {1, 2}